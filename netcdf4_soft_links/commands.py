@@ -4,13 +4,12 @@ import os
 import netCDF4
 import socket
 import multiprocessing
-import requests
 
 #Internal
-from .soft_links import create_soft_links, read_soft_links
+from .soft_links import create_soft_links, read_soft_links, metadata_cache
 from .subset import subset_utils
 from .remote_netcdf import remote_netcdf
-from . import retrieval_manager, queues_manager
+from . import retrieval_manager, queues_manager, requests_sessions, netcdf_utils
 
 valid_file_type_list=['local_file','OPENDAP']
 time_frequency=None
@@ -33,23 +32,48 @@ def validate(options):
     paths_list=[{drs_name:path[drs_id] for drs_id, drs_name in enumerate(drs_to_pass)} for path in paths]
 
     manager=multiprocessing.Manager()
-    validate_semaphores=queues_manager.Semaphores_data_node(manager,num_concurrent=5)
+    #Only remote data nodes are capped:
+    remote_data_node_list=[data_node for data_node in set(data_node_list)
+                           if options.file_type in remote_netcdf.remote_file_types]
+    validate_semaphores=queues_manager.Semaphores_data_node(manager,n=max(20,len(remote_data_node_list)),num_concurrent=5)
+    for data_node in remote_data_node_list:
+        validate_semaphores.add_new_data_node(data_node)
+
+    if 'num_validate_workers' in dir(options):
+        num_validate_workers=options.num_validate_workers
+    else:
+        num_validate_workers=1
 
     remote_netcdf_kwargs={opt: getattr(options,opt) for opt in ['openid','username','password','use_certificates',
                                                                  ] if opt in dir(options)}
-    session=requests.Session()
-    netcdf_pointers=create_soft_links.create_netCDF_pointers(
-                                                      paths_list,
-                                                      time_frequency,options.year,options.month,
-                                                      valid_file_type_list,
-                                                      list(set(data_node_list)),
-                                                      record_other_vars=False,
-                                                      semaphores=validate_semaphores,
-                                                      time_var=options.time_var,
-                                                      session=session,
-                                                      remote_netcdf_kwargs=remote_netcdf_kwargs)
-    output=netCDF4.Dataset(options.out_netcdf_file,'w')
-    netcdf_pointers.record_meta_data(output,options.var_name)
+    #Validate workers share a pool of connections:
+    session=requests_sessions.create_single_session(pool_maxsize=num_validate_workers)
+
+    if 'metadata_cache' in dir(options) and options.metadata_cache:
+        cache=metadata_cache.file_metadata_cache(options.metadata_cache,
+                                                 expire_after=datetime.timedelta(days=options.metadata_cache_expire_after),
+                                                 max_size=options.metadata_cache_max_size)
+    else:
+        cache=None
+
+    try:
+        netcdf_pointers=create_soft_links.create_netCDF_pointers(
+                                                          paths_list,
+                                                          time_frequency,options.year,options.month,
+                                                          valid_file_type_list,
+                                                          list(set(data_node_list)),
+                                                          record_other_vars=False,
+                                                          semaphores=validate_semaphores,
+                                                          time_var=options.time_var,
+                                                          session=session,
+                                                          remote_netcdf_kwargs=remote_netcdf_kwargs,
+                                                          num_validate_workers=num_validate_workers,
+                                                          metadata_cache=cache)
+        output=netCDF4.Dataset(options.out_netcdf_file,'w')
+        netcdf_pointers.record_meta_data(output,options.var_name)
+    finally:
+        if cache is not None:
+            cache.close()
     return
 
 def download_files(options):
@@ -64,8 +88,19 @@ def load(options):
     download(options,retrieval_type='load')
     return
 
+def set_copy_options(options):
+    #The memory budget and threads apply to every variable copied into the output:
+    if 'copy_memory_budget' in dir(options):
+        netcdf_utils.copy_memory_budget=options.copy_memory_budget
+    if 'copy_threads' in dir(options):
+        netcdf_utils.copy_threads=options.copy_threads
+    return
+
 def download(options,retrieval_type='load'):
+    set_copy_options(options)
 
+    #Compressed chunks are copied once the output is closed:
+    netcdf_utils.defer_direct_chunks(options.out_netcdf_file)
     output=netCDF4.Dataset(options.out_netcdf_file,'w')
     data=netCDF4.Dataset(options.in_netcdf_file,'r')
     data_node_list=list(set(data.groups['soft_links'].variables['data_node'][:]))
@@ -86,9 +121,10 @@ def download(options,retrieval_type='load'):
         q_manager.set_opened()
         remote_netcdf_kwargs={opt: getattr(options,opt) for opt in ['openid','username','password','use_certificates',
                                                                      ] if opt in dir(options)}
-        session=requests.Session()
+        session=requests_sessions.create_single_session()
         options_dict={opt: getattr(options,opt) for opt in ['previous','next','year','month','day','hour',
-                                                                     'download_all_files','download_all_opendap'] if opt in dir(options)}
+                                                                     'download_all_files','download_all_opendap',
+                                                                     'waste_ratio'] if opt in dir(options)}
         options_dict['remote_netcdf_kwargs']=remote_netcdf_kwargs
 
         netcdf_pointers=read_soft_links.read_netCDF_pointers(data,time_var=options.time_var,
@@ -105,10 +141,14 @@ def download(options,retrieval_type='load'):
             q_manager.set_closed()
             output=retrieval_manager.launch_download(output,data_node_list,q_manager,options)
             output.close()
+            netcdf_utils.flush_direct_chunks(options.out_netcdf_file)
             if ( retrieval_type=='download_files' and
                 not ( 'do_not_revalidate' in dir(options) and options.do_not_revalidate)):
                 pass
                 #Revalidate not implemented yet
+        else:
+            output.close()
+            netcdf_utils.flush_direct_chunks(options.out_netcdf_file)
     finally:
         if retrieval_type!='load':
             #Terminate the download processes:
@@ -117,6 +157,7 @@ def download(options,retrieval_type='load'):
     return
 
 def subset(options):
+    set_copy_options(options)
     subset_utils.subset(options.in_netcdf_file,options.out_netcdf_file,
                             lonlatbox=options.lonlatbox,
                             lat_var=options.lat_var,lon_var=options.lon_var,
@@ -1,6 +1,16 @@
 #External:
 import numpy as np
-from itertools import groupby, count
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from itertools import groupby, count, product
+
+#Cache of matched indices, keyed on the dimension arrays. It is shared by retrieval threads:
+indices_from_dim_cache=OrderedDict()
+indices_from_dim_cache_size=256
+indices_from_dim_lock=threading.Lock()
 
 def get_indices_from_dim(source,output):
     #This function finds which indices from source should be used and in which order:
@@ -9,19 +19,48 @@ def get_indices_from_dim(source,output):
     if len(source)==1 and len(output)==1:
         return np.array([0,])
 
-    indices = np.arange(max(source.shape))[np.in1d(source,output)]
-    try:
-        return np.array([ indices[source[indices] == val][0] for val in output ])
-    except IndexError:
-        #The in1d might have encountered afloating point error. Make the equality fuzzy:
-        #warnings.warn('Dimension matching was done to floating point tolerance for some model',UserWarning)
-        indices=np.arange(max(source.shape))[np.array([np.any(np.isclose(output,item,atol=1e-5)) for item in source])]
-        #try:
-        return np.array([indices[np.isclose(source[indices], val, atol=1e-5)][0] for val in output])
-        #except IndexError:
-        #    print indices
-        #    print(source,output)
-        #    raise
+    source=np.asarray(source)
+    output=np.asarray(output)
+    key=(array_hash(source),array_hash(output))
+    with indices_from_dim_lock:
+        indices=indices_from_dim_cache.pop(key,None)
+        if indices is not None:
+            indices_from_dim_cache[key]=indices
+    if indices is None:
+        #Match outside the lock:
+        indices=match_indices(source,output)
+        with indices_from_dim_lock:
+            indices_from_dim_cache.pop(key,None)
+            if len(indices_from_dim_cache)>=indices_from_dim_cache_size:
+                indices_from_dim_cache.popitem(last=False)
+            indices_from_dim_cache[key]=indices
+    return indices.copy()
+
+def array_hash(array):
+    return hashlib.sha1(str(array.dtype)+str(array.shape)+np.ascontiguousarray(array).tostring()).hexdigest()
+
+def match_indices(source,output,atol=1e-5,rtol=1e-5):
+    #For every value in output, find the first index in source with the same value.
+    #A stable sort ensures that the first occurence is found:
+    order=np.argsort(source,kind='mergesort')
+    sorted_source=source[order]
+    positions=np.minimum(np.searchsorted(sorted_source,output,side='left'),len(source)-1)
+    if np.all(sorted_source[positions]==output):
+        return order[positions]
+
+    #There might be a floating point error. Make the equality fuzzy,
+    #with the same tolerance as np.isclose:
+    #warnings.warn('Dimension matching was done to floating point tolerance for some model',UserWarning)
+    tolerance=atol+rtol*np.abs(output)
+    lower=np.searchsorted(sorted_source,output-tolerance,side='left')
+    upper=np.searchsorted(sorted_source,output+tolerance,side='right')
+    if np.any(lower>=upper):
+        raise IndexError('Some values could not be found in dimension')
+    #First index in every tolerance window:
+    bounds=np.empty(2*len(output),dtype=np.int64)
+    bounds[::2]=lower
+    bounds[1::2]=upper
+    return np.minimum.reduceat(np.append(order,len(source)),bounds)[::2]
 
 def convert_indices_to_slices(indices):
     #This feature is currently broken (December 2014):
@@ -71,6 +110,64 @@ def prepare_indices(indices):
     indices=convert_indices_to_slices(indices)
     return indices, unsort_indices
 
+def coalesce_slices(slices,waste_ratio):
+    #Merge neighbouring slices into bounding slices as long as the fraction of
+    #elements read but not needed stays below waste_ratio.
+    #Also returns the position of every requested element within the new slices:
+    groups=[]
+    for slice_item in slices:
+        slice_indices=np.arange(slice_item.start,slice_item.stop,slice_item.step)
+        if len(slice_indices)==0:
+            continue
+        if len(groups)>0:
+            start=groups[-1]['start']
+            stop=max(groups[-1]['stop'],slice_indices[-1]+1)
+            needed=groups[-1]['needed']+len(slice_indices)
+            if ( slice_indices[0]>=start and
+                 1.0-needed/float(stop-start)<=waste_ratio ):
+                groups[-1]['slices'].append(slice_item)
+                groups[-1]['indices'].append(slice_indices)
+                groups[-1]['stop']=stop
+                groups[-1]['needed']=needed
+                continue
+        groups.append({'slices':[slice_item],'indices':[slice_indices],
+                       'start':slice_indices[0],'stop':slice_indices[-1]+1,
+                       'needed':len(slice_indices)})
+
+    coalesced_slices=[]
+    positions=[]
+    offset=0
+    for group in groups:
+        if len(group['slices'])==1:
+            #Keep the original slice:
+            coalesced_slices.append(group['slices'][0])
+            positions.append(offset+np.arange(group['needed']))
+            offset+=group['needed']
+        else:
+            coalesced_slices.append(slice(group['start'],group['stop'],1))
+            positions.extend([offset+indices-group['start'] for indices in group['indices']])
+            offset+=group['stop']-group['start']
+    if len(positions)==0:
+        return slices, np.arange(0)
+    return coalesced_slices, np.concatenate(positions)
+
+def coalesce_indices(indices,unsort_indices,dimensions,waste_ratio=0.5):
+    #Read planner. Fewer and larger hyperslabs are retrieved and the requested
+    #elements are subselected in memory.
+    #With waste_ratio=0 the requested slices are retrieved exactly:
+    if waste_ratio<=0:
+        return indices, unsort_indices
+    coalesced_indices=copy.copy(indices)
+    coalesced_unsort_indices=copy.copy(unsort_indices)
+    for dim in dimensions:
+        if len(indices[dim])>1:
+            coalesced_indices[dim], positions=coalesce_slices(indices[dim],waste_ratio)
+            if len(coalesced_indices[dim])<len(indices[dim]):
+                coalesced_unsort_indices[dim]=positions[unsort_indices[dim]]
+            else:
+                coalesced_indices[dim]=indices[dim]
+    return coalesced_indices, coalesced_unsort_indices
+
 def largest_hyperslab(slices_dict):
     return np.prod([max([slice_length(item) for item in slices_dict[dim]])
                 for dim in slices_dict.keys()])
@@ -80,21 +177,78 @@ def slice_length(slice_item):
         
 def retrieve_slice(variable,indices,unsort_indices,dim,dimensions,dim_id,max_request,getitem_tuple=tuple(),default=False):
     if default: return np.array([])
-    if len(dimensions)>0:
-        return take_safely(np.ma.concatenate(map(lambda x: retrieve_slice(variable,
-                                                 indices,
-                                                 unsort_indices,
-                                                 dimensions[0],
-                                                 dimensions[1:],
-                                                 dim_id+1,
-                                                 max_request,
-                                                 getitem_tuple=getitem_tuple+(x,)),
-                                                 indices[dim]),
-                              axis=dim_id),unsort_indices[dim],axis=dim_id)
+    dims_list=[dim]+list(dimensions)
+    prefix_shape=tuple([slice_length(item) for item in getitem_tuple])
+
+    #For every slice, find where its elements go in the output:
+    output_positions=[]
+    block_positions=[]
+    for cur_dim in dims_list:
+        unsort=np.asarray(unsort_indices[cur_dim])
+        output_positions.append([])
+        block_positions.append([])
+        offset=0
+        for slice_item in indices[cur_dim]:
+            length=slice_length(slice_item)
+            positions=np.nonzero((unsort>=offset)&(unsort<offset+length))[0]
+            output_positions[-1].append((positions,index_to_slice(positions)))
+            block_positions[-1].append((unsort[positions]-offset,index_to_slice(unsort[positions]-offset)))
+            offset+=length
+    output_shape=prefix_shape+tuple([len(unsort_indices[cur_dim]) for cur_dim in dims_list])
+
+    #Preallocate the output once and write every block at its final position:
+    output=None
+    output_mask=None
+    prefix_index=(slice(None),)*len(prefix_shape)
+    for slices_ids in product(*[range(len(indices[cur_dim])) for cur_dim in dims_list]):
+        output_index=[output_positions[dim_num][slice_id] for dim_num, slice_id in enumerate(slices_ids)]
+        if min([len(item[0]) for item in output_index]+[1])==0:
+            #Nothing in this block is needed:
+            continue
+        block=getitem_from_variable(variable,
+                                    getitem_tuple+tuple([indices[cur_dim][slice_id] for cur_dim, slice_id in zip(dims_list,slices_ids)]),
+                                    max_request)
+        if output is None:
+            output=np.empty(output_shape,dtype=block.dtype)
+        output_index=prefix_index+outer_index(output_index)
+        block_index=prefix_index+outer_index([block_positions[dim_num][slice_id] for dim_num, slice_id in enumerate(slices_ids)])
+        output[output_index]=np.ma.getdata(block)[block_index]
+
+        #Only create a mask if there are masked values:
+        block_mask=np.ma.getmask(block)
+        if block_mask is not np.ma.nomask and block_mask.any():
+            if output_mask is None:
+                output_mask=np.zeros(output_shape,dtype=bool)
+            output_mask[output_index]=block_mask[block_index]
+        elif output_mask is not None:
+            output_mask[output_index]=False
+    if output is None:
+        return np.ma.masked_all(output_shape)
+    if output_mask is None:
+        output_mask=np.ma.nomask
+    return np.ma.array(output,mask=output_mask,copy=False)
+
+def outer_index(index_list):
+    #Use slices whenever possible to avoid copies:
+    slices_list=[item[1] for item in index_list]
+    if len([item for item in slices_list if not isinstance(item,slice)])<=1:
+        return tuple(slices_list)
     else:
-        return take_safely(np.ma.concatenate(map(lambda x: getitem_from_variable(variable,getitem_tuple+(x,),max_request),
-                                                 indices[dim]),
-                              axis=dim_id),unsort_indices[dim],axis=dim_id)
+        return np.ix_(*[item[0] for item in index_list])
+
+def index_to_slice(index):
+    #Converts an arithmetic progression of indices to a slice:
+    if len(index)==0:
+        return index
+    elif len(index)==1:
+        return slice(index[0],index[0]+1,1)
+    step=index[1]-index[0]
+    if step==0 or not np.all(np.diff(index)==step):
+        return index
+    stop=index[-1]+step
+    if stop<0:
+        stop=None
+    return slice(index[0],stop,step)
 
 def take_safely(x, indices, axis=0):
     if x.shape[axis] == 0:
@@ -106,14 +260,51 @@ def take_safely(x, indices, axis=0):
     else:
         return np.ma.take(x, indices, axis=axis)
 
+def bytes_per_element(variable):
+    #Size of one element once retrieved. Compression does not matter since
+    #servers and memory are limited by the uncompressed size:
+    try:
+        itemsize=np.dtype(variable.dtype).itemsize
+    except TypeError:
+        itemsize=0
+    if itemsize==0:
+        #Variable-length types. Assume the largest numerical type:
+        itemsize=8
+    return itemsize
+
+#Requests made by each thread, recorded between start_request_log and stop_request_log:
+request_log=threading.local()
+
+def start_request_log():
+    request_log.requests=[]
+    return
+
+def stop_request_log():
+    #Returns a list of (size in Mb, elapsed time in seconds, split) for every request:
+    requests=getattr(request_log,'requests',None)
+    request_log.requests=None
+    if requests is None:
+        return []
+    return requests
+
+def logged_getitem(variable,getitem_tuple,itemsize,split):
+    start_time=time.time()
+    data=variable[getitem_tuple]
+    requests=getattr(request_log,'requests',None)
+    if requests is not None:
+        size=itemsize*np.prod([( (item.stop-item.start)//item.step) for item in getitem_tuple])/(1024.0*1024.0)
+        requests.append((size,time.time()-start_time,split))
+    return data
+
 def getitem_from_variable(variable,getitem_tuple,max_request):
+    itemsize=bytes_per_element(variable)
     if ( max_request==None or
-         max_request*1024*1024>32*np.prod([( (item.stop-item.start)//item.step) for item in getitem_tuple]) ):
+         max_request*1024*1024>itemsize*np.prod([( (item.stop-item.start)//item.step) for item in getitem_tuple]) ):
         
-        return variable[getitem_tuple]
+        return logged_getitem(variable,getitem_tuple,itemsize,False)
     else:
         #Max number of steps along first dimension: 
-        max_steps = np.maximum(int(np.floor(max_request*1024*1024/(32*np.prod([( (item.stop-item.start)//item.step) for item in getitem_tuple[1:]])))), 1)
+        max_steps = np.maximum(int(np.floor(max_request*1024*1024/(itemsize*np.prod([( (item.stop-item.start)//item.step) for item in getitem_tuple[1:]])))), 1)
 
         first_dim_length = (getitem_tuple[0].stop - getitem_tuple[0].start) // getitem_tuple[0].step
         num_split = np.minimum( first_dim_length // max_steps, first_dim_length)
@@ -121,6 +312,6 @@ def getitem_from_variable(variable,getitem_tuple,max_request):
         id_lists = np.array_split(np.arange( getitem_tuple[0].start,  getitem_tuple[0].stop,  getitem_tuple[0].step), num_split)
 
         slice_list = map(lambda x: convert_indices_to_slices_step(x, getitem_tuple[0].step)[0], id_lists)
-        return np.ma.concatenate(map(lambda x: variable[(x,) + getitem_tuple[1:]], slice_list),
+        return np.ma.concatenate(map(lambda x: logged_getitem(variable,(x,) + getitem_tuple[1:],itemsize,True), slice_list),
                                  axis=0)
                                             
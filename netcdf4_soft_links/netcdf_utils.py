@@ -1,13 +1,20 @@
 #External:
 import numpy as np
 import math
+import re
 import time
 import h5netcdf.legacyapi as netCDF4_h5
 import netCDF4
+import netcdftime
 import h5py
+import ctypes
 import datetime
 import copy
 import os
+import sys
+import threading
+import Queue
+from itertools import product
 from collections import OrderedDict
 #import dask.array as da
 
@@ -39,6 +46,16 @@ def get_date_axis(dataset, time_dim, default=False):
         calendar = None
     return get_date_axis_from_units_and_calendar(dataset.variables[time_dim][:], units, calendar)
 
+def get_date_components_from_dataset(dataset, time_dim, default=False):
+    if default: return get_date_components(np.array([]), None, None, default=True)
+
+    units = getncattr(dataset.variables[time_dim], 'units')
+    if 'calendar' in dataset.variables[time_dim].ncattrs():
+        calendar = getncattr(dataset.variables[time_dim], 'calendar')
+    else:
+        calendar = None
+    return get_date_components(dataset.variables[time_dim][:], units, calendar)
+
 def get_date_axis_from_units_and_calendar(time_axis, units, calendar, default=False):
     if default: return np.array([])
 
@@ -50,6 +67,11 @@ def get_date_axis_from_units_and_calendar(time_axis, units, calendar, default=Fa
 
 def get_date_axis_relative(time_axis,units,calendar,default=False):
     if default: return np.array([])
+    try:
+        return num2date(time_axis, units, calendar if calendar is not None else 'standard')
+    except NotImplementedError:
+        #Units or calendar that are not vectorized:
+        pass
     if calendar is not None:
         try:
             date_axis = netCDF4.num2date(time_axis,units=units,calendar=calendar)
@@ -69,7 +91,214 @@ def get_date_axis_relative(time_axis,units,calendar,default=False):
 
 def get_date_axis_absolute(time_axis,default=False):
     if default: return np.array([])
-    return map(convert_to_date_absolute,time_axis)
+    years, months, days, hours, minutes, seconds = decode_date_absolute(time_axis)
+    valid_months = (months >= 1) & (months <= 12)
+    is_leap = (years % 4 == 0) & ((years % 100 != 0) | (years % 400 == 0))
+    days_in_months = (np.array(fixed_calendars_days_per_month['noleap'])[np.where(valid_months, months - 1, 0)] +
+                      (is_leap & (months == 2)))
+    if not ( np.all((years >= 1) & (years <= 9999) & valid_months) and
+             np.all((days >= 1) & (days <= days_in_months)) and
+             np.all((hours < 24) & (minutes < 60) & (seconds < 60)) ):
+        #Let datetime raise its usual error:
+        return np.array(map(convert_to_date_absolute, time_axis))
+    #numpy creates the datetime objects. 2440588 is the Julian Day Number of 1970-01-01:
+    seconds_since_epoch = ((day_number_from_date(years, months, days, 'proleptic_gregorian') - 2440588)*86400 +
+                           hours*3600 + minutes*60 + seconds)
+    return seconds_since_epoch.astype('datetime64[s]').astype(object)
+
+def get_date_components(time_axis, units, calendar, default=False):
+    #Returns integer year, month, day and hour arrays without creating date objects:
+    if default: return tuple([np.array([], dtype=np.int64) for id in range(4)])
+    time_axis = np.asarray(time_axis)
+    if units == 'day as %Y%m%d.%f':
+        return get_date_components_absolute(time_axis)
+    if calendar is None:
+        calendar = 'standard'
+    try:
+        return get_date_components_relative(time_axis, units, calendar)
+    except NotImplementedError:
+        #Units or calendar that are not vectorized:
+        date_axis = get_date_axis_relative(time_axis, units, calendar)
+        return tuple([np.array([getattr(date, component) for date in date_axis], dtype=np.int64)
+                      for component in ['year', 'month', 'day', 'hour']])
+
+def get_date_components_absolute(time_axis):
+    return decode_date_absolute(time_axis)[:4]
+
+def decode_date_absolute(time_axis):
+    #Same arithmetic as convert_to_date_absolute, on whole arrays.
+    #Returns integer year, month, day, hour, minute and second arrays:
+    time_axis = np.asarray(time_axis)
+    years = np.floor(time_axis/1e4)
+    remainder = time_axis - years*1e4
+    months = np.floor(remainder/1e2)
+    remainder = remainder - months*1e2
+    days = np.floor(remainder)
+    remainder = (remainder - days)*24.0
+    hours = np.floor(remainder)
+    remainder = (remainder - hours)*60.0
+    minutes = np.floor(remainder)
+    remainder = (remainder - minutes)*60.0
+    seconds = np.floor(remainder)
+    return tuple([item.astype(np.int64) for item in [years, months, days, hours, minutes, seconds]])
+
+time_units_seconds = {'days': 86400, 'day': 86400, 'd': 86400,
+                      'hours': 3600, 'hour': 3600, 'hrs': 3600, 'hr': 3600, 'h': 3600,
+                      'minutes': 60, 'minute': 60, 'mins': 60, 'min': 60,
+                      'seconds': 1, 'second': 1, 'secs': 1, 'sec': 1, 's': 1}
+
+time_units_cache = dict()
+
+def parse_time_units(units):
+    #Returns the number of seconds in one unit and the reference (year, month, day, seconds into day).
+    #The same few units strings are parsed for every file so the result is memoized:
+    if not units in time_units_cache:
+        time_units_cache[units] = _parse_time_units(units)
+    return time_units_cache[units]
+
+def _parse_time_units(units):
+    match = re.match(r'^\s*(\w+)\s+since\s+(-?\d+)-(\d+)-(\d+)'
+                     r'(?:[ T]+(\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?\s*(?:Z|UTC)?\s*$', units)
+    if match is None or not match.group(1).lower() in time_units_seconds.keys():
+        raise NotImplementedError('Units '+units+' are not supported')
+    year, month, day = [int(match.group(id)) for id in range(2, 5)]
+    seconds = 0.0
+    if match.group(5) is not None:
+        seconds = int(match.group(5))*3600 + int(match.group(6))*60
+        if match.group(7) is not None:
+            seconds += float(match.group(7))
+    return time_units_seconds[match.group(1).lower()], (year, month, day, seconds)
+
+fixed_calendars_days_per_month = {'noleap': [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+                                  '365_day': [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+                                  'all_leap': [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+                                  '366_day': [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+                                  '360_day': [30 for month in range(12)]}
+
+def get_date_components_relative(time_axis, units, calendar):
+    unit_seconds, reference = parse_time_units(units)
+    reference_day = day_number_from_date(reference[0], reference[1], reference[2], calendar)
+    #Round to the nearest millisecond to remove floating point errors:
+    milliseconds = np.round((time_axis*float(unit_seconds) + reference[3])*1e3).astype(np.int64)
+    day_numbers = reference_day + milliseconds // 86400000
+    hours = (milliseconds % 86400000) // 3600000
+    years, months, days = date_from_day_number(day_numbers, calendar)
+    return years, months, days, hours
+
+def day_number_from_date(year, month, day, calendar):
+    #Day number in calendar. Julian Day Number for the real-world calendars.
+    #Works on scalars and on integer arrays:
+    calendar = calendar.lower()
+    if calendar in fixed_calendars_days_per_month.keys():
+        days_per_month = fixed_calendars_days_per_month[calendar]
+        months_starts = np.cumsum([0] + days_per_month[:-1])
+        return year*sum(days_per_month) + months_starts[month - 1] + day - 1
+    if not calendar in ['standard', 'gregorian', 'proleptic_gregorian', 'julian']:
+        raise NotImplementedError('Calendar '+calendar+' is not supported')
+    if np.any(np.asarray(year) == 0):
+        raise NotImplementedError('Year 0 does not exist in calendar '+calendar)
+    #There is no year 0 in these calendars:
+    year = np.where(year < 0, year + 1, year)
+    a = (14 - month)//12
+    y = year + 4800 - a
+    m = month + 12*a - 3
+    julian_day_number = day + (153*m + 2)//5 + 365*y + y//4
+    if calendar == 'proleptic_gregorian':
+        return julian_day_number - y//100 + y//400 - 32045
+    elif calendar == 'julian':
+        return julian_day_number - 32083
+    #Switch from the julian to the gregorian calendar on 1582-10-15:
+    return np.where(year*10000 + month*100 + day >= 15821015,
+                    julian_day_number - y//100 + y//400 - 32045,
+                    julian_day_number - 32083)
+
+def date_from_day_number(day_numbers, calendar):
+    calendar = calendar.lower()
+    if calendar in fixed_calendars_days_per_month.keys():
+        days_per_month = fixed_calendars_days_per_month[calendar]
+        years = day_numbers // sum(days_per_month)
+        day_of_year = day_numbers % sum(days_per_month)
+        months_starts = np.cumsum([0] + days_per_month[:-1])
+        months = np.searchsorted(months_starts, day_of_year, side='right')
+        days = day_of_year - months_starts[months - 1] + 1
+        return years, months, days
+
+    if calendar == 'proleptic_gregorian':
+        gregorian = np.ones(day_numbers.shape, dtype=bool)
+    elif calendar in ['standard', 'gregorian']:
+        #Switch from the julian to the gregorian calendar on 1582-10-15:
+        gregorian = day_numbers >= 2299161
+    elif calendar == 'julian':
+        gregorian = np.zeros(day_numbers.shape, dtype=bool)
+    else:
+        raise NotImplementedError('Calendar '+calendar+' is not supported')
+
+    c = day_numbers + 32082
+    b = np.zeros(day_numbers.shape, dtype=np.int64)
+    #Gregorian centuries:
+    a = day_numbers[gregorian] + 32044
+    b[gregorian] = (4*a + 3)//146097
+    c[gregorian] = a - (146097*b[gregorian])//4
+    d = (4*c + 3)//1461
+    e = c - (1461*d)//4
+    m = (5*e + 2)//153
+    days = e - (153*m + 2)//5 + 1
+    months = m + 3 - 12*(m//10)
+    years = 100*b + d - 4800 + m//10
+    #There is no year 0 in these calendars:
+    years[years <= 0] -= 1
+    return years, months, days
+
+date_types = {'standard': netcdftime.DatetimeGregorian,
+              'gregorian': netcdftime.DatetimeGregorian,
+              'proleptic_gregorian': netcdftime.DatetimeProlepticGregorian,
+              'julian': netcdftime.DatetimeJulian,
+              'noleap': netcdftime.DatetimeNoLeap,
+              '365_day': netcdftime.DatetimeNoLeap,
+              'all_leap': netcdftime.DatetimeAllLeap,
+              '366_day': netcdftime.DatetimeAllLeap,
+              '360_day': netcdftime.Datetime360Day}
+
+def num2date(time_axis, units, calendar):
+    #Vectorized netCDF4.num2date. Date objects are created only once the calendar arithmetic is done:
+    calendar = calendar.lower()
+    if not calendar in date_types.keys() or np.ma.is_masked(time_axis):
+        raise NotImplementedError('Calendar '+calendar+' is not supported')
+    unit_seconds, reference = parse_time_units(units)
+    if reference[0] < 1 and not calendar in fixed_calendars_days_per_month.keys():
+        raise NotImplementedError('Reference year must be positive in calendar '+calendar)
+    time_axis = np.asarray(time_axis, dtype=np.float64)
+    if time_axis.size == 0:
+        return np.empty(time_axis.shape, dtype=object)
+    if not np.all(np.isfinite(time_axis)):
+        raise NotImplementedError('Only finite times are supported')
+    reference_day = day_number_from_date(reference[0], reference[1], reference[2], calendar)
+
+    #Split whole and fractional units to keep microseconds exact:
+    whole_units = np.floor(time_axis)
+    microseconds = (whole_units.astype(np.int64)*unit_seconds*1000000 +
+                    np.round(((time_axis - whole_units)*unit_seconds + reference[3])*1e6).astype(np.int64))
+    day_numbers = reference_day + microseconds // 86400000000
+    microseconds = microseconds % 86400000000
+    years, months, days = date_from_day_number(np.atleast_1d(day_numbers).ravel(), calendar)
+
+    #Same date types as netCDF4.num2date:
+    if calendar == 'gregorian' and np.min(years) < 1:
+        raise NotImplementedError('Years before 1 are not supported in calendar '+calendar)
+    if ( (calendar in ['proleptic_gregorian', 'gregorian'] and np.min(years) >= 1) or
+         (calendar == 'standard' and np.min(day_numbers) >= 2299161) ):
+        date_type = datetime.datetime
+    else:
+        date_type = date_types[calendar]
+    microseconds = np.atleast_1d(microseconds).ravel()
+    components = [years, months, days,
+                  microseconds // 3600000000, (microseconds // 60000000) % 60,
+                  (microseconds // 1000000) % 60, microseconds % 1000000]
+    date_axis = np.empty(len(years), dtype=object)
+    date_axis[:] = [date_type(*date) for date in zip(*[item.tolist() for item in components])]
+    if time_axis.ndim == 0:
+        return date_axis[0]
+    return date_axis.reshape(time_axis.shape)
 
 def get_time(dataset,time_var='time',default=False):
     if default: return np.array([])
@@ -269,43 +498,34 @@ def append_and_copy_variable(dataset,output,var_name,record_dimensions,
         storage_size = dataset.variables[var_name]._h5ds.id.get_storage_size()
 
     if variable_size > 0 and storage_size > 0:
-        max_request = 450.0 #maximum request in Mb
-        #use dask array store
-        max_first_dim_steps = max(
-                        int(np.floor(max_request*1024*1024/(32*np.prod(dataset.variables[var_name].shape[1:])))),
-                        1)
-
-    #Using dask. Not working yet:
-    #    source = da.from_array(dataset.variables[var_name], 
-    #                           chunks=(max_first_dim_steps,)+dataset.variables[var_name].shape[1:])
-    #
-    #    getitem_tuple = tuple([ slice(0,_dim_len(dataset,dim),1) if not dim in record_dimensions.keys()
-    #                                                      else record_dimensions[dim]['append_slice']
-    #                                                      for dim in dataset.variables[var_name].dimensions ])
-    #    dest = ( da.from_array(output.variables[var_name], 
-    #                         chunks=(1,)+output.variables[var_name].shape[1:])[getitem_tuple]
-    #                         .rechunk((max_first_dim_steps,)+dataset.variables[var_name].shape[1:]) )
-    #
-    #    da.store(source, dest)
-    #return output
-
-        num_first_dim_chunk = int(np.ceil(dataset.variables[var_name].shape[0]/float(max_first_dim_steps)))
-        for first_dim_chunk in range(num_first_dim_chunk):
-            first_dim_slice = slice(first_dim_chunk*max_first_dim_steps,
-                             min((first_dim_chunk+1)*max_first_dim_steps,dataset.variables[var_name].shape[0])
-                             ,1)
-            output = append_dataset_first_dim_slice(dataset,output,var_name,first_dim_slice,record_dimensions,check_empty)
-    return output
-
-def append_dataset_first_dim_slice(dataset,output,var_name,first_dim_slice,record_dimensions,check_empty):
-    #Create a setitem tuple
-    setitem_list = [ slice(0,_dim_len(dataset,dim),1) if not dim in record_dimensions.keys()
-                                                               else record_dimensions[dim]['append_slice']
-                                                              for dim in dataset.variables[var_name].dimensions]
-    #Pick a first_dim_slice along the first dimension:
-    setitem_list[0] = indices_utils.slice_a_slice(setitem_list[0], first_dim_slice)
-    temp = dataset.variables[var_name][first_dim_slice, ...]
-    assign_not_masked(temp, output.variables[var_name], setitem_list, check_empty)
+        dimensions = dataset.variables[var_name].dimensions
+        setitem_list = [ slice(0,_dim_len(dataset,dim),1) if not dim in record_dimensions.keys()
+                                                          else record_dimensions[dim]['append_slice']
+                                                          for dim in dimensions]
+        if ( all([ isinstance(setitem, slice) and setitem.step == 1 for setitem in setitem_list ]) and
+             copy_direct_chunks(dataset.variables[var_name], output.variables[var_name],
+                                [ setitem.start for setitem in setitem_list ]) ):
+            return output
+
+        #Destination chunks are aligned only if the appended records start on a chunk:
+        dest_chunks = [ chunk if (isinstance(setitem, slice) and setitem.step == 1 and
+                                  setitem.start % chunk == 0) else 1
+                        for chunk, setitem in zip(_chunking(output, var_name, len(dimensions)), setitem_list) ]
+        blocks = copy_blocks(dataset.variables[var_name].shape,
+                             copy_alignment(_chunking(dataset, var_name, len(dimensions)), dest_chunks),
+                             indices_utils.bytes_per_element(dataset.variables[var_name]))
+
+        def read_block(block):
+            return dataset.variables[var_name][block]
+
+        def write_block(block, temp):
+            assign_not_masked(temp, output.variables[var_name],
+                              [ indices_utils.slice_a_slice(setitem, block_slice) if dim in record_dimensions.keys()
+                                else block_slice for dim, setitem, block_slice in zip(dimensions, setitem_list, block) ],
+                              check_empty)
+            return
+
+        copy_in_blocks(read_block, write_block, blocks, lock_reads=_uses_library(dataset))
     return output
 
 def assign_not_masked(source, dest, setitem_list, check_empty):
@@ -382,59 +602,292 @@ def replicate_and_copy_variable(dataset,output,var_name,
         storage_size = dataset.variables[var_name]._h5ds.id.get_storage_size()
 
     if variable_size > 0 and storage_size > 0:
-        max_request = 450.0 #maximum request in Mb
-        #max_request=9000.0 #maximum request in Mb
-
+        dimensions = dataset.variables[var_name].dimensions
         #Create the output variable shape, allowing slices:
         var_shape = tuple([ dataset.variables[var_name].shape[dim_id] if not dim in comp_slices.keys()
                             else len(np.arange(dataset.variables[var_name].shape[dim_id])[comp_slices[dim]])
-                            for dim_id,dim in enumerate(dataset.variables[var_name].dimensions) ])
-        max_first_dim_steps = max(
-                        int(np.floor(max_request*1024*1024/(32*np.prod(var_shape[1:])))),
-                        1)
-
-#    # Using dask. Not working yet:
-#        getitem_tuple = tuple([ comp_slices[var_dim] if var_dim in comp_slices.keys()
-#                                else slice(None,None,1) for var_dim in
-#                                dataset.variables[var_name].dimensions ])
-#        source = ( da.from_array(dataset.variables[var_name], 
-#                               chunks=(1,)+dataset.variables[var_name].shape[1:])[getitem_tuple]
-#                               .rechunk((max_first_dim_steps,)+output.variables[var_name].shape[1:]) )
-#        dest = ( da.from_array(output.variables[var_name], 
-#                               chunks=(max_first_dim_steps,)+output.variables[var_name].shape[1:]))
-#    
-#        print(dest.dask)
-#        da.store(source, dest)
-#    #    da.store(source, output.variables[var_name])
-#    return output
-
-#def dummy():
-        num_first_dim_chunk = int(np.ceil(var_shape[0]/float(max_first_dim_steps)))
-
-        for first_dim_chunk in range(num_first_dim_chunk):
-            first_dim_slice = slice(first_dim_chunk*max_first_dim_steps,
-                                    min((first_dim_chunk+1)*max_first_dim_steps,var_shape[0])
-                                    ,1)
-            output = copy_dataset_first_dim_slice(dataset, output, var_name, first_dim_slice,
-                                                  check_empty,slices=comp_slices)
-#        return output
+                            for dim_id,dim in enumerate(dimensions) ])
+        if ( len(set(dimensions).intersection(comp_slices.keys())) == 0 and
+             copy_direct_chunks(dataset.variables[var_name], output.variables[var_name],
+                                [ 0 for dim in dimensions ]) ):
+            return output
+
+        #Source chunks are not aligned along sliced dimensions:
+        source_chunks = [ chunk if not dim in comp_slices.keys() else 1
+                          for chunk, dim in zip(_chunking(dataset, var_name, len(dimensions)), dimensions) ]
+        blocks = copy_blocks(var_shape,
+                             copy_alignment(source_chunks, _chunking(output, var_name, len(dimensions))),
+                             indices_utils.bytes_per_element(dataset.variables[var_name]))
+
+        def read_block(block):
+            getitem_tuple = tuple([ block_slice if not dim in comp_slices.keys()
+                                    else (comp_slices[dim] if block_slice == slice(0, length, 1)
+                                          else indices_utils.slice_a_slice(comp_slices[dim], block_slice))
+                                    for dim, length, block_slice in zip(dimensions, var_shape, block) ])
+            return dataset.variables[var_name][getitem_tuple]
+
+        def write_block(block, temp):
+            assign_not_masked(temp, output.variables[var_name], list(block) + [Ellipsis], check_empty)
+            return
+
+        copy_in_blocks(read_block, write_block, blocks, lock_reads=_uses_library(dataset))
     return output
 
-def copy_dataset_first_dim_slice(dataset, output, var_name, first_dim_slice, check_empty, slices=dict()):
-    combined_slices = slices.copy()
-    first_dim = dataset.variables[var_name].dimensions[0]
-    if first_dim in combined_slices:
-        combined_slices[first_dim] = indices_utils.slice_a_slice(combined_slices[first_dim], first_dim_slice)
+#HDF5 library h5py is linked against. H5Dread_chunk requires HDF5 1.10.2:
+h5lib = ctypes.CDLL(h5py.h5d.__file__)
+h5lib_read_chunk = hasattr(h5lib, 'H5Dread_chunk')
+
+def copy_direct_chunks(source, dest, offsets):
+    #Copies the compressed chunks of an HDF5 variable as they are stored, without decompressing
+    #and recompressing them. Only possible when both variables have the same chunks, type, fill value
+    #and filters, and when every chunk lands on a destination chunk.
+    #h5netcdf variables are copied right away. netCDF4 outputs are only written by netCDF4 while they
+    #are open, since netCDF4 and h5py may link different HDF5 libraries: their chunks are copied
+    #by flush_direct_chunks, if the output was registered with defer_direct_chunks.
+    #Returns False if the variable must be copied through numpy instead:
+    if not h5lib_read_chunk:
+        return False
+    if '_h5ds' in dir(source) and '_h5ds' in dir(dest):
+        return _copy_direct_chunks(source._h5ds, dest._h5ds, offsets)
+    elif isinstance(dest, netCDF4.Variable):
+        return _defer_direct_chunks(source, dest, offsets)
+    return False
+
+def _copy_direct_chunks(source_ds, dest_ds, offsets):
+    if ( source_ds.chunks is None or
+         source_ds.chunks != dest_ds.chunks or
+         source_ds.dtype != dest_ds.dtype or
+         not np.array_equal(source_ds.fillvalue, dest_ds.fillvalue) or
+         _filters_pipeline(source_ds) != _filters_pipeline(dest_ds) or
+         not _chunks_aligned(source_ds.shape, dest_ds.shape, source_ds.chunks, offsets) ):
+        return False
+
+    for chunk_offset in product(*[ range(0, length, chunk) for length, chunk in zip(source_ds.shape, source_ds.chunks) ]):
+        filter_mask, chunk_data = _read_direct_chunk(source_ds, chunk_offset)
+        if chunk_data is None:
+            #Chunk only holds fill values:
+            continue
+        dest_ds.id.write_direct_chunk(tuple([ int(chunk_start + offset) for chunk_start, offset
+                                              in zip(chunk_offset, offsets) ]),
+                                      chunk_data, filter_mask)
+    return True
+
+def _chunks_aligned(shape, dest_shape, chunks, offsets):
+    for length, dest_length, chunk, offset in zip(shape, dest_shape, chunks, offsets):
+        if ( offset % chunk != 0 or
+             offset + length > dest_length or
+             #A partial chunk at the end of the source would overwrite the destination beyond it:
+             ( length % chunk != 0 and offset + length != dest_length ) ):
+            return False
+    return True
+
+#Outputs whose chunks are copied once they are closed, with the copies waiting for them:
+deferred_chunks = dict()
+deferred_chunks_lock = threading.Lock()
+
+def defer_direct_chunks(file_name):
+    #Chunks copied into the netCDF4 output file_name are copied by flush_direct_chunks, after the
+    #output is closed. Variables copied this way read as fill values until then. Coordinate variables,
+    #that might be read back from the output, are always copied right away:
+    with deferred_chunks_lock:
+        deferred_chunks[os.path.abspath(file_name)] = []
+    return
+
+def flush_direct_chunks(file_name):
+    #Copies the chunks deferred for file_name. The output must have been closed:
+    with deferred_chunks_lock:
+        copies = deferred_chunks.pop(os.path.abspath(file_name), [])
+    if len(copies) == 0:
+        return
+    sources = dict()
+    try:
+        with h5py.File(file_name, 'r+') as dest_file:
+            for source_file_name, source_path, dest_path, offsets in copies:
+                if not source_file_name in sources:
+                    sources[source_file_name] = h5py.File(source_file_name, 'r')
+                source_ds = sources[source_file_name][source_path]
+                dest_ds = dest_file[dest_path]
+                #netCDF4 only extends variables along unlimited dimensions when they are written:
+                dest_shape = tuple([ max(dest_length, offset + length) for dest_length, length, offset
+                                     in zip(dest_ds.shape, source_ds.shape, offsets) ])
+                if dest_shape != dest_ds.shape:
+                    dest_ds.resize(dest_shape)
+                if not _copy_direct_chunks(source_ds, dest_ds, offsets):
+                    #The stored chunks cannot be reused. Copy the stored values:
+                    for block in copy_blocks(source_ds.shape, source_ds.chunks, source_ds.dtype.itemsize):
+                        dest_ds[tuple([ slice(block_slice.start + offset, block_slice.stop + offset, 1)
+                                        for block_slice, offset in zip(block, offsets) ])] = source_ds[block]
+    finally:
+        for source_file in sources.values():
+            source_file.close()
+    return
+
+def _defer_direct_chunks(source, dest, offsets):
+    #Only defer copies that write exactly the values a copy through numpy would write:
+    dest_file_name = _hdf5_file_name(dest)
+    with deferred_chunks_lock:
+        if not dest_file_name in deferred_chunks:
+            return False
+    source_file_name = _hdf5_file_name(source)
+    if '_h5ds' in dir(source):
+        source_chunks = source._h5ds.chunks
     else:
-        combined_slices[first_dim] = first_dim_slice
-                
-    getitem_tuple = tuple([ combined_slices[var_dim] if var_dim in combined_slices.keys()
-                            else slice(None,None,1) for var_dim in
-                            dataset.variables[var_name].dimensions ])
-
-    temp = dataset.variables[var_name][getitem_tuple]
-    assign_not_masked(temp, output.variables[var_name], [first_dim_slice, Ellipsis], check_empty)
-    return output
+        source_chunks = source.chunking()
+        if source.filters() != dest.filters():
+            return False
+    dest_chunks = dest.chunking()
+    if ( source_file_name is None or
+         source_chunks in [None, 'contiguous'] or
+         dest_chunks in [None, 'contiguous'] or
+         list(source_chunks) != list(dest_chunks) or
+         not isinstance(source.dtype, np.dtype) or
+         not source.dtype.kind in 'biuf' or
+         source.dtype != dest.dtype or
+         not np.array_equal(_fill_value(source), _fill_value(dest)) or
+         dest.name in dest.dimensions or
+         #Masked or scaled values would be changed by a copy through numpy:
+         len(set(['scale_factor', 'add_offset', 'missing_value',
+                  'valid_min', 'valid_max', 'valid_range']).intersection(list(source.ncattrs()) +
+                                                                         list(dest.ncattrs()))) > 0 or
+         not _chunks_aligned(source.shape, dest.shape, source_chunks, offsets) ):
+        return False
+    with deferred_chunks_lock:
+        if not dest_file_name in deferred_chunks:
+            return False
+        deferred_chunks[dest_file_name].append((source_file_name, _hdf5_path(source),
+                                                _hdf5_path(dest), tuple([ int(offset) for offset in offsets ])))
+    return True
+
+def _hdf5_file_name(variable):
+    #Name of the HDF5 file holding the variable, None if it is not in an HDF5 file:
+    if '_h5ds' in dir(variable):
+        return os.path.abspath(variable._h5ds.file.filename)
+    elif isinstance(variable, netCDF4.Variable):
+        root = variable.group()
+        while root.parent is not None:
+            root = root.parent
+        if root.data_model in ['NETCDF4', 'NETCDF4_CLASSIC']:
+            return os.path.abspath(root.filepath())
+    return None
+
+def _hdf5_path(variable):
+    if '_h5ds' in dir(variable):
+        return variable._h5ds.name
+    return variable.group().path.rstrip('/') + '/' + variable.name
+
+def _fill_value(variable):
+    if '_FillValue' in variable.ncattrs():
+        return variable.getncattr('_FillValue')
+    elif '_h5ds' in dir(variable):
+        return variable._h5ds.fillvalue
+    return netCDF4.default_fillvals.get(variable.dtype.str[1:])
+
+def _read_direct_chunk(h5ds, chunk_offset):
+    #h5py 2.10 under python 2 returns the representation of the chunk buffer instead of its bytes.
+    #Read the chunk with the HDF5 library h5py is linked against. Returns None for unallocated chunks:
+    offset = (ctypes.c_uint64 * len(chunk_offset))(*chunk_offset)
+    storage_size = ctypes.c_uint64(0)
+    if ( h5lib.H5Dget_chunk_storage_size(ctypes.c_int64(h5ds.id.id), offset, ctypes.byref(storage_size)) < 0 or
+         storage_size.value == 0 ):
+        return None, None
+    chunk_data = ctypes.create_string_buffer(storage_size.value)
+    filter_mask = ctypes.c_uint32(0)
+    if h5lib.H5Dread_chunk(ctypes.c_int64(h5ds.id.id), ctypes.c_int64(0), offset, ctypes.byref(filter_mask), chunk_data) < 0:
+        raise RuntimeError('Could not read chunk at '+str(chunk_offset))
+    return filter_mask.value, chunk_data.raw
+
+def _filters_pipeline(h5ds):
+    create_plist = h5ds.id.get_create_plist()
+    return [ create_plist.get_filter(filter_id) for filter_id in range(create_plist.get_nfilters()) ]
+
+copy_memory_budget = 450.0 #maximum memory used when copying a variable, in Mb
+copy_threads = False #read the next block in a separate thread while the current block is written
+
+def _chunking(dataset, var_name, num_dims):
+    #Chunk shape of the first num_dims dimensions. Contiguous variables have no chunks to align with:
+    chunking = dataset.variables[var_name].chunking()
+    if chunking == 'contiguous' or chunking is None:
+        return [1 for dim_id in range(num_dims)]
+    return list(chunking)[:num_dims]
+
+def copy_alignment(source_chunks, dest_chunks):
+    #Blocks that are multiples of both chunk shapes are read from whole source chunks
+    #and written to whole destination chunks:
+    return [ int(np.lcm(source_chunk, dest_chunk)) for source_chunk, dest_chunk in zip(source_chunks, dest_chunks) ]
+
+def copy_blocks(shape, alignment, bytes_per_element):
+    #Split shape in blocks that fit copy_memory_budget. Outer dimensions are split first
+    #and blocks fall on the alignment grid whenever it fits in the budget:
+    memory_budget = copy_memory_budget*1024*1024
+    if copy_threads:
+        #One block is read while another waits and a third one is written:
+        memory_budget /= 3.0
+    block_shape = list(shape)
+    for dim_id in range(len(shape)):
+        inner_size = bytes_per_element*int(np.prod(block_shape[dim_id+1:]))
+        steps = max(int(memory_budget // inner_size), 1)
+        if steps >= shape[dim_id]:
+            break
+        if steps >= alignment[dim_id]:
+            steps -= steps % alignment[dim_id]
+        block_shape[dim_id] = steps
+        if inner_size <= memory_budget:
+            break
+    return product(*[ [ slice(start, min(start + block_length, length), 1) for start in range(0, length, block_length) ]
+                      for length, block_length in zip(shape, block_shape) ])
+
+#The netCDF4 and HDF5 libraries are not thread-safe:
+library_lock = threading.Lock()
+
+def _uses_library(dataset):
+    return isinstance(dataset, (netCDF4.Dataset, netCDF4_h5.Group))
+
+def copy_in_blocks(read_block, write_block, blocks, lock_reads=True):
+    if not copy_threads:
+        for block in blocks:
+            write_block(block, read_block(block))
+        return
+
+    #Reading the next block overlaps with writing the current one. Local reads share
+    #the library lock with writes so only remote reads truly overlap:
+    read_queue = Queue.Queue(maxsize=1)
+    stop = threading.Event()
+    def reader():
+        try:
+            for block in blocks:
+                if stop.is_set():
+                    return
+                if lock_reads:
+                    with library_lock:
+                        temp = read_block(block)
+                else:
+                    temp = read_block(block)
+                read_queue.put((block, temp))
+            read_queue.put((None, None))
+        except Exception:
+            read_queue.put((None, sys.exc_info()))
+        return
+    reader_thread = threading.Thread(target=reader)
+    reader_thread.daemon = True
+    reader_thread.start()
+    try:
+        while True:
+            block, temp = read_queue.get()
+            if block is None:
+                break
+            with library_lock:
+                write_block(block, temp)
+    finally:
+        #Unblock the reader if writing failed:
+        stop.set()
+        while reader_thread.is_alive():
+            try:
+                read_queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+    if temp is not None:
+        raise temp[0], temp[1], temp[2]
+    return
 
 def replicate_group(dataset, output, group_name, default=False):
     if default: return output
@@ -599,27 +1052,29 @@ def replicate_netcdf_var(dataset,output,var,
         var_shape=tuple([dataset.variables[var].shape[dim_id] if not dim in slices.keys()
                                                else len(np.arange(dataset.variables[var].shape[dim_id])[slices[dim]])
                                                for dim_id,dim in enumerate(dimensions)])
-        if chunksize==-1:
-            chunksizes=tuple([1 if dim==time_dim else var_shape[dim_id] for dim_id,dim in enumerate(dimensions)])
-        elif dataset.variables[var].chunking()=='contiguous':
-            if kwargs['zlib']:
-                chunksizes=tuple([1 if dim==time_dim else var_shape[dim_id] for dim_id,dim in enumerate(dimensions)])
-            else:
-                chunksizes=tuple([1 for dim_id,dim in enumerate(dimensions)])
+        if ( chunksize==-1 or
+             dataset.variables[var].chunking()=='contiguous' or
+             len(set(dimensions).intersection(slices.keys()))>0 ):
+            chunksizes=record_chunksizes(dimensions,var_shape,time_dim,
+                                         indices_utils.bytes_per_element(dataset.variables[var]))
         else:
-            if len(set(dimensions).intersection(slices.keys()))>0:
-                if kwargs['zlib']:
-                    chunksizes=tuple([1 if dim==time_dim else var_shape[dim_id] for dim_id,dim in enumerate(dimensions)])
-                else:
-                    chunksizes=tuple([1 for dim_id,dim in enumerate(dimensions)])
-            else:
-                chunksizes=dataset.variables[var].chunking()
+            chunksizes=dataset.variables[var].chunking()
         kwargs['chunksizes']=chunksizes
         out_var=output.createVariable(var,datatype,dimensions,**kwargs)
     output = replicate_netcdf_var_att(dataset,output,var)
     return output
     #return out_var
 
+def record_chunksizes(dimensions,var_shape,time_dim,bytes_per_element,max_chunk_size=4.0):
+    #One time step per chunk and whole extents along the other dimensions, halved
+    #until a chunk fits in max_chunk_size Mb. Time steps are then written to whole chunks:
+    chunksizes=[1 if dim==time_dim else max(var_shape[dim_id],1) for dim_id,dim in enumerate(dimensions)]
+    for dim_id in range(len(dimensions)):
+        while (bytes_per_element*np.prod(chunksizes)>max_chunk_size*1024*1024 and
+               chunksizes[dim_id]>1):
+            chunksizes[dim_id]=int(np.ceil(chunksizes[dim_id]/2.0))
+    return tuple(chunksizes)
+
 def _toscalar(x):
     try:
         return np.asscalar(x)
@@ -719,6 +1174,24 @@ def find_dimension_type(dataset, time_var='time', default=False):
             dimension_type[dim] = _dim_len(dataset,dim)
     return dimension_type
 
+def get_file_metadata(dataset, time_var='time', default=False):
+    #Retrieve in one access all the metadata needed to validate a file:
+    metadata = {'calendar': netcdf_calendar(dataset, time_var=time_var, default=default),
+                'units': netcdf_time_units(dataset, time_var=time_var, default=True),
+                'time_axis': np.array([]),
+                'time_attributes': dict(),
+                'dimension_type': find_dimension_type(dataset, time_var=time_var, default=default),
+                'variables': []}
+    if default: return metadata
+
+    metadata['variables'] = list(dataset.variables.keys())
+    if find_time_var(dataset, time_var=time_var) is not None:
+        metadata['units'] = netcdf_time_units(dataset, time_var=time_var)
+    time_dim = find_time_dim(dataset, time_var=time_var)
+    if time_dim is not None:
+        metadata['time_axis'], metadata['time_attributes'] = retrieve_dimension(dataset, time_dim)
+    return metadata
+
 def netcdf_time_units(dataset, time_var='time', default=False):
     units = None
     if default: return units
@@ -750,7 +1223,7 @@ def retrieve_dimension_list(dataset, var, default=False):
     if default: return dimensions
     return dataset.variables[var].dimensions
 
-def retrieve_dimensions_no_time(dataset, var, time_var='time', default=False):
+def retrieve_dimensions_no_time(dataset, var, time_var='time', signature=None, default=False):
     dimensions_data = dict()
     attributes = dict()
     if default: return dimensions_data, attributes
@@ -758,9 +1231,47 @@ def retrieve_dimensions_no_time(dataset, var, time_var='time', default=False):
     time_dim = find_time_name_from_list(dimensions, time_var)
     for dim in dimensions:
         if dim != time_dim:
-            dimensions_data[dim], attributes[dim] = retrieve_dimension(dataset, dim)
+            if signature is None:
+                dimensions_data[dim], attributes[dim] = retrieve_dimension(dataset, dim)
+            else:
+                dimensions_data[dim], attributes[dim] = retrieve_dimension_cached(dataset, dim,
+                                                                signature + (tuple(dataset.variables[var].shape), tuple(dimensions)))
     return dimensions_data, attributes
 
+#Cache of coordinate variables, shared by the files on the same grid and by retrieval threads:
+dimensions_cache = OrderedDict()
+dimensions_cache_size = 128
+dimensions_cache_lock = threading.Lock()
+
+def retrieve_dimension_cached(dataset, dimension, signature, default=False):
+    if default: return retrieve_dimension(dataset, dimension, default=True)
+    length = _dim_len(dataset, dimension)
+    if ( not dimension in dataset.variables.keys() or
+         length <= 2 ):
+        #Nothing to gain from the cache:
+        return retrieve_dimension(dataset, dimension)
+
+    attributes = dict()
+    for att in dataset.variables[dimension].ncattrs():
+        attributes[att] = getncattr(dataset.variables[dimension], att)
+    #Retrieve the first and last values in a single request:
+    edges = np.asarray(dataset.variables[dimension][0::length-1])
+    key = signature + (dimension, length, str(edges.dtype), tuple(edges.tolist()),
+                       tuple(sorted([(att, str(attributes[att])) for att in attributes.keys()])))
+    with dimensions_cache_lock:
+        dimension_dataset = dimensions_cache.pop(key, None)
+        if dimension_dataset is not None:
+            dimensions_cache[key] = dimension_dataset
+    if dimension_dataset is None:
+        #Retrieve outside the lock:
+        dimension_dataset, attributes = retrieve_dimension(dataset, dimension)
+        with dimensions_cache_lock:
+            dimensions_cache.pop(key, None)
+            if len(dimensions_cache) >= dimensions_cache_size:
+                dimensions_cache.popitem(last=False)
+            dimensions_cache[key] = dimension_dataset
+    return copy.copy(dimension_dataset), attributes
+
 def retrieve_variables(dataset, output, zlib=True, default=False):
     if default: return output
     for var_name in dataset.variables.keys():
@@ -791,8 +1302,7 @@ def create_date_axis_from_time_axis(time_axis, attributes_dict, default=False):
         calendar = attributes_dict['calendar']
 
     if units == 'day as %Y%m%d.%f':
-        date_axis = np.array(map(convert_to_date_absolute,
-                                 native_time_axis))
+        date_axis = get_date_axis_absolute(time_axis)
     else:
         try:
             #Put cmip5_rewrite_time_axis here:
@@ -803,9 +1313,15 @@ def create_date_axis_from_time_axis(time_axis, attributes_dict, default=False):
 
 def retrieve_container(dataset, var, dimensions, unsort_dimensions,
                        sort_table, max_request, time_var='time',
-                       file_name='', default=False):
+                       file_name='', waste_ratio=0.5, default=False):
     if default: return np.array([])
-    remote_dimensions, attributes = retrieve_dimensions_no_time(dataset, var, time_var=time_var)
+    if len(file_name) > 4 and file_name[:4] == 'http':
+        #Remote coordinates are cached for each data node:
+        signature = ('/'.join(file_name.split('/')[:3]),)
+    else:
+        signature = None
+    remote_dimensions, attributes = retrieve_dimensions_no_time(dataset, var, time_var=time_var,
+                                                                signature=signature)
 
     indices = copy.copy(dimensions)
     unsort_indices = copy.copy(unsort_dimensions)
@@ -813,11 +1329,27 @@ def retrieve_container(dataset, var, dimensions, unsort_dimensions,
         indices[dim], unsort_indices[dim] = indices_utils.prepare_indices(
                                             indices_utils.get_indices_from_dim(remote_dimensions[dim],
                                                                                indices[dim]))
-    return grab_indices(dataset, var, indices, unsort_indices, max_request, file_name=file_name)
+    return grab_indices(dataset, var, indices, unsort_indices, max_request, file_name=file_name,
+                        waste_ratio=waste_ratio)
+
+def retrieve_container_batch(dataset, var_list, dimensions_list, unsort_dimensions_list,
+                             sort_table_list, max_request, time_var='time',
+                             file_name='', waste_ratio_list=None, default=False):
+    #Retrieve several variables from the same dataset:
+    if waste_ratio_list is None:
+        waste_ratio_list = [ 0.5 for var in var_list ]
+    return [ retrieve_container(dataset, var, dimensions, unsort_dimensions,
+                                sort_table, max_request, time_var=time_var,
+                                file_name=file_name, waste_ratio=waste_ratio, default=default)
+             for var, dimensions, unsort_dimensions, sort_table, waste_ratio
+             in zip(var_list, dimensions_list, unsort_dimensions_list, sort_table_list, waste_ratio_list) ]
 
 def grab_indices(dataset, var, indices, unsort_indices, max_request,
-                 file_name='', default=False):
+                 file_name='', waste_ratio=0.5, default=False):
     if default: return np.array([])
     dimensions = retrieve_dimension_list(dataset,var)
+    #Merge scattered slices into bounding hyperslabs:
+    indices, unsort_indices = indices_utils.coalesce_indices(indices, unsort_indices, dimensions,
+                                                             waste_ratio=waste_ratio)
     return indices_utils.retrieve_slice(dataset.variables[var], indices, unsort_indices,
                                         dimensions[0], dimensions[1:], 0, max_request)
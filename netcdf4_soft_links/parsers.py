@@ -59,6 +59,7 @@ def subset(subparsers,epilog,project_drs):
     parser.add_argument('--output_vertices',action='store_true',help='Compute and output vertices')
     input_arguments(parser)
     output_arguments(parser)
+    copy_arguments(parser,project_drs)
     return
 
 def validate(subparsers,epilog,project_drs):
@@ -85,7 +86,22 @@ def validate_arguments(parser,project_drs):
                      help='Type of files.')
     parser.add_argument('--time_var',default='time',
                      help='The time variable in the files. Default: time.')
+    parser.add_argument('--num_validate_workers',default=1,type=int,
+                     help='Number of files from which time axes are retrieved simultaneously.\n\
+                           Simultaneous accesses to EACH data node remain limited. Default=1.')
+    metadata_cache_arguments(parser,project_drs)
+    return
 
+def metadata_cache_arguments(parser,project_drs):
+    cache_group = parser.add_argument_group('Cache the metadata of files with a checksum or a tracking_id')
+    cache_group.add_argument('--metadata_cache',default=None,
+                     help='Directory where the calendar, time units and time axis of validated files are cached.\n\
+                           Files that were validated before are then not opened again.')
+    cache_group.add_argument('--metadata_cache_expire_after',default=30.0,type=float,
+                     help='Age (in days) after which cached metadata is discarded. Default: 30.')
+    cache_group.add_argument('--metadata_cache_max_size',default=100.0,type=float,
+                     help='Maximum size (in Mb) of the metadata cache. Least recently used metadata\n\
+                           is discarded first. Default: 100.')
     return
 
 def download_files(subparsers,epilog,project_drs):
@@ -104,6 +120,7 @@ def download_files_arguments(parser,project_drs):
     output_arguments(parser)
     download_files_arguments_no_io(parser,project_drs)
     download_arguments_no_io(parser,project_drs)
+    copy_arguments(parser,project_drs)
     serial_arguments(parser,project_drs)
     certificates_arguments(parser,project_drs)
     data_node_restriction(parser,project_drs)
@@ -127,6 +144,7 @@ def download_opendap_arguments(parser,project_drs):
     output_arguments(parser)
     download_opendap_arguments_no_io(parser,project_drs)
     download_arguments_no_io(parser,project_drs)
+    copy_arguments(parser,project_drs)
     serial_arguments(parser,project_drs)
     certificates_arguments(parser,project_drs)
     data_node_restriction(parser,project_drs)
@@ -158,8 +176,28 @@ def download_files_arguments_no_io(parser,project_drs):
 def download_arguments_no_io(parser,project_drs):
     parser.add_argument('--download_cache',help='Cache file for downloads')
     parser.add_argument('--num_dl',default=1,type=int,help='Number of simultaneous download from EACH data node. Default=1.')
+    parser.add_argument('--queues_backend',default='manager',choices=['manager','native'],
+                        help='Queues used to dispatch downloads. \'native\' uses pipes and shared memory\n\
+                              instead of a manager process and scales better with a large --num_dl. Default=manager.')
+    parser.add_argument('--engine',default='processes',choices=['processes','threads'],
+                        help='Retrieval engine. \'processes\' starts --num_dl processes for EACH data node.\n\
+                              \'threads\' multiplexes the retrievals from all data nodes in a single process,\n\
+                              with at most --num_dl simultaneous retrievals from EACH data node. Default=processes.')
+    parser.add_argument('--waste_ratio',default=0.5,type=float,
+                        help='Maximum fraction of unneeded elements read when nearby indices are merged into a\n\
+                              single remote request. 0 retrieves exactly the requested slices. Default=0.5.')
     return parser
 
+def copy_arguments(parser,project_drs):
+    copy_group = parser.add_argument_group('Copy of variables into the output file')
+    copy_group.add_argument('--copy_memory_budget',default=450.0,type=float,
+                     help='Maximum memory (in Mb) used when copying a variable. Variables are copied in blocks\n\
+                           aligned with the chunks of the source and output files. Default: 450.')
+    copy_group.add_argument('--copy_threads',default=False,action='store_true',
+                     help='Read the next block in a separate thread while the current block is written,\n\
+                           so that decompression and compression overlap with I/O.')
+    return
+
 def serial_arguments(parser,project_drs):
     parser.add_argument('--serial',default=False,action='store_true',help='Force serial analysis.')
     return parser
@@ -176,6 +214,7 @@ def load(subparsers,epilog,project_drs):
     output_arguments(parser)
     verbosity_group = parser.add_argument_group('Specify verbosity in downloads')
     verbosity_group.add_argument('-s','--silent',default=False,action='store_true',help='Make downloads silent.')
+    copy_arguments(parser,project_drs)
     certificates_arguments(parser,project_drs)
     time_selection_arguments(parser,project_drs)
     return parser
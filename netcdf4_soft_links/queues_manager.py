@@ -1,7 +1,9 @@
 #External:
 import multiprocessing
 import numpy as np
-import Queue
+import os
+import time
+import tempfile
 import requests
 import requests_cache
 
@@ -41,12 +43,41 @@ class Shared_Counter(object):
     def value_no_lock(self):
         return self.val.value
 
+class Native_manager:
+    #Provides the same interface as a multiprocessing.Manager but creates native
+    #multiprocessing objects (pipes and shared memory) that are inherited by
+    #the download processes. Only the data node dictionaries, that are
+    #rarely accessed, are kept in the manager process.
+    def __init__(self,manager):
+        self.manager=manager
+
+    def Value(self,*args):
+        return multiprocessing.Value(*args)
+
+    def Lock(self):
+        return multiprocessing.Lock()
+
+    def Semaphore(self,value=1):
+        return multiprocessing.Semaphore(value)
+
+    def Queue(self):
+        return multiprocessing.Queue()
+
+    def Event(self):
+        return multiprocessing.Event()
+
+    def dict(self):
+        return self.manager.dict()
+
 class Semaphores_data_node:
     #Shared semaphores class
     def __init__(self,manager,n=20,num_concurrent=1):
         self.dict = manager.dict()
         self.lock = manager.Lock()
         self.list = [manager.Semaphore(num_concurrent) for id in range(n)]
+        #Local copy of the data node indices. Indices never change once
+        #they are attributed:
+        self.local_dict = dict()
 
     def add_new_data_node(self,data_node): 
         #Add a pointer to a semaphore:
@@ -58,14 +89,158 @@ class Semaphores_data_node:
                     self.dict[data_node]=0
         return
 
+    def index(self,data_node):
+        if not data_node in self.local_dict.keys():
+            self.local_dict[data_node]=self.dict[data_node]
+        return self.local_dict[data_node]
+
     def __getitem__(self,data_node):
         #Just send the semaphore object:
-        return self.list[self.dict[data_node]]
+        return self.list[self.index(data_node)]
 
     def keys(self):
         #Just send the semaphore object:
         return self.dict.keys()
 
+class Request_sizes_data_node:
+    #Shared maximum request sizes (in Mb) for each data node.
+    #Sizes are adapted with an additive increase, multiplicative decrease rule:
+    def __init__(self,manager,initial=450.0,minimum=10.0,maximum=2048.0,increase=50.0,decrease=0.5):
+        self.dict = manager.dict()
+        self.throughput = manager.dict()
+        self.lock = manager.Lock()
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+
+    def __getitem__(self,data_node):
+        return self.dict.get(data_node,self.initial)
+
+    def success(self,data_node,max_request,requests_list):
+        #requests_list holds (size in Mb, elapsed time in seconds, split) for every request
+        #of the retrieval (see indices_utils.stop_request_log):
+        if len(requests_list) == 0:
+            return
+        size = sum([request[0] for request in requests_list])
+        elapsed_time = sum([request[1] for request in requests_list])
+        throughput = size/max(elapsed_time,1e-3)
+        with self.lock:
+            previous_throughput = self.throughput.get(data_node,0.0)
+            if any([request[2] for request in requests_list]):
+                #The retrieval had to be split in several requests:
+                if throughput >= 0.5*previous_throughput:
+                    self.dict[data_node] = min(self.maximum,max_request+self.increase)
+                else:
+                    #Large requests slow down this data node:
+                    self.dict[data_node] = max(self.minimum,max_request*self.decrease)
+            elif not data_node in self.dict.keys():
+                self.dict[data_node] = max_request
+            #Exponential moving average of throughput:
+            if previous_throughput>0:
+                throughput = 0.8*previous_throughput + 0.2*throughput
+            self.throughput[data_node] = throughput
+        return
+
+    def failure(self,data_node,max_request):
+        #Only call for errors that smaller requests might avoid (see retrieval_manager.is_size_error):
+        with self.lock:
+            self.dict[data_node] = max(self.minimum,max_request*self.decrease)
+        return
+
+    def keys(self):
+        return self.dict.keys()
+
+class Health_data_node:
+    #Shared health of data nodes: response time and error rate (exponential moving averages)
+    #and time of the last success. The circuit of a data node opens after max_failures
+    #consecutive failures. Requests to that data node are then refused until cooldown seconds
+    #have passed, after which a single request is let through to test it again.
+    #The data node is considered dead once max_probes of these tests have failed:
+    def __init__(self,manager,max_failures=3,cooldown=120.0,smoothing=0.2,max_probes=2):
+        self.dict = manager.dict()
+        self.lock = manager.Lock()
+        self.max_failures = max_failures
+        self.max_probes = max_probes
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+
+    def __getitem__(self,data_node):
+        return self.dict.get(data_node,{'response_time':None,
+                                        'error_rate':0.0,
+                                        'last_success':None,
+                                        'failures':0,
+                                        'opened':None})
+
+    def success(self,data_node,elapsed_time):
+        with self.lock:
+            health = self[data_node]
+            if health['response_time'] is None:
+                health['response_time'] = elapsed_time
+            else:
+                health['response_time'] = ((1.0-self.smoothing)*health['response_time'] +
+                                                 self.smoothing*elapsed_time)
+            health['error_rate'] = (1.0-self.smoothing)*health['error_rate']
+            health['last_success'] = time.time()
+            health['failures'] = 0
+            health['opened'] = None
+            self.dict[data_node] = health
+        return
+
+    def failure(self,data_node):
+        with self.lock:
+            health = self[data_node]
+            health['error_rate'] = (1.0-self.smoothing)*health['error_rate'] + self.smoothing
+            health['failures'] += 1
+            if health['failures'] >= self.max_failures:
+                #Open the circuit, or keep it open if the test request failed:
+                health['opened'] = time.time()
+            self.dict[data_node] = health
+        return
+
+    def is_open(self,data_node):
+        opened = self[data_node]['opened']
+        return opened is not None and time.time()-opened < self.cooldown
+
+    def cooldown_left(self,data_node):
+        #Seconds before a request to the data node can be let through:
+        opened = self[data_node]['opened']
+        if opened is None:
+            return 0.0
+        return max(0.0,self.cooldown-(time.time()-opened))
+
+    def is_dead(self,data_node):
+        return self[data_node]['failures'] >= self.max_failures + self.max_probes
+
+    def allow(self,data_node):
+        #Once cooldown has passed, only the first caller is let through:
+        if not self.is_open(data_node):
+            if self[data_node]['opened'] is None:
+                return True
+            with self.lock:
+                health = self[data_node]
+                if health['opened'] is None:
+                    return True
+                elif time.time()-health['opened'] >= self.cooldown:
+                    health['opened'] = time.time()
+                    self.dict[data_node] = health
+                    return True
+        return False
+
+    def score(self,data_node):
+        #Data nodes with the lowest scores are preferred. Data nodes without recorded
+        #response time come after the fast and healthy ones:
+        health = self[data_node]
+        if health['response_time'] is None:
+            response_time = float('inf')
+        else:
+            response_time = health['response_time']
+        return (self.is_open(data_node), round(health['error_rate'],1), response_time)
+
+    def keys(self):
+        return self.dict.keys()
+
 class Queues_data_node:
     #Shared queues class
     def __init__(self,manager,n=20):
@@ -73,6 +248,9 @@ class Queues_data_node:
         self.lock = manager.Lock()
         self.list = [manager.Queue() for id in range(n)]
         self.list_expected = [Shared_Counter(manager) for id in range(n)]
+        #Local copy of the data node indices. Indices never change once
+        #they are attributed:
+        self.local_dict = dict()
 
     def add_new_data_node(self,data_node): 
         #Add a pointer to a queue:
@@ -84,22 +262,29 @@ class Queues_data_node:
                     self.dict[data_node]=0
         return
 
+    def index(self,data_node):
+        if not data_node in self.local_dict.keys():
+            self.local_dict[data_node]=self.dict[data_node]
+        return self.local_dict[data_node]
+
     def put(self,data_node,item):
         #Just put the item in the queue and increment the counter:
-        with self.list_expected[self.dict[data_node]].lock:
-            self.list[self.dict[data_node]].put(item)
-            self.list_expected[self.dict[data_node]].increment_no_lock()
+        index=self.index(data_node)
+        with self.list_expected[index].lock:
+            self.list[index].put(item)
+            self.list_expected[index].increment_no_lock()
         return 
 
     def get(self,data_node):
         #Just send the queue object:
-        item=self.list[self.dict[data_node]].get()
+        index=self.index(data_node)
+        item=self.list[index].get()
         #Decrement after, in case there is an error in the get command:
-        self.list_expected[self.dict[data_node]].decrement()
+        self.list_expected[index].decrement()
         return item
 
     def qsize(self,data_node):
-        return self.list_expected[self.dict[data_node]].value
+        return self.list_expected[self.index(data_node)].value
 
     def keys(self):
         return self.dict.keys()
@@ -111,15 +296,20 @@ class NC4SL_queues_manager:
         else:
             self.manager=manager
 
-        #Shared sessions among downloads. Appears tricky to use...
-        #self.session=requests_sessions.create_single_session(**remote_netcdf_kwargs)
-        ##Set the pool size to number of downloads:
-        #adapter = requests.adapters.HTTPAdapter(pool_connections=20, pool_maxsize=options.num_dl)
-        #self.session.mount('http://',adapter)
-        #self.session.mount('https://',adapter)
+        if 'queues_backend' in dir(options) and options.queues_backend=='native':
+            #Queues, counters and semaphores bypass the manager process:
+            self.manager=Native_manager(self.manager)
+            self.shared_memory=True
+        else:
+            self.shared_memory=False
+
+        #Sessions are not shared among download processes. Pooled sessions are
+        #created by the workers (see retrieval_manager).
 
         self.semaphores=Semaphores_data_node(self.manager,num_concurrent=options.num_dl)
         self.queues=Queues_data_node(self.manager)
+        self.request_sizes=Request_sizes_data_node(self.manager)
+        self.health=Health_data_node(self.manager)
         #Create gather download_queues:
         for proc_id in processes_names:
             thread_id='download_'+proc_id
@@ -151,6 +341,8 @@ class NC4SL_queues_manager:
         thread_id='download_'+multiprocessing.current_process().name
         #thread_id='download_'+process_name
         getattr(self,thread_id+'_closed').set()
+        #Wake up the consumer. From now on, it knows how many results it should expect:
+        getattr(self,thread_id).put('CLOSED')
         return
 
     def set_opened(self):
@@ -160,21 +352,113 @@ class NC4SL_queues_manager:
         return
 
     def put_for_thread_id(self,thread_id,item):
+        if self.shared_memory:
+            item=to_shared_memory(item)
         getattr(self,thread_id).put(item)
         return
 
     def get_for_thread_id(self):
-        timeout=0.1
         thread_id='download_'+multiprocessing.current_process().name
         #thread_id='download_'+process_name
-        while not (getattr(self,thread_id+'_closed').is_set() 
-                   and getattr(self,thread_id+'_expected').value==0):
-            try:
-                with getattr(self,thread_id+'_expected').lock:
-                    item = getattr(self,thread_id).get(True,timeout)
-                    #Decrement expected counter
-                    getattr(self,thread_id+'_expected').decrement_no_lock()
+        #Results consumed and results remaining are tracked locally
+        #so that the only shared call per result is the blocking get:
+        if not 'consumed' in dir(self):
+            self.consumed=dict()
+            self.remaining=dict()
+        if not thread_id in self.consumed.keys():
+            self.consumed[thread_id]=0
+            self.remaining[thread_id]=None
+
+        while True:
+            if self.remaining[thread_id]==0:
+                #Workers split failed items after 'CLOSED' was received. Their results are expected too.
+                #An item is only split before it returns a result, so no split can follow once all
+                #expected results were consumed:
+                self.remaining[thread_id]=(getattr(self,thread_id+'_expected').value
+                                           -self.consumed[thread_id])
+                if self.remaining[thread_id]==0:
+                    break
+            item = getattr(self,thread_id).get()
+            if isinstance(item,str) and item=='CLOSED':
+                #Ignore stale signals from a previous retrieval:
+                if ( self.remaining[thread_id]==None and
+                     getattr(self,thread_id+'_closed').is_set()):
+                    self.remaining[thread_id]=(getattr(self,thread_id+'_expected').value
+                                               -self.consumed[thread_id])
+            else:
+                self.consumed[thread_id]+=1
+                if self.remaining[thread_id]!=None:
+                    self.remaining[thread_id]-=1
+                if self.shared_memory:
+                    item=from_shared_memory(item)
                 return item
-            except Queue.Empty:
-                pass
+
+        #Decrement expected counter once all results have been consumed:
+        getattr(self,thread_id+'_expected').decrement(self.consumed[thread_id])
+        del self.consumed[thread_id]
+        del self.remaining[thread_id]
         return 'STOP'
+
+class shared_array:
+    #Placeholder for an array that was written to shared memory:
+    def __init__(self,array,dir=None):
+        if dir==None:
+            dir=shared_memory_dir()
+        self.dtype=array.dtype
+        self.shape=array.shape
+        if isinstance(array,np.ma.core.MaskedArray):
+            self.fill_value=array.fill_value
+            mask=np.ma.getmask(array)
+            if mask is np.ma.nomask:
+                self.mask=mask
+            else:
+                self.mask=np.packbits(mask)
+            array=array.data
+        else:
+            self.fill_value=None
+        file_descriptor, self.file_name=tempfile.mkstemp(prefix='nc4sl_',dir=dir)
+        with os.fdopen(file_descriptor,'wb') as file_handle:
+            np.ascontiguousarray(array).tofile(file_handle)
+        return
+
+    def load(self):
+        try:
+            array=np.fromfile(self.file_name,dtype=self.dtype).reshape(self.shape)
+        finally:
+            os.remove(self.file_name)
+        if self.fill_value is None:
+            return array
+        if self.mask is np.ma.nomask:
+            mask=self.mask
+        else:
+            mask=np.unpackbits(self.mask)[:array.size].reshape(self.shape).astype(np.bool)
+        return np.ma.array(array,mask=mask,fill_value=self.fill_value)
+
+def shared_memory_dir():
+    #Use the shared memory filesystem when it is available:
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm',os.W_OK):
+        return '/dev/shm'
+    else:
+        return tempfile.gettempdir()
+
+def to_shared_memory(item,min_size=2**20):
+    #Large arrays are written to shared memory so that only a
+    #small placeholder is pickled through the queue:
+    if isinstance(item,np.ndarray) and item.nbytes>=min_size and item.dtype.hasobject==False:
+        return shared_array(item)
+    elif isinstance(item,tuple):
+        return tuple([to_shared_memory(sub_item,min_size=min_size) for sub_item in item])
+    elif isinstance(item,list):
+        return [to_shared_memory(sub_item,min_size=min_size) for sub_item in item]
+    else:
+        return item
+
+def from_shared_memory(item):
+    if isinstance(item,shared_array):
+        return item.load()
+    elif isinstance(item,tuple):
+        return tuple([from_shared_memory(sub_item) for sub_item in item])
+    elif isinstance(item,list):
+        return [from_shared_memory(sub_item) for sub_item in item]
+    else:
+        return item
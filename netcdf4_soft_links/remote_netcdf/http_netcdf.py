@@ -23,9 +23,13 @@ class http_netCDF:
                                authentication_url=None,
                                username=None,
                                password=None,
-                               use_certificates=False):
+                               use_certificates=False,
+                               health=None):
         self.url=url
         self.semaphores=semaphores
+        self.remote_data_node=remote_data_node
+        #Shared health of data nodes (see queues_manager.Health_data_node):
+        self.health=health
         self.timeout=timeout
         self.cache=cache
         self.expire_after=expire_after
@@ -59,8 +63,15 @@ class http_netCDF:
         if len(self.url)>3 and self.url[:3]=='ftp':
             return True
         success=False
+        tried=False
         for trial in range(num_trials):
             if not success:
+                if ( self.health is not None and
+                     not self.health.allow(self.remote_data_node) ):
+                    #The data node is failing. Do not wait for it:
+                    break
+                tried=True
+                start_time=time.time()
                 try:
                     with Dataset(self.url,
                                  cache=self.cache,
@@ -73,6 +84,8 @@ class http_netCDF:
                                  use_certificates=self.use_certificates) as dataset:
                         pass
                     success=True
+                    if self.health is not None:
+                        self.health.success(self.remote_data_node,time.time()-start_time)
                 except requests.exceptions.ReadTimeout as e:
                     time.sleep(3*(trial+1))
                     pass
@@ -96,7 +109,11 @@ class http_netCDF:
                     pass
                 except RemoteEmptyError as e:
                     print(e)
+                    #The data node responded:
+                    tried=False
                     break
+        if not success and tried and self.health is not None:
+            self.health.failure(self.remote_data_node)
         return success
 
     def download(self,var,pointer_var,checksum='',checksum_type='MD5',out_dir='.',version='v1'):
@@ -5,7 +5,11 @@ import netcdf4_pydap
 
 import time
 import os
+import errno
 import datetime
+import threading
+import atexit
+from collections import OrderedDict
 from socket import error as SocketError
 import requests
 from urllib2 import HTTPError, URLError
@@ -27,10 +31,13 @@ class queryable_netCDF:
                  username=None,
                  password=None,
                  authentication_url=None,
-                 use_certificates=False):
+                 use_certificates=False,
+                 max_request=None,
+                 health=None):
         self.file_name=file_name
         self.semaphores=semaphores
         self.time_var=time_var
+        self.remote_data_node=remote_data_node
 
         if (remote_data_node in  self.semaphores.keys()):
             self.semaphore=semaphores[remote_data_node]
@@ -52,15 +59,17 @@ class queryable_netCDF:
             self.use_pydap=True
             self.max_request=450
             #self.use_h5=False
+            #Shared health of data nodes (see queues_manager.Health_data_node):
+            self.health=health
         else:
             self.use_pydap=False
             self.max_request=2048
-            try:
-                with netCDF4_h5.Dataset(self.file_name,'r') as dataset:
-                    pass
-                self.use_h5=True
-            except:
-                self.use_h5=False
+            self.use_h5=local_use_h5(self.file_name)
+            self.health=None
+
+        if max_request!=None:
+            #Maximum request (in Mb) adapted to the data node:
+            self.max_request=max_request
         return
 
     def __enter__(self):
@@ -76,23 +85,38 @@ class queryable_netCDF:
 
     def unsafe_handling(self,function_handle,*args,**kwargs):
         #Capture errors. Important to prevent curl errors from being printed:
+        return self.pooled_handling(self.timeout,function_handle,*args,**kwargs)
+
+    def pooled_handling(self,timeout,function_handle,*args,**kwargs):
+        #Datasets are kept open between calls and discarded if a call fails:
         if self.use_pydap:
-            with netcdf4_pydap.Dataset(self.file_name,cache=self.cache,
-                                       timeout=self.timeout,
-                                       expire_after=self.expire_after,
-                                       session=self.session,
-                                       authentication_url=self.authentication_url,
-                                       username=self.username,
-                                       password=self.password,
-                                       use_certificates=self.use_certificates) as dataset:
-                output=function_handle(dataset,*args,**kwargs)
-        elif self.use_h5:
-            with netCDF4_h5.Dataset(self.file_name,'r') as dataset:
-                output=function_handle(dataset,*args,**kwargs)
+            pool, key = remote_datasets, self.pydap_key()
+            dataset=remote_datasets.open(key,
+                                         lambda: netcdf4_pydap.Dataset(self.file_name,
+                                                                       cache=self.cache,
+                                                                       timeout=timeout,
+                                                                       expire_after=self.expire_after,
+                                                                       session=self.session,
+                                                                       authentication_url=self.authentication_url,
+                                                                       username=self.username,
+                                                                       password=self.password,
+                                                                       use_certificates=self.use_certificates))
         else:
-            with netCDF4.Dataset(self.file_name,'r') as dataset:
-                output=function_handle(dataset,*args,**kwargs)
-        return output
+            pool, key = local_datasets, self.file_name
+            dataset=open_local_dataset(self.file_name)
+        try:
+            result=function_handle(dataset,*args,**kwargs)
+        except:
+            #The open dataset might be left in an invalid state:
+            pool.release(key,dataset,discard=True)
+            raise
+        pool.release(key,dataset)
+        return result
+
+    def pydap_key(self):
+        #The session is kept alive by the pooled dataset, so its id cannot be reused:
+        return (self.file_name, self.cache, id(self.session), self.authentication_url,
+                self.username, self.password, self.use_certificates)
 
     def safe_handling(self,function_handle, *args, **kwargs):
         error_statement=' '.join('''
@@ -107,41 +131,39 @@ not available or out of date.'''.splitlines()).format(self.file_name.replace('do
         else:
             num_trials = 5
         success = False
+        tried = False
+        last_error = None
         timeout = copy.copy(self.timeout)
         for trial in range(num_trials):
             if not success:
+                if ( self.health is not None and
+                     not self.health.allow(self.remote_data_node) ):
+                    #The data node is failing. Do not wait for it:
+                    break
+                tried = True
+                start_time = time.time()
                 try:
                     #Capture errors. Important to prevent curl errors from being printed:
-                    if self.use_pydap:
-                        with netcdf4_pydap.Dataset(self.file_name,
-                                                   cache=self.cache,
-                                                   timeout=timeout,
-                                                   expire_after=self.expire_after,
-                                                   session=self.session,
-                                                   authentication_url=self.authentication_url,
-                                                   username=self.username,
-                                                   password=self.password,
-                                                   use_certificates=self.use_certificates) as dataset:
-                            try:
-                                output=function_handle(dataset,*args,**kwargs)
-                            except EOFError as e:
-                                #There is an issue with the remote file. Return default:
-                                output=function_handle(dataset,*args,default=True,**kwargs)
-                    elif self.use_h5:
-                        with netCDF4_h5.Dataset(self.file_name,'r') as dataset:
-                            output=function_handle(dataset,*args,**kwargs)
-                    else:
-                        with netCDF4.Dataset(self.file_name,'r') as dataset:
-                            output=function_handle(dataset,*args,**kwargs)
+                    try:
+                        output=self.pooled_handling(timeout,function_handle,*args,**kwargs)
+                    except EOFError as e:
+                        if not self.use_pydap:
+                            raise
+                        #There is an issue with the remote file. Return default:
+                        output=function_handle(None,*args,default=True,**kwargs)
                     success=True
+                    if self.health is not None:
+                        self.health.success(self.remote_data_node,time.time()-start_time)
                 except (HTTPError,
                         requests.exceptions.ReadTimeout) as e:
+                    last_error = e
                     time.sleep(3*(trial+1))
                     #Increase timeout:
                     timeout+=self.timeout
                     pass
                 except URLError as e:
                     if e.message == '<urlopen error [Errno 110] Connection timed out>':
+                        last_error = e
                         time.sleep(3*(trial+1))
                         #Increase timeout:
                         timeout+=self.timeout
@@ -151,37 +173,242 @@ not available or out of date.'''.splitlines()).format(self.file_name.replace('do
                 except (RuntimeError,
                         requests.exceptions.ConnectionError,
                         requests.exceptions.ChunkedEncodingError) as e:
+                    last_error = e
                     time.sleep(3*(trial+1))
                     pass
                 except SocketError as e:
                     #http://stackoverflow.com/questions/20568216/python-handling-socket-error-errno-104-connection-reset-by-peer
                     if e.errno != errno.ECONNRESET:
                         raise
+                    last_error = e
                     time.sleep(3*(trial+1))
                     pass
         if not success:
-            raise dodsError(error_statement)
+            if self.health is not None:
+                if not tried:
+                    raise circuitOpenError(error_statement)
+                self.health.failure(self.remote_data_node)
+            raise dodsError(error_statement, cause=last_error)
         return output
 
     def check_if_opens(self,num_trials=5):
+        if self.use_pydap:
+            #Always check that the remote file still opens. The new dataset is then reused:
+            remote_datasets.close(self.pydap_key())
         try:
             return self.safe_handling(netcdf_utils.check_if_opens, num_trials=num_trials)
         except dodsError as e:
             return False
 
-    def download(self,var,pointer_var,dimensions=dict(),unsort_dimensions=dict(),sort_table=[],time_var='time'):
+    def download(self,var,pointer_var,dimensions=dict(),unsort_dimensions=dict(),sort_table=[],time_var='time',waste_ratio=0.5):
         retrieved_data=self.safe_handling(
                          netcdf_utils.retrieve_container,var,
                                                         dimensions,
                                                         unsort_dimensions,
                                                         sort_table,self.max_request,
                                                         time_var=self.time_var,
-                                                        file_name=self.file_name
+                                                        file_name=self.file_name,
+                                                        waste_ratio=waste_ratio
                                         )
         return (retrieved_data, sort_table, pointer_var+[var])
 
+    def download_batch(self,var_list,pointer_var,download_kwargs_list):
+        retrieved_data_list=self.safe_handling(
+                         netcdf_utils.retrieve_container_batch,var_list,
+                                                        [download_kwargs.get('dimensions',dict()) for download_kwargs in download_kwargs_list],
+                                                        [download_kwargs.get('unsort_dimensions',dict()) for download_kwargs in download_kwargs_list],
+                                                        [download_kwargs.get('sort_table',[]) for download_kwargs in download_kwargs_list],
+                                                        self.max_request,
+                                                        time_var=self.time_var,
+                                                        file_name=self.file_name,
+                                                        waste_ratio_list=[download_kwargs.get('waste_ratio',0.5) for download_kwargs in download_kwargs_list]
+                                        )
+        return [(retrieved_data, download_kwargs.get('sort_table',[]), pointer_var+[var])
+                    for retrieved_data, download_kwargs, var in zip(retrieved_data_list,download_kwargs_list,var_list)]
+
+#Backend of local files, keyed on path and validated with their modification time and size:
+local_backend_cache = dict()
+hdf5_signature = '\x89HDF\r\n\x1a\n'
+
+def local_use_h5(file_name):
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return False
+    signature = (stat.st_mtime, stat.st_size)
+    if ( not file_name in local_backend_cache or
+         local_backend_cache[file_name][0] != signature ):
+        local_backend_cache[file_name] = (signature, is_hdf5(file_name, stat.st_size))
+    return local_backend_cache[file_name][1]
+
+def is_hdf5(file_name, file_size):
+    #The HDF5 superblock is at the beginning of the file or after a user block of 512, 1024, 2048, ... bytes.
+    #netCDF3 files start with 'CDF':
+    try:
+        with open(file_name, 'rb') as file_handle:
+            offset = 0
+            while offset + len(hdf5_signature) <= file_size:
+                file_handle.seek(offset)
+                header = file_handle.read(len(hdf5_signature))
+                if header == hdf5_signature:
+                    return True
+                elif offset == 0 and header[:3] == 'CDF':
+                    return False
+                offset = max(512, 2 * offset)
+    except IOError:
+        pass
+    return False
+
+class datasets_pool:
+    #Open datasets, least recently used first. A dataset is reopened when its signature changes
+    #or when it was not used for more than idle_timeout seconds.
+    #Every open must be followed by a release. A dataset that is in use is only removed from the pool
+    #and is closed when its last user releases it.
+    #Datasets are opened outside the pool lock. Threads opening the same key wait for the first one:
+    def __init__(self, max_size, idle_timeout=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.datasets = OrderedDict()
+        self.users = dict()
+        self.opening = dict()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        return
+
+    def open(self, key, open_function, signature=None):
+        while True:
+            with self.lock:
+                if self.pid != os.getpid():
+                    #Handles inherited from a parent process must not be used nor closed:
+                    self.datasets.clear()
+                    self.users.clear()
+                    self.opening.clear()
+                    self.pid = os.getpid()
+                now = time.time()
+                if self.idle_timeout is not None:
+                    for idle_key in [ idle_key for idle_key in self.datasets
+                                      if now - self.datasets[idle_key][1] > self.idle_timeout ]:
+                        self._remove(idle_key)
+                if key in self.datasets:
+                    dataset_signature, last_used, dataset = self.datasets.pop(key)
+                    if dataset_signature == signature:
+                        self.datasets[key] = (dataset_signature, now, dataset)
+                        self.users.setdefault(id(dataset), [dataset, 0])[1] += 1
+                        return dataset
+                    self.datasets[key] = (dataset_signature, last_used, dataset)
+                    self._remove(key)
+                if key in self.opening:
+                    opened = self.opening[key]
+                else:
+                    opened = threading.Event()
+                    self.opening[key] = opened
+                    break
+            #Another thread is opening this dataset:
+            opened.wait()
+
+        try:
+            dataset = open_function()
+        except:
+            with self.lock:
+                if self.opening.get(key) is opened:
+                    del self.opening[key]
+            opened.set()
+            raise
+
+        with self.lock:
+            if self.opening.get(key) is opened:
+                del self.opening[key]
+            if self.pid == os.getpid():
+                self.users[id(dataset)] = [dataset, 1]
+                if key in self.datasets:
+                    self._remove(key)
+                self.datasets[key] = (signature, time.time(), dataset)
+                while len(self.datasets) > self.max_size:
+                    self._remove(next(iter(self.datasets)))
+        opened.set()
+        return dataset
+
+    def release(self, key, dataset, discard=False):
+        #discard=True removes a dataset that might be in an invalid state from the pool:
+        with self.lock:
+            if ( self.pid == os.getpid() and
+                 id(dataset) in self.users ):
+                self.users[id(dataset)][1] -= 1
+                in_pool = ( key in self.datasets and
+                            self.datasets[key][2] is dataset )
+                if discard and in_pool:
+                    del self.datasets[key]
+                    in_pool = False
+                if self.users[id(dataset)][1] == 0:
+                    del self.users[id(dataset)]
+                    if not in_pool:
+                        _close_dataset(dataset)
+        return
+
+    def close(self, key):
+        with self.lock:
+            if ( self.pid == os.getpid() and
+                 key in self.datasets ):
+                self._remove(key)
+        return
+
+    def close_all(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                while len(self.datasets) > 0:
+                    self._remove(next(iter(self.datasets)))
+        return
+
+    def _remove(self, key):
+        #Must be called with the lock held. Datasets in use are closed when they are released:
+        dataset = self.datasets.pop(key)[2]
+        if not id(dataset) in self.users:
+            _close_dataset(dataset)
+        return
+
+def _close_dataset(dataset):
+    try:
+        dataset.close()
+    except Exception:
+        pass
+    return
+
+#Read-only local datasets:
+local_datasets = datasets_pool(16)
+atexit.register(local_datasets.close_all)
+
+def open_local_dataset(file_name):
+    use_h5 = local_use_h5(file_name)
+    signature = local_backend_cache.get(file_name, (None,))[0]
+    return local_datasets.open(file_name, lambda: _open_local_dataset(file_name, use_h5, signature),
+                               signature=signature)
+
+def _open_local_dataset(file_name, use_h5, signature):
+    #netCDF4 and HDF5 are not thread-safe:
+    with netcdf_utils.library_lock:
+        return _open_local_dataset_unlocked(file_name, use_h5, signature)
+
+def _open_local_dataset_unlocked(file_name, use_h5, signature):
+    if use_h5:
+        try:
+            return netCDF4_h5.Dataset(file_name, 'r')
+        except Exception:
+            #HDF5 file that h5netcdf cannot read:
+            local_backend_cache[file_name] = (signature, False)
+    return netCDF4.Dataset(file_name, 'r')
+
+#Remote OPeNDAP datasets. Their DDS and DAS are only retrieved when they are opened:
+remote_datasets = datasets_pool(8, idle_timeout=300)
+atexit.register(remote_datasets.close_all)
+
 class dodsError(Exception):
-    def __init__(self, value):
+    #cause is the last error that was retried, if any:
+    def __init__(self, value, cause=None):
         self.value = value
+        self.cause = cause
     def __str__(self):
         return repr(self.value)
+
+class circuitOpenError(dodsError):
+    #The data node was not contacted because its circuit is open:
+    pass
@@ -5,6 +5,9 @@ import time
 import sys
 import os
 import datetime
+import threading
+from collections import OrderedDict
+from multiprocessing.dummy import Pool as ThreadPool
 import netcdf4_pydap.cas.esgf as esgf
 
 #Internal:
@@ -15,6 +18,16 @@ local_queryable_file_types=['local_file','soft_links_container']
 remote_queryable_file_types=['OPENDAP']
 queryable_file_types=local_queryable_file_types+remote_queryable_file_types
 downloadable_file_types=['FTPServer','HTTPServer','GridFTP']
+remote_file_types=remote_queryable_file_types+downloadable_file_types
+
+#Availability of paths is trusted for availability_ttl seconds. A data node is assumed
+#down when data_node_failures_threshold of its paths were unavailable within that time
+#and none was available since:
+availability_ttl=60.0
+data_node_failures_threshold=3
+availability_cache=dict()
+data_node_failures=dict()
+availability_lock=threading.Lock()
 
 class remote_netCDF:
     def __init__(self,filename,file_type,
@@ -29,7 +42,9 @@ class remote_netCDF:
                  use_certificates=False,
                  cache=None,
                  timeout=120,
-                 expire_after=datetime.timedelta(hours=1)):
+                 expire_after=datetime.timedelta(hours=1),
+                 max_request=None,
+                 health=None):
         self.filename=filename
         self.file_type=file_type
         self.remote_data_node=get_data_node(self.filename,self.file_type)
@@ -48,6 +63,9 @@ class remote_netCDF:
         self.username=username
         self.password=password
         self.use_certificates=use_certificates
+        self.max_request=max_request
+        #Shared health of data nodes (see queues_manager.Health_data_node):
+        self.health=health
         return
     
     def is_available(self,num_trials=5):
@@ -55,6 +73,7 @@ class remote_netCDF:
         if not self.file_type in queryable_file_types: 
             with http_netcdf.http_netCDF(self.filename,
                                                 semaphores=self.semaphores,
+                                                health=self.health,
                                                 remote_data_node=self.remote_data_node,
                                                 timeout=self.timeout,
                                                 session=self.session,
@@ -66,6 +85,7 @@ class remote_netCDF:
         elif not self.file_type in ['soft_links_container']:
             with queryable_netcdf.queryable_netCDF(self.filename,
                                                 semaphores=self.semaphores,
+                                                health=self.health,
                                                 remote_data_node=self.remote_data_node,
                                                 timeout=self.timeout,
                                                 session=self.session,
@@ -82,6 +102,7 @@ class remote_netCDF:
         if self.file_type in queryable_file_types:
             with queryable_netcdf.queryable_netCDF(self.filename,
                                                    semaphores=self.semaphores,
+                                                   health=self.health,
                                                    time_var=self.time_var,
                                                    remote_data_node=get_data_node(self.filename,self.file_type),
                                                    cache=self.cache,timeout=self.timeout,
@@ -89,11 +110,13 @@ class remote_netCDF:
                                                    authentication_url=self.authentication_url,
                                                    username=self.username,
                                                    password=self.password,
-                                                   use_certificates=self.use_certificates) as remote_data:
+                                                   use_certificates=self.use_certificates,
+                                                   max_request=self.max_request) as remote_data:
                 return remote_data.download(var,pointer_var,**download_kwargs)
         elif self.file_type == 'HTTPServer':
             with http_netcdf.http_netCDF(self.filename,
                                          semaphores=self.semaphores,
+                                         health=self.health,
                                          remote_data_node=get_data_node(self.filename,self.file_type),
                                          cache=self.cache,timeout=self.timeout,
                                          expire_after=self.expire_after,session=self.session,
@@ -110,32 +133,92 @@ class remote_netCDF:
                                        expire_after=self.expire_after,session=self.session) as remote_data:
                 return remote_data.download(var,pointer_var,**download_kwargs)
 
+    def download_batch(self,var_list,pointer_var,download_kwargs_list=[]):
+        #Retrieve several variables while opening the file only once:
+        if self.file_type in queryable_file_types:
+            with queryable_netcdf.queryable_netCDF(self.filename,
+                                                   semaphores=self.semaphores,
+                                                   health=self.health,
+                                                   time_var=self.time_var,
+                                                   remote_data_node=get_data_node(self.filename,self.file_type),
+                                                   cache=self.cache,timeout=self.timeout,
+                                                   expire_after=self.expire_after,session=self.session,
+                                                   authentication_url=self.authentication_url,
+                                                   username=self.username,
+                                                   password=self.password,
+                                                   use_certificates=self.use_certificates,
+                                                   max_request=self.max_request) as remote_data:
+                return remote_data.download_batch(var_list,pointer_var,download_kwargs_list)
+        else:
+            return [self.download(var,pointer_var,download_kwargs=download_kwargs)
+                        for var, download_kwargs in zip(var_list,download_kwargs_list)]
+
+    def is_available_cached(self,num_trials=5):
+        if ( self.health is not None and
+             self.file_type in remote_file_types and
+             self.health.is_open(self.remote_data_node) ):
+            return False
+        now=time.time()
+        with availability_lock:
+            if ( self.filename in availability_cache and
+                 now-availability_cache[self.filename][0]<availability_ttl ):
+                return availability_cache[self.filename][1]
+            if ( self.file_type in remote_file_types and
+                 len([failure_time for failure_time in data_node_failures.get(self.remote_data_node,dict()).values()
+                      if now-failure_time<availability_ttl])>=data_node_failures_threshold ):
+                return False
+        available=self.is_available(num_trials=num_trials)
+        with availability_lock:
+            availability_cache[self.filename]=(time.time(),available)
+            if self.file_type in remote_file_types:
+                if available:
+                    data_node_failures.pop(self.remote_data_node,None)
+                else:
+                    data_node_failures.setdefault(self.remote_data_node,dict())[self.filename]=time.time()
+        return available
+
     def check_if_available_and_find_alternative(self,paths_list,
                                                     file_type_list,
                                                     checksum_list,
-                                                    acceptable_file_types,num_trials=5):
+                                                    acceptable_file_types,num_trials=5,
+                                                    path_index=None,
+                                                    checksum_index=None):
+        #path_index and checksum_index (see paths_index and checksums_index) avoid scanning
+        #paths_list and checksum_list when this is called for many paths of the same list:
         if ( not self.file_type in acceptable_file_types or
-             not self.is_available(num_trials=num_trials)):
-            checksum=checksum_list[list(paths_list).index(self.filename)]
-            for cs_id, cs in enumerate(checksum_list):
-                if ( cs==checksum and 
-                     paths_list[cs_id]!=self.filename and
-                     file_type_list[cs_id] in acceptable_file_types  and
-                     is_level_name_included_and_not_excluded('data_node',self,get_data_node(paths_list[cs_id],file_type_list[cs_id]))
-                     ):
-                        remote_data=remote_netCDF(paths_list[cs_id],
-                                                  file_type_list[cs_id],
-                                                  self.semaphores,
-                                                  cache=self.cache,
-                                                  timeout=self.timeout,
-                                                  expire_after=self.expire_after,
-                                                  session=self.session,
-                                                  openid=self.openid,
-                                                  username=self.username,
-                                                  password=self.password,
-                                                  use_certificates=self.use_certificates)
-                        if remote_data.is_available(num_trials=num_trials):
-                            return paths_list[cs_id]
+             not self.is_available_cached(num_trials=num_trials)):
+            if path_index is None:
+                checksum=checksum_list[list(paths_list).index(self.filename)]
+            else:
+                checksum=checksum_list[path_index[self.filename]]
+            if checksum_index is None:
+                replicas_id=range(len(checksum_list))
+            else:
+                replicas_id=checksum_index[checksum]
+            replicas_id=[ cs_id for cs_id in replicas_id
+                          if ( checksum_list[cs_id]==checksum and 
+                               paths_list[cs_id]!=self.filename and
+                               file_type_list[cs_id] in acceptable_file_types  and
+                               is_level_name_included_and_not_excluded('data_node',self,get_data_node(paths_list[cs_id],file_type_list[cs_id]))
+                               ) ]
+            if self.health is not None:
+                #Try healthy and fast data nodes first:
+                replicas_id=sorted(replicas_id,key=lambda cs_id: self.health.score(get_data_node(paths_list[cs_id],file_type_list[cs_id])))
+            for cs_id in replicas_id:
+                remote_data=remote_netCDF(paths_list[cs_id],
+                                          file_type_list[cs_id],
+                                          self.semaphores,
+                                          cache=self.cache,
+                                          timeout=self.timeout,
+                                          expire_after=self.expire_after,
+                                          session=self.session,
+                                          openid=self.openid,
+                                          username=self.username,
+                                          password=self.password,
+                                          use_certificates=self.use_certificates,
+                                          health=self.health)
+                if remote_data.is_available_cached(num_trials=num_trials):
+                    return paths_list[cs_id]
             return None
         else:
             return self.filename
@@ -144,6 +227,7 @@ class remote_netCDF:
         if self.file_type in queryable_file_types:
             with queryable_netcdf.queryable_netCDF(self.filename,
                                                 semaphores=self.semaphores,
+                                                health=self.health,
                                                 remote_data_node=get_data_node(self.filename,self.file_type),
                                                 cache=self.cache,timeout=self.timeout,
                                                 expire_after=self.expire_after,session=self.session,
@@ -160,6 +244,7 @@ class remote_netCDF:
         if self.file_type in queryable_file_types:
             with queryable_netcdf.queryable_netCDF(self.filename,
                                                 semaphores=self.semaphores,
+                                                health=self.health,
                                                 remote_data_node=get_data_node(self.filename,self.file_type),
                                                 cache=self.cache,
                                                 timeout=self.timeout,
@@ -203,6 +288,7 @@ class remote_netCDF:
         if self.file_type in queryable_file_types:
             with queryable_netcdf.queryable_netCDF(self.filename,
                                                 semaphores=self.semaphores,
+                                                health=self.health,
                                                 remote_data_node=get_data_node(self.filename,self.file_type),
                                                 cache=self.cache,
                                                 timeout=self.timeout,
@@ -222,6 +308,7 @@ class remote_netCDF:
         if self.file_type in queryable_file_types:
             with queryable_netcdf.queryable_netCDF(self.filename,
                                                 semaphores=self.semaphores,
+                                                health=self.health,
                                                 remote_data_node=get_data_node(self.filename,self.file_type),
                                                 cache=self.cache,
                                                 timeout=self.timeout,
@@ -237,6 +324,10 @@ class remote_netCDF:
             units='days since '+str(start_date)
         return units
 
+    def get_file_metadata(self,time_var='time'):
+        #Calendar, time units, time axis, dimension type and variables in a single access:
+        return self.safe_handling(netcdf_utils.get_file_metadata,time_var=time_var)
+
 def dates_from_filename(filename, calendar):
     """
     Returns datetime objetcs for start and end dates from the filename.
@@ -281,6 +372,39 @@ def rebuild_date_axis(start, length, instant, inc, units, calendar='standard'):
     date_axis = timeaxis_mod.Num2date(num_axis, units=units, calendar=calendar)
     return date_axis
 
+def paths_index(paths_list):
+    #Index of the first occurence of each path:
+    path_index=dict()
+    for index, path in enumerate(paths_list):
+        path_index.setdefault(path,index)
+    return path_index
+
+def checksums_index(checksum_list):
+    #Indices of the paths sharing each checksum:
+    checksum_index=dict()
+    for index, checksum in enumerate(checksum_list):
+        checksum_index.setdefault(checksum,[]).append(index)
+    return checksum_index
+
+def probe_availability(paths_list,file_type_list,num_trials=5,num_threads=8,**remote_netcdf_kwargs):
+    #Check concurrently the availability of remote paths, filling the availability cache.
+    #Local paths are cheap to check and are left to check_if_available_and_find_alternative:
+    remote_data_list=[]
+    for path, file_type in OrderedDict.fromkeys(zip(paths_list,file_type_list)):
+        if file_type in remote_file_types:
+            remote_data=remote_netCDF(path,file_type,**remote_netcdf_kwargs)
+            if is_level_name_included_and_not_excluded('data_node',remote_data,remote_data.remote_data_node):
+                remote_data_list.append(remote_data)
+    if len(remote_data_list)==0:
+        return
+    pool=ThreadPool(min(num_threads,len(remote_data_list)))
+    try:
+        pool.map(lambda remote_data: remote_data.is_available_cached(num_trials=num_trials),remote_data_list)
+    finally:
+        pool.close()
+        pool.join()
+    return
+
 def is_level_name_included_and_not_excluded(level_name,options,group):
     if level_name in dir(options):
         if isinstance(getattr(options,level_name),list):
@@ -16,12 +16,14 @@ import numpy as np
 from argparse import RawTextHelpFormatter
 from datetime import datetime
 from functools import wraps
-from netCDF4 import Dataset, date2num, num2date
+from netCDF4 import Dataset, num2date
 from netCDF4 import datetime as phony_datetime
 from multiprocessing.dummy import Pool as ThreadPool
 from textwrap import fill
 from glob import glob
 
+from .. import netcdf_utils
+
 # Program version
 __version__ = '{0} {1}-{2}-{3}'.format('v3.0', '2015', '08', '25')
 
@@ -576,7 +578,7 @@ def untroncated_timestamp(timestamp):
 def Num2date(num_axis, units, calendar):
     """
     A wrapper from ``netCDF4.num2date`` able to handle "years since" and "months since" units.
-    If time units are not "years since" or "months since", calls usual ``netcdftime.num2date``.
+    If time units are not "years since" or "months since", calls the vectorized ``netcdf_utils.get_date_axis_relative``.
 
     :param array num_axis: The numerical time axis following units
     :param str units: The proper time units
@@ -587,49 +589,27 @@ def Num2date(num_axis, units, calendar):
     """
     # num_axis is the numerical time axis incremented following units (i.e., by years, months, days, etc).
     if not units.split(' ')[0] in ['years', 'months']:
-        # If units are not 'years' or 'months since', call usual netcdftime.num2date:
-        return num2date(num_axis, units=units, calendar=calendar)
+        # If units are not 'years' or 'months since', call usual num2date:
+        return netcdf_utils.get_date_axis_relative(num_axis, units, calendar)
     else:
         # Return to time refenence with 'days since'
         units_as_days = 'days '+' '.join(units.split(' ')[1:])
-        # Convert the time refrence 'units_as_days' as datetime object
-        start_date = num2date(0.0, units=units_as_days, calendar=calendar)
         # Control num_axis to always get an Numpy array (even with a scalar)
-        num_axis_mod = np.atleast_1d(np.array(num_axis))
-        if units.split(' ')[0] == 'years':
-            # If units are 'years since'
-            # Define the number of maximum and minimum years to build a date axis covering the whole 'num_axis' period
-            max_years = np.floor(np.max(num_axis_mod)) + 1
-            min_years = np.ceil(np.min(num_axis_mod)) - 1
-            # Create a date axis with one year that spans the entire period by year
-            years_axis = np.array([add_year(start_date, years_to_add) for years_to_add in np.arange(min_years, max_years+2)])
-            # Convert rebuilt years axis as 'number of days since'
-            year_axis_as_days = date2num(years_axis, units=units_as_days, calendar=calendar)
-            # Index of each years
-            yind = np.vectorize(np.int)(np.floor(num_axis_mod))
-            # Rebuilt num_axis as 'days since' addint the number of days since referenced time with an half-increment (num_axis_mod - yind) = 0 or 0.5
-            num_axis_mod_days = (year_axis_as_days[yind - int(min_years)] + (num_axis_mod - yind) * np.diff(year_axis_as_days)[yind - int(min_years)])
-        elif units.split(' ')[0] == 'months':
-            # If units are 'months since'
-            # Define the number of maximum and minimum months to build a date axis covering the whole 'num_axis' period
-            max_months = np.floor(np.max(num_axis_mod)) + 1
-            min_months = np.ceil(np.min(num_axis_mod)) - 1
-            # Create a date axis with one month that spans the entire period by month
-            months_axis = np.array([add_month(start_date, months_to_add) for months_to_add in np.arange(min_months, max_months+12)])
-            # Convert rebuilt months axis as 'number of days since'
-            months_axis_as_days = date2num(months_axis, units=units_as_days, calendar=calendar)
-            # Index of each months
-            mind = np.vectorize(np.int)(np.floor(num_axis_mod))
-            # Rebuilt num_axis as 'days since' addint the number of days since referenced time with an half-increment (num_axis_mod - mind) = 0 or 0.5
-            num_axis_mod_days = (months_axis_as_days[mind - int(min_months)] + (num_axis_mod - mind) * np.diff(months_axis_as_days)[mind - int(min_months)])
+        num_axis_mod = np.atleast_1d(np.array(num_axis, dtype=np.float64))
+        # Index of each years or months
+        index = np.floor(num_axis_mod).astype(np.int64)
+        # Number of days since time reference at the start of this year or month and of the next one
+        start_days, end_days = months_as_days([index, index + 1], units, calendar)
+        # Rebuilt num_axis as 'days since' adding the fraction of the year or month (num_axis_mod - index) = 0 or 0.5
+        num_axis_mod_days = start_days + (num_axis_mod - index) * (end_days - start_days)
         # Convert result as date axis
-        return num2date(num_axis_mod_days, units=units_as_days, calendar=calendar)
+        return netcdf_utils.get_date_axis_relative(num_axis_mod_days, units_as_days, calendar)
 
 
 def Date2num(date_axis, units, calendar):
     """
     A wrapper from ``netCDF4.date2num`` able to handle "years since" and "months since" units.
-    If time units are not "years since" or "months since" calls usual ``netcdftime.date2num``.
+    If time units are not "years since" or "months since" calls the vectorized ``netcdf_utils.get_time_axis_relative``.
 
     :param array num_axis: The date axis following units
     :param str units: The proper time units
@@ -640,43 +620,58 @@ def Date2num(date_axis, units, calendar):
     """
     # date_axis is the date time axis incremented following units (i.e., by years, months, days, etc).
     if not units.split(' ')[0] in ['years', 'months']:
-        # If units are not 'years' or 'months since', call usual netcdftime.date2num:
-        return date2num(date_axis, units=units, calendar=calendar)
+        # If units are not 'years' or 'months since', call usual date2num:
+        return netcdf_utils.get_time_axis_relative(date_axis, units, calendar)
     else:
         # Return to time refenence with 'days since'
         units_as_days = 'days '+' '.join(units.split(' ')[1:])
         # Convert date axis as number of days since time reference
-        days_axis = date2num(date_axis, units=units_as_days, calendar=calendar)
-        # Convert the time refrence 'units_as_days' as datetime object
-        start_date = num2date(0.0, units=units_as_days, calendar=calendar)
-        # Create years axis from input date axis
-        years = np.array([date.year for date in np.atleast_1d(np.array(date_axis))])
+        days_axis = np.atleast_1d(netcdf_utils.get_time_axis_relative(date_axis, units_as_days, calendar))
+        # The time refrence as year and month
+        start_year, start_month = netcdf_utils.parse_time_units(units_as_days)[1][:2]
+        # Years or months elapsed since the time reference from the date components
+        dates = np.atleast_1d(np.array(date_axis))
+        index = np.array([date.year for date in dates]) - start_year
+        if units.split(' ')[0] == 'months':
+            index = 12 * index + np.array([date.month for date in dates]) - start_month
+        start_days = months_as_days([index], units, calendar)[0]
+        # The date can fall before the start of its year or month if the time reference is not on the first day:
+        index = np.where(days_axis < start_days, index - 1, index)
+        start_days, end_days = months_as_days([index, index + 1], units, calendar)
+        return index + (days_axis - start_days) / (end_days - start_days)
+
+
+def months_as_days(indices_list, units, calendar):
+    """
+    Converts integer numbers of years or months since the time reference to numbers of days since
+    the time reference, without creating date objects.
+
+    :param list indices_list: Integer arrays of years or months following units
+    :param str units: The "years since" or "months since" time units
+    :param str calendar: The NetCDF calendar attribute
+    :returns: The corresponding numbers of days for each array in indices_list
+    :rtype: *list*
+    :raises ValueError: If the day of the time reference does not exist in one of these years or months
+
+    """
+    reference = netcdf_utils.parse_time_units('days '+' '.join(units.split(' ')[1:]))[1]
+    if calendar is None:
+        calendar = 'standard'
+    reference_day = netcdf_utils.day_number_from_date(reference[0], reference[1], reference[2], calendar)
+    days_list = []
+    for indices in indices_list:
         if units.split(' ')[0] == 'years':
-            # If units are 'years since'
-            # Define the number of maximum and minimum years to build a date axis covering the whole 'num_axis' period
-            max_years = np.max(years - start_date.year) + 1
-            min_years = np.min(years - start_date.year) - 1
-            # Create a date axis with one year that spans the entire period by year
-            years_axis = np.array([add_year(start_date, yid) for yid in np.arange(min_years, max_years+2)])
-            # Convert years axis as number of days since time reference
-            years_axis_as_days = date2num(years_axis, units=units_as_days, calendar=calendar)
-            # Find closest index for years_axis_as_days in days_axis
-            closest_index = np.searchsorted(years_axis_as_days, days_axis)
-            # ???
-            return min_years + closest_index + (days_axis - years_axis_as_days[closest_index]) / np.diff(years_axis_as_days)[closest_index]
-        elif units.split(' ')[0] == 'months':
-            # If units are 'months since'
-            # Define the number of maximum and minimum months to build a date axis covering the whole 'num_axis' period
-            max_months = np.max(12 * (years - start_date.year)) + 1
-            min_months = np.min(12 * (years - start_date.year)) - 1
-            # Create a date axis with one month that spans the entire period by month
-            months_axis = np.array([add_month(start_date, mid) for mid in np.arange(min_months, max_months+12)])
-            # Convert months axis as number of days since time reference
-            months_axis_as_days = date2num(months_axis, units=units_as_days, calendar=calendar)
-            # Find closest index for months_axis_as_days in days_axis
-            closest_index = np.searchsorted(months_axis_as_days, days_axis)
-            # ???
-            return min_months + closest_index + (days_axis - months_axis_as_days[closest_index]) / np.diff(months_axis_as_days)[closest_index]
+            years, months = reference[0] + indices, reference[1]
+        else:
+            years = reference[0] + (reference[1] - 1 + indices) // 12
+            months = (reference[1] - 1 + indices) % 12 + 1
+        # As with dates, a time reference on the 31st cannot be moved to a month with 30 days
+        month_starts = netcdf_utils.day_number_from_date(years, months, 1, calendar)
+        next_month_starts = netcdf_utils.day_number_from_date(years + months // 12, months % 12 + 1, 1, calendar)
+        if np.any(reference[2] > next_month_starts - month_starts):
+            raise ValueError('day is out of range for month')
+        days_list.append(month_starts + reference[2] - 1 - reference_day)
+    return days_list
 
 
 def add_month(date, months_to_add):
@@ -4,9 +4,12 @@ import datetime
 from sqlite3 import DatabaseError
 import requests
 import requests_cache
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 def create_single_session(cache=None,expire_after=datetime.timedelta(hours=1),
-                          openid=None,username=None,password=None,use_certificates=None):
+                          openid=None,username=None,password=None,use_certificates=None,
+                          pool_maxsize=1,max_retries=3,backoff_factor=0.5):
     #credentials openid,username and password are accepted only for compatibility
     #purposes
     if cache!=None:
@@ -22,4 +25,19 @@ def create_single_session(cache=None,expire_after=datetime.timedelta(hours=1),
     else:
         #Create a phony in-memory cached session and disable it:
         session=requests.Session()
+    mount_pooled_adapter(session,pool_maxsize=pool_maxsize,max_retries=max_retries,backoff_factor=backoff_factor)
+    return session
+
+def mount_pooled_adapter(session,pool_maxsize=1,max_retries=3,backoff_factor=0.5):
+    #Keep up to pool_maxsize connections alive for each host. Should match
+    #the number of simultaneous requests made with the session.
+    #Failed connections and overloaded servers are retried with an exponential backoff.
+    #Other errors, including read errors, are left to the caller:
+    retries=Retry(total=None,connect=max_retries,read=False,status=max_retries,
+                  status_forcelist=[500,502,503,504],
+                  backoff_factor=backoff_factor,
+                  raise_on_status=False)
+    adapter=HTTPAdapter(pool_connections=10,pool_maxsize=pool_maxsize,max_retries=retries)
+    session.mount('http://',adapter)
+    session.mount('https://',adapter)
     return session
@@ -1,16 +1,23 @@
 #External:
 import multiprocessing
+import threading
 import datetime
+import time
+import re
+import socket
 #import sys
 #from StringIO import StringIO
 import netCDF4
 import requests
 import requests_cache
+from urllib2 import HTTPError, URLError
+from pydap.exceptions import ServerError
 
 #Internal:
-from . import netcdf_utils, requests_sessions, retrieval_utils
+from . import netcdf_utils, indices_utils, requests_sessions, retrieval_utils
 from .certificates import certificates
 from .remote_netcdf import remote_netcdf
+from .remote_netcdf.queryable_netcdf import dodsError, circuitOpenError
 
 def start_download_processes(options,q_manager,previous_processes=dict()):
     remote_netcdf_kwargs=dict()
@@ -31,7 +38,11 @@ def start_download_processes(options,q_manager,previous_processes=dict()):
     #Start processes for download. Can be run iteratively for an update.
     processes=previous_processes
     if not ('serial' in dir(options) and options.serial):
-        processes=start_download_processes_no_serial(q_manager,options.num_dl,processes,time_var=time_var,
+        if 'engine' in dir(options) and options.engine=='threads':
+            processes=start_download_threads_no_serial(q_manager,options.num_dl,processes,time_var=time_var,
+                                                                                        remote_netcdf_kwargs=remote_netcdf_kwargs)
+        else:
+            processes=start_download_processes_no_serial(q_manager,options.num_dl,processes,time_var=time_var,
                                                                                         remote_netcdf_kwargs=remote_netcdf_kwargs)
     return processes
 
@@ -46,8 +57,47 @@ def start_download_processes_no_serial(q_manager,num_dl,processes,time_var='time
                 processes[process_name].start()
     return processes
 
-def worker_retrieve(q_manager,data_node,time_var,remote_netcdf_kwargs):
-    if ( 'session' in dir(q_manager) and
+def start_download_threads_no_serial(q_manager,num_dl,processes,time_var='time',remote_netcdf_kwargs=dict()):
+    #A single process multiplexes the retrievals from all new data nodes.
+    #The number of simultaneous retrievals from each data node is capped by num_dl.
+    data_node_list=[data_node for data_node in q_manager.queues.keys() if not data_node+'-threads' in processes.keys()]
+    if len(data_node_list)>0:
+        process_name='threads-'+str(len(set(processes.values())))
+        process=multiprocessing.Process(target=worker_retrieve_threads,
+                                        name=process_name,
+                                        args=(q_manager,data_node_list,num_dl,time_var,remote_netcdf_kwargs))
+        process.start()
+        for data_node in data_node_list:
+            processes[data_node+'-threads']=process
+    return processes
+
+def worker_retrieve_threads(q_manager,data_node_list,num_dl,time_var,remote_netcdf_kwargs):
+    threads=[]
+    for data_node in data_node_list:
+        if 'cache' in remote_netcdf_kwargs.keys() and remote_netcdf_kwargs['cache']:
+            #Cached sessions toggle their cache and cannot be shared among threads:
+            session=None
+        else:
+            #The threads retrieving from a data node share a session with a pool of num_dl connections:
+            session=requests_sessions.create_single_session(pool_maxsize=num_dl,**remote_netcdf_kwargs)
+        for simultaneous_thread in range(num_dl):
+            thread=threading.Thread(target=worker_retrieve,
+                                    name=data_node+'-'+str(simultaneous_thread),
+                                    args=(q_manager,data_node,time_var,remote_netcdf_kwargs),
+                                    kwargs={'session':session})
+            thread.daemon=True
+            thread.start()
+            threads.append(thread)
+    #Threads are waiting on the network most of the time. Process will be terminated by main process:
+    for thread in threads:
+        thread.join()
+    return
+
+def worker_retrieve(q_manager,data_node,time_var,remote_netcdf_kwargs,session=None):
+    if ( isinstance(session,requests.Session) or
+         isinstance(session,requests_cache.core.CachedSession)):
+        pass
+    elif ( 'session' in dir(q_manager) and
         (isinstance(q_manager.session,requests.Session) or
             isinstance(q_manager.session,requests_cache.core.CachedSession)
             )):
@@ -60,21 +110,66 @@ def worker_retrieve(q_manager,data_node,time_var,remote_netcdf_kwargs):
     while True:
         item = q_manager.queues.get(data_node)
         if item=='STOP': break
+        max_request=None
         try:
             thread_id=item[0]
             trial=item[1]
             path_to_retrieve=item[2]
             file_type=item[3]
+            if ( file_type in remote_netcdf.remote_queryable_file_types and
+                 'request_sizes' in dir(q_manager)):
+                #Request size learned for this data node:
+                max_request=q_manager.request_sizes[data_node]
+            else:
+                max_request=None
+            if 'health' in dir(q_manager):
+                health=q_manager.health
+            else:
+                health=None
             remote_data=remote_netcdf.remote_netCDF(path_to_retrieve,file_type,session=session,
                                                                                time_var=time_var,
+                                                                               max_request=max_request,
+                                                                               health=health,
                                                                                **remote_netcdf_kwargs)
 
             var_to_retrieve=item[4]
             pointer_var=item[5]
-            result=remote_data.download(var_to_retrieve,pointer_var,download_kwargs=item[-1])
+            indices_utils.start_request_log()
+            if isinstance(var_to_retrieve,list):
+                #Several variables from the same path:
+                result=remote_data.download_batch(var_to_retrieve,pointer_var,download_kwargs_list=item[-1])
+            else:
+                result=remote_data.download(var_to_retrieve,pointer_var,download_kwargs=item[-1])
+            requests_list=indices_utils.stop_request_log()
+            if max_request!=None:
+                q_manager.request_sizes.success(data_node,max_request,requests_list)
             q_manager.put_for_thread_id(thread_id,(file_type,result))
-        except Exception:
-            if trial==3:
+        except circuitOpenError:
+            indices_utils.stop_request_log()
+            if q_manager.health.is_dead(data_node):
+                #The tests sent after each cooldown failed. Give up on this data node:
+                print('Download failed with arguments ',item)
+                q_manager.put_for_thread_id(thread_id,(file_type,'FAIL'))
+            else:
+                #The data node was not contacted. This is not a download failure: wait for the
+                #circuit cooldown and put back in the queue without counting a trial:
+                while q_manager.health.is_open(data_node):
+                    time.sleep(min(q_manager.health.cooldown_left(data_node),5.0))
+                q_manager.put_again_to_data_node_from_thread_id(thread_id,data_node,item[1:])
+        except Exception as e:
+            indices_utils.stop_request_log()
+            if max_request!=None and is_size_error(e):
+                #Retry with smaller requests:
+                q_manager.request_sizes.failure(data_node,max_request)
+            if isinstance(var_to_retrieve,list) and len(var_to_retrieve)>1:
+                #A single variable might be failing. Retry the variables one by one without counting
+                #a trial. The other variables are expected before the first one takes the place of the batch:
+                for var, download_kwargs in zip(var_to_retrieve[1:],item[-1][1:]):
+                    q_manager.put_to_data_node_from_thread_id(thread_id,data_node,
+                                                              (trial,path_to_retrieve,file_type,[var],pointer_var,[download_kwargs]))
+                q_manager.put_again_to_data_node_from_thread_id(thread_id,data_node,
+                                                                (trial,path_to_retrieve,file_type,var_to_retrieve[:1],pointer_var,item[-1][:1]))
+            elif trial==3:
                 print('Download failed with arguments ',item)
                 raise
                 q_manager.put_for_thread_id(thread_id,(file_type,'FAIL'))
@@ -85,6 +180,30 @@ def worker_retrieve(q_manager,data_node,time_var,remote_netcdf_kwargs):
                 q_manager.put_again_to_data_node_from_thread_id(thread_id,data_node,item_new)
     return
 
+def is_size_error(error):
+    #Errors that smaller requests might avoid: server errors (HTTP 5xx), request too large (HTTP 413)
+    #and timeouts. Authentication errors, missing variables and bugs are not:
+    if isinstance(error,dodsError):
+        #Last error retried before giving up:
+        error=error.cause
+    if isinstance(error,(requests.exceptions.Timeout,socket.timeout)):
+        return True
+    elif isinstance(error,URLError) and not isinstance(error,HTTPError):
+        return 'timed out' in str(error)
+    elif isinstance(error,HTTPError):
+        status=error.code
+    elif isinstance(error,requests.exceptions.HTTPError) and error.response is not None:
+        status=error.response.status_code
+    elif isinstance(error,(requests.exceptions.HTTPError,ServerError)):
+        #The status is only available from the message, e.g. 'Server error 500: ...':
+        match=re.search(r'\b([1-5][0-9][0-9])\b',str(error))
+        if match is None:
+            return False
+        status=int(match.group(1))
+    else:
+        return False
+    return status==413 or 500<=status<600
+
 def worker_exit(q_manager,data_node_list,queues_size,start_time,renewal_time,output,options):
     failed=False
     while True:
@@ -145,11 +264,16 @@ def progress_report(file_type,result,q_manager,data_node_list,queues_size,start_
             failed=True
     else:
         if not result=='FAIL':
-            assign_tree(output,*result)
+            if isinstance(result,list):
+                #Results for several variables from the same path:
+                for sub_result in result:
+                    assign_tree(output,*sub_result)
+            else:
+                assign_tree(output,*result)
             output.sync()
             if 'silent' in dir(options) and not options.silent:
                 string_to_print=[str(queues_size[data_node]-q_manager.queues.qsize(data_node)).zfill(len(str(queues_size[data_node])))+
-                                 '/'+str(queues_size[data_node]) for
+                                 '/'+str(queues_size[data_node])+request_size_string(q_manager,data_node) for
                                     data_node in data_node_list if queues_size[data_node]>0]
                 print(str(elapsed_time)+', '+' | '.join(string_to_print)+'\r'),
         else:
@@ -166,6 +290,13 @@ def progress_report(file_type,result,q_manager,data_node_list,queues_size,start_
         renewal_time=datetime.datetime.now()
     return renewal_time, failed
 
+def request_size_string(q_manager,data_node):
+    if ( 'request_sizes' in dir(q_manager) and
+         data_node in q_manager.request_sizes.keys()):
+        return ' ('+str(int(round(q_manager.request_sizes[data_node])))+'Mb)'
+    else:
+        return ''
+
 def assign_tree(output,val,sort_table,tree):
     if len(tree)>1:
         if tree[0]!='':
@@ -4,6 +4,7 @@ import tempfile
 import copy
 import os
 import datetime
+from multiprocessing.dummy import Pool as ThreadPool
 
 #Internal:
 from ..remote_netcdf import remote_netcdf
@@ -17,7 +18,8 @@ class create_netCDF_pointers:
     def __init__(self, paths_list, time_frequency, years, months,
                  file_type_list, data_node_list,
                  semaphores=dict(), record_other_vars=True, check_dimensions=False,
-                 time_var='time', session=None, remote_netcdf_kwargs=dict()):
+                 time_var='time', session=None, remote_netcdf_kwargs=dict(),
+                 num_validate_workers=1, metadata_cache=None):
         self.semaphores = semaphores
         self.session = session
         self.remote_netcdf_kwargs = remote_netcdf_kwargs
@@ -34,10 +36,15 @@ class create_netCDF_pointers:
         self.is_instant = False
         self.record_other_vars = record_other_vars
         self.time_var = time_var
+        self.num_validate_workers = num_validate_workers
 
         self.months = months
         self.years = years
 
+        #Metadata records, keyed by path. Each file is opened at most once to fill them:
+        self.metadata = dict()
+        self.metadata_cache = metadata_cache
+
         self.paths_ordering = order_paths_by_preference(sorts_list,
                                                       self.id_list,
                                                       self.paths_list,
@@ -47,7 +54,10 @@ class create_netCDF_pointers:
                                                       semaphores=self.semaphores,
                                                       time_var=self.time_var,
                                                       session=self.session,
-                                                      remote_netcdf_kwargs=self.remote_netcdf_kwargs)
+                                                      remote_netcdf_kwargs=self.remote_netcdf_kwargs,
+                                                      metadata=self.metadata,
+                                                      metadata_cache=self.metadata_cache,
+                                                      num_workers=self.num_validate_workers)
         return
 
     def record_paths(self,output,var):
@@ -64,7 +74,10 @@ class create_netCDF_pointers:
             self.calendar = obtain_unique_calendar(self.paths_ordering,semaphores=self.semaphores,
                                                                      time_var=self.time_var,
                                                                      session=self.session,
-                                                                     remote_netcdf_kwargs=self.remote_netcdf_kwargs)
+                                                                     remote_netcdf_kwargs=self.remote_netcdf_kwargs,
+                                                                     metadata=self.metadata,
+                                                                     metadata_cache=self.metadata_cache,
+                                                                     num_workers=self.num_validate_workers)
             #Retrieve time and meta:
             self.create_variable(output,var)
             #Put version:
@@ -148,7 +161,10 @@ class create_netCDF_pointers:
                                                 semaphores=self.semaphores,
                                                 time_var=self.time_var,
                                                 session=self.session,
-                                                remote_netcdf_kwargs=self.remote_netcdf_kwargs)
+                                                remote_netcdf_kwargs=self.remote_netcdf_kwargs,
+                                                metadata=self.metadata,
+                                                metadata_cache=self.metadata_cache,
+                                                num_workers=self.num_validate_workers)
 
         if len(table['paths'])>0:
             #Convert time axis to numbers and find the unique time axis:
@@ -184,23 +200,49 @@ class create_netCDF_pointers:
             netcdf_utils.create_time_axis_date(output, date_axis_unique, units, self.calendar, time_dim=time_dim)
 
             self.create(output)
+            #All variables share the same time axis and therefore the same soft links:
+            soft_links_table = create_soft_links_table(self.paths_ordering,
+                                                       time_axis,time_axis_unique,
+                                                       table,paths_id_on_time_axis)
             if isinstance(var,list):
                 for sub_var in var:
-                    output = record_indices(self.paths_ordering,
-                                               remote_data,output,sub_var,
-                                               time_dim,time_axis,time_axis_unique,
-                                               table,paths_id_on_time_axis,self.record_other_vars)
+                    output = record_indices(remote_data,output,sub_var,
+                                               time_dim,soft_links_table,self.record_other_vars)
             else:
-                output = record_indices(self.paths_ordering,
-                                           remote_data,output,var,
-                                           time_dim,time_axis,time_axis_unique,
-                                           table,paths_id_on_time_axis,self.record_other_vars)
+                output = record_indices(remote_data,output,var,
+                                           time_dim,soft_links_table,self.record_other_vars)
         return
 
-def record_indices(paths_ordering,
-                    remote_data,output,var,
-                    time_dim,time_axis,time_axis_unique,
-                    table,paths_id_on_time_axis,record_other_vars):
+def create_soft_links_table(paths_ordering,time_axis,time_axis_unique,table,paths_id_on_time_axis):
+    #For each time in time_axis_unique, pick the first path in paths_ordering that
+    #covers this time and the index of this time in that path:
+    paths_id_list = paths_ordering['path_id']
+    soft_links_table = np.empty((len(time_axis_unique),2),dtype=np.int64)
+    if len(time_axis_unique)==0:
+        return soft_links_table
+
+    #Rank of the path of every entry of time_axis. Stable sort ensures that the first
+    #of duplicated path_ids is used:
+    paths_id_sort = np.argsort(paths_id_list,kind='mergesort')
+    paths_rank = paths_id_sort[np.minimum(np.searchsorted(paths_id_list,paths_id_on_time_axis,sorter=paths_id_sort),
+                                          len(paths_id_list)-1)]
+    usable = np.flatnonzero(paths_id_list[paths_rank]==paths_id_on_time_axis)
+
+    #Sort by time, then by rank and finally by position in the table. The first entry
+    #for each time is the one to use:
+    usable = usable[np.lexsort((usable,paths_rank[usable],time_axis[usable]))]
+    first_for_time = np.concatenate(([True],np.diff(time_axis[usable])!=0))
+    usable = usable[first_for_time]
+
+    time_ids = np.minimum(np.searchsorted(time_axis[usable],time_axis_unique),len(usable)-1)
+    if len(usable)==0 or np.any(time_axis[usable][time_ids]!=time_axis_unique):
+        raise ValueError('Variable was not created properly. Must recreate')
+    soft_links_table[:,0] = paths_id_on_time_axis[usable][time_ids]
+    soft_links_table[:,1] = table['indices'][usable][time_ids]
+    return soft_links_table
+
+def record_indices(remote_data,output,var,
+                    time_dim,soft_links_table,record_other_vars):
     #Create descriptive vars:
     #Must use compression, especially for ocean variables in curvilinear coordinates:
     remote_data.safe_handling(netcdf_utils.retrieve_variables_no_time,output,time_dim,zlib=True)
@@ -216,24 +258,13 @@ def record_indices(paths_ordering,
     indices[0] = 'path'
     indices[1] = time_dim
 
-    #Create soft links:
-    paths_id_list = [path_id for path_id in paths_ordering['path_id'] ]
-
     #Replicate variable in main group:
     remote_data.safe_handling(netcdf_utils.replicate_netcdf_var,output,var,zlib=True)
 
     if var in output.variables.keys():
         var_out = output_grp.createVariable(var,np.int64,(time_dim,indices_dim),zlib=True)
-
-        for time_id, time in enumerate(time_axis_unique):
-            #For each time in time_axis_unique, pick path_id in paths_id_list. They
-            #should all be the same. Pick the first one:
-            paths_id_that_can_be_used = np.unique([path_id for path_id in paths_id_on_time_axis[time==time_axis]
-                                            if path_id in paths_id_list])
-            path_id_to_use = [path_id for path_id in paths_id_list
-                                if path_id in paths_id_that_can_be_used][0]
-            var_out[time_id,0] = path_id_to_use
-            var_out[time_id,1] = table[indices_dim][np.logical_and(paths_id_on_time_axis==path_id_to_use,time==time_axis)][0]
+        if len(soft_links_table)>0:
+            var_out[:] = soft_links_table
         if np.ma.count_masked(var_out)>0:
             raise ValueError('Variable was not created properly. Must recreate')
 
@@ -248,22 +279,16 @@ def record_indices(paths_ordering,
             if (not other_var in previous_output_variables_list):
                 var_out = output_grp.createVariable(other_var,np.int64,(time_dim,indices_dim),zlib=True)
                 #Create soft links:
-                for time_id, time in enumerate(time_axis_unique):
-                    #For each time in time_axis_unique, pick path_id in paths_id_list. They
-                    #should all be the same. Pick the first one:
-                    paths_id_that_can_be_used = np.unique([path_id for path_id in paths_id_on_time_axis[time==time_axis]
-                                                    if path_id in paths_id_list])
-                    path_id_to_use = [path_id for path_id in paths_id_list
-                                        if path_id in paths_id_that_can_be_used][0]
-                    var_out[time_id,0] = path_id_to_use
-                    var_out[time_id,1] = table[indices_dim][np.logical_and(paths_id_on_time_axis==path_id_to_use,time==time_axis)][0]
+                if len(soft_links_table)>0:
+                    var_out[:] = soft_links_table
                 if np.ma.count_masked(var_out)>0:
                     raise ValueError('Variable was not created properly. Must recreate')
     output.sync()
     return output
 
 def order_paths_by_preference(sorts_list,id_list,paths_list,file_type_list,data_node_list,check_dimensions,
-                                semaphores=dict(),time_var='time',session=None,remote_netcdf_kwargs=dict()):
+                                semaphores=dict(),time_var='time',session=None,remote_netcdf_kwargs=dict(),
+                                metadata=None,metadata_cache=None,num_workers=1):
     #FIND ORDERING:
     paths_desc = []
     for id in sorts_list:
@@ -289,22 +314,24 @@ def order_paths_by_preference(sorts_list,id_list,paths_list,file_type_list,data_
 
         paths_ordering['file_type'][file_id] = file['file_type']
         paths_ordering['data_node'][file_id] = remote_netcdf.get_data_node(file['path'],paths_ordering['file_type'][file_id])
-        
-        if check_dimensions:
-            #Dimensions types. Find the different dimensions types:
+
+    if check_dimensions:
+        #Dimensions types. Find the different dimensions types:
+        metadata = obtain_file_metadata(paths_ordering,metadata=metadata,
+                                                       semaphores=semaphores,
+                                                       time_var=time_var,
+                                                       session=session,
+                                                       remote_netcdf_kwargs=remote_netcdf_kwargs,
+                                                       metadata_cache=metadata_cache,
+                                                       num_workers=num_workers)
+        for file_id, file in enumerate(paths_list):
             if not paths_ordering['file_type'][file_id] in queryable_file_types:
                 paths_ordering['dimension_type_id'][file_id] = dimension_type_list.index('unqueryable')
             else:
-                remote_data = remote_netcdf.remote_netCDF(paths_ordering['path'][file_id],
-                                                        paths_ordering['file_type'][file_id],
-                                                        semaphores=semaphores,
-                                                        session=session,
-                                                        **remote_netcdf_kwargs)
-                dimension_type = remote_data.safe_handling(netcdf_utils.find_dimension_type,time_var=time_var)
+                dimension_type = metadata[paths_ordering['path'][file_id]]['dimension_type']
                 if not dimension_type in dimension_type_list: dimension_type_list.append(dimension_type)
                 paths_ordering['dimension_type_id'][file_id] = dimension_type_list.index(dimension_type)
 
-    if check_dimensions:
         #Sort by increasing number. Later when we sort, we should get a uniform type:
         dimension_type_list_number = [ sum(paths_ordering['dimension_type_id']==dimension_type_id)
                                         for dimension_type_id,dimension_type in enumerate(dimension_type_list)]
@@ -323,30 +350,41 @@ def order_paths_by_preference(sorts_list,id_list,paths_list,file_type_list,data_
     #sort and reverse order to get from most to least:
     return np.sort(paths_ordering,order = sorts_list)[::-1]
 
-def _recover_date(path,time_frequency,is_instant,calendar,semaphores=dict(),time_var='time',session=None,remote_netcdf_kwargs=dict()):
+def _recover_date(path,time_frequency,is_instant,calendar,semaphores=dict(),time_var='time',session=None,remote_netcdf_kwargs=dict(),
+                  metadata=dict()):
     file_type = path['file_type']
     path_name = str(path['path']).split('|')[0]
-    remote_data = remote_netcdf.remote_netCDF(path_name,
-                                            file_type,
-                                            semaphores=semaphores,
-                                            session=session,
-                                            **remote_netcdf_kwargs)
-    try:
-        date_axis = remote_data.get_time(time_frequency=time_frequency,
-                                        is_instant=is_instant,
-                                        time_var=time_var,
-                                        calendar=calendar)
-    except dodsError:
-        #No time axis, return empty arrays:
-        return np.array([]), np.array([], dtype=table_desc)
-        
-    time_units = remote_data.get_time_units(calendar,time_var=time_var)
     table_desc = [
                ('paths','a255'),
                ('file_type','a255'),
                ('time_units','a255'),
                ('indices','int64')
                ] + [(unique_file_id,'a255') for unique_file_id in unique_file_id_list]
+    if ( path_name in metadata and
+         file_type in remote_netcdf.queryable_file_types ):
+        #The time axis was already retrieved with the file metadata:
+        record = metadata[path_name]
+        if len(record['time_axis'])>0:
+            date_axis = netcdf_utils.create_date_axis_from_time_axis(record['time_axis'], record['time_attributes'])
+        else:
+            date_axis = np.array([])
+        time_units = record['units']
+    else:
+        remote_data = remote_netcdf.remote_netCDF(path_name,
+                                                file_type,
+                                                semaphores=semaphores,
+                                                session=session,
+                                                **remote_netcdf_kwargs)
+        try:
+            date_axis = remote_data.get_time(time_frequency=time_frequency,
+                                            is_instant=is_instant,
+                                            time_var=time_var,
+                                            calendar=calendar)
+        except dodsError:
+            #No time axis, return empty arrays:
+            return np.array([]), np.array([], dtype=table_desc)
+
+        time_units = remote_data.get_time_units(calendar,time_var=time_var)
     if len(date_axis)>0:
         table = np.empty(date_axis.shape, dtype=table_desc)
         if len(date_axis)>0:
@@ -361,17 +399,27 @@ def _recover_date(path,time_frequency,is_instant,calendar,semaphores=dict(),time
         #No time axis, return empty arrays:
         return np.array([]), np.array([], dtype=table_desc)
 
-def obtain_date_axis(paths_ordering,time_frequency,is_instant,calendar,semaphores=dict(),time_var='time',session=None,remote_netcdf_kwargs=dict()):
+def obtain_date_axis(paths_ordering,time_frequency,is_instant,calendar,semaphores=dict(),time_var='time',session=None,remote_netcdf_kwargs=dict(),
+                     metadata=None,metadata_cache=None,num_workers=1):
     #Retrieve time axes from queryable file types or reconstruct time axes from time stamp
     #from non-queryable file types.
+    metadata = obtain_file_metadata(paths_ordering,metadata=metadata,
+                                                   semaphores=semaphores,
+                                                   time_var=time_var,
+                                                   session=session,
+                                                   remote_netcdf_kwargs=remote_netcdf_kwargs,
+                                                   metadata_cache=metadata_cache,
+                                                   num_workers=num_workers)
     date_axis, table =  map(np.concatenate,
-                    zip(*map(lambda x:_recover_date(x,time_frequency,
+                    zip(*_map_paths(lambda x:_recover_date(x,time_frequency,
                                                       is_instant,
                                                       calendar,
                                                       semaphores=semaphores,
                                                       time_var=time_var,
                                                       session=session,
-                                                      remote_netcdf_kwargs=remote_netcdf_kwargs),np.nditer(paths_ordering))))
+                                                      remote_netcdf_kwargs=remote_netcdf_kwargs,
+                                                      metadata=metadata),paths_ordering,
+                                                      num_workers=num_workers)))
     if len(date_axis)>0:
         #If all files have the same time units, use this one. Otherwise, create a new one:
         unique_date_units = _drop_none(np.unique(table['time_units']))
@@ -388,7 +436,31 @@ def obtain_date_axis(paths_ordering,time_frequency,is_instant,calendar,semaphore
 def _drop_none(arr):
     return arr[arr != np.array(None)]
 
-def _recover_calendar(path,semaphores=dict(),time_var='time',session=None,remote_netcdf_kwargs=dict()):
+def _map_paths(function_handle,paths_ordering,num_workers=1):
+    #Apply function_handle to every path. Results are returned in the order of paths_ordering.
+    #Per-data-node limits are enforced by the semaphores used when each file is opened.
+    #Only remote paths are retrieved concurrently: netCDF4 and HDF5 are not thread-safe:
+    paths = list(np.nditer(paths_ordering))
+    remote_ids = [ path_id for path_id, path in enumerate(paths)
+                   if str(path['file_type']) in remote_netcdf.remote_file_types ]
+    if num_workers>1 and len(remote_ids)>1:
+        results = [ None for path in paths ]
+        pool = ThreadPool(min(num_workers,len(remote_ids)))
+        try:
+            for path_id, result in zip(remote_ids,pool.map(function_handle,[paths[path_id] for path_id in remote_ids],chunksize=1)):
+                results[path_id] = result
+        finally:
+            pool.close()
+            pool.join()
+        remote_ids = set(remote_ids)
+        for path_id, path in enumerate(paths):
+            if not path_id in remote_ids:
+                results[path_id] = function_handle(path)
+        return results
+    else:
+        return map(function_handle,paths)
+
+def _recover_metadata(path,semaphores=dict(),time_var='time',session=None,remote_netcdf_kwargs=dict()):
     file_type = path['file_type']
     path_name = str(path['path']).split('|')[0]
     remote_data = remote_netcdf.remote_netCDF(path_name,
@@ -396,14 +468,45 @@ def _recover_calendar(path,semaphores=dict(),time_var='time',session=None,remote
                                             semaphores=semaphores,
                                             session=session,
                                             **remote_netcdf_kwargs)
-    calendar = remote_data.get_calendar(time_var=time_var)
-    return calendar, file_type 
-
-def obtain_unique_calendar(paths_ordering,semaphores=dict(),time_var='time',session=None,remote_netcdf_kwargs=dict()):
-    calendar_list,file_type_list=zip(*map(lambda x:_recover_calendar(x,semaphores=semaphores,
-                                                                        time_var=time_var,
-                                                                        session=session,
-                                                                        remote_netcdf_kwargs=remote_netcdf_kwargs),np.nditer(paths_ordering)))
+    return remote_data.get_file_metadata(time_var=time_var)
+
+def obtain_file_metadata(paths_ordering,metadata=None,semaphores=dict(),time_var='time',session=None,remote_netcdf_kwargs=dict(),
+                         metadata_cache=None,num_workers=1):
+    #Retrieve the calendar, time units, time axis, dimension type and variables of each file
+    #in a single access. Only paths that are not already in metadata are accessed:
+    if metadata is None:
+        metadata = dict()
+    missing_paths = np.array([not path in metadata for path in paths_ordering['path']], dtype=np.bool)
+    if metadata_cache is not None:
+        #Use records from previous validations:
+        for file_id in np.flatnonzero(missing_paths):
+            record = metadata_cache.get(paths_ordering[file_id])
+            if record is not None:
+                metadata[paths_ordering['path'][file_id]] = record
+                missing_paths[file_id] = False
+    if np.any(missing_paths):
+        records = _map_paths(lambda x:_recover_metadata(x,semaphores=semaphores,
+                                                          time_var=time_var,
+                                                          session=session,
+                                                          remote_netcdf_kwargs=remote_netcdf_kwargs),paths_ordering[missing_paths],
+                                                          num_workers=num_workers)
+        metadata.update(zip(paths_ordering['path'][missing_paths],records))
+        if metadata_cache is not None:
+            for path, record in zip(paths_ordering[missing_paths],records):
+                metadata_cache.put(path,record)
+    return metadata
+
+def obtain_unique_calendar(paths_ordering,semaphores=dict(),time_var='time',session=None,remote_netcdf_kwargs=dict(),
+                           metadata=None,metadata_cache=None,num_workers=1):
+    metadata = obtain_file_metadata(paths_ordering,metadata=metadata,
+                                                   semaphores=semaphores,
+                                                   time_var=time_var,
+                                                   session=session,
+                                                   remote_netcdf_kwargs=remote_netcdf_kwargs,
+                                                   metadata_cache=metadata_cache,
+                                                   num_workers=num_workers)
+    calendar_list = [metadata[path]['calendar'] for path in paths_ordering['path']]
+    file_type_list = list(paths_ordering['file_type'])
     #Find the calendars found from queryable file types:
     calendars = set([item[0] for item in zip(calendar_list,file_type_list) if item[1] in queryable_file_types])
     if len(calendars)==1:
@@ -412,53 +515,49 @@ def obtain_unique_calendar(paths_ordering,semaphores=dict(),time_var='time',sess
 
 def reduce_paths_ordering(time_axis,time_axis_unique,paths_ordering,table):
     #CREATE LOOK-UP TABLE:
-    paths_indices_on_time_axis = np.empty(time_axis.shape,dtype=np.int64)
-    paths_id_on_time_axis = np.empty(time_axis.shape,dtype=np.int64)
+    paths_list = paths_ordering['path']
+    paths_id_list = paths_ordering['path_id']
 
-    paths_list = list(paths_ordering['path'])
-    paths_id_list = list(paths_ordering['path_id'])
-    #for path_id, path in zip(paths_id_list,paths_list):
-    for path_index, (path_id, path) in enumerate(zip(paths_id_list,paths_list)):
-        #find in table the path and assign path_index to it:
-        paths_indices_on_time_axis[path==table['paths']] = path_index
-        paths_id_on_time_axis[path==table['paths']] = path_id
+    #Map each path to its index in paths_ordering. If a path is repeated, the last one is used:
+    path_to_index = dict(zip(paths_list,range(len(paths_list))))
+    table_paths_unique, table_paths_inverse = np.unique(table['paths'],return_inverse=True)
+    paths_indices_on_time_axis = np.array([path_to_index[path] for path in table_paths_unique],
+                                          dtype=np.int64)[table_paths_inverse]
+    paths_id_on_time_axis = paths_id_list[paths_indices_on_time_axis]
 
     #Remove paths that are not necessary over the requested time range:
-    #First, list the paths_id used:
-    #Pick the lowest path index so that we follow the paths_ordering:
-    useful_paths_id_list_unique = list(
-                                np.unique(
-                                    [paths_id_list[np.min(paths_indices_on_time_axis[time==time_axis])] 
-                                        for time_id, time in enumerate(time_axis_unique)]))
-
-    #Second, list the path_names corresponding to these paths_id:
-    #useful_file_name_list=[useful_path_id.split('/')[-1] for useful_path_id in 
-    #                        [path for path_id, path in zip(paths_id_list,paths_list)
-    #                                if path_id in useful_paths_id_list_unique] ]
-    useful_file_name_list_unique = [paths_list[paths_id_list.index(path_id)].split('/')[-1]
-                                        for path_id in useful_paths_id_list_unique]
+    #First, list the paths_id used.
+    #Pick the lowest path index so that we follow the paths_ordering. Sort by time
+    #and then by path index. The first entry for each time has the lowest path index:
+    time_sort = np.lexsort((paths_indices_on_time_axis,time_axis))
+    first_for_time = np.concatenate(([True],np.diff(time_axis[time_sort])!=0))
+    lowest_index_for_time = paths_indices_on_time_axis[time_sort][first_for_time]
+    time_ids = np.searchsorted(time_axis[time_sort][first_for_time],time_axis_unique)
+    useful_paths_id_list_unique = np.unique(paths_id_list[lowest_index_for_time[time_ids]])
+
+    #Second, list the file names corresponding to these paths_id:
+    first_file_id = dict()
+    for file_id, path_id in enumerate(paths_id_list):
+        first_file_id.setdefault(path_id,file_id)
+    equivalent_file_id = dict()
+    for path_id in useful_paths_id_list_unique:
+        equivalent_file_id.setdefault(paths_list[first_file_id[path_id]].split('/')[-1],first_file_id[path_id])
 
     #Find the indices to keep:
-    useful_file_id_list = [file_id for file_id, file in enumerate(paths_ordering)
-                            if paths_ordering['path_id'][file_id] in useful_paths_id_list_unique]
-                            
+    is_useful = np.in1d(paths_id_list,useful_paths_id_list_unique)
+    useful_file_id_list = list(np.flatnonzero(is_useful))
+
     #Finally, check if some equivalent indices are worth keeping:
-    for file_id, file in enumerate(paths_ordering):
-        if not paths_ordering['path_id'][file_id] in useful_paths_id_list_unique:
-            #This file was not kept but it might be the same data, in which
-            #case we would like to keep it.
-            #Find the file name (remove path):
-            file_name = paths_ordering['path'][file_id].split('/')[-1]
-            if file_name in useful_file_name_list_unique:
-                #If the file name is useful, find its path_id: 
-                equivalent_path_id = useful_paths_id_list_unique[useful_file_name_list_unique.index(file_name)]
-                    
-                #Use this to find its file_id:
-                equivalent_file_id = list(paths_ordering['path_id']).index(equivalent_path_id)
-                #Then check if the checksum are the same. If yes, keep the file!
-                if paths_ordering['checksum'][file_id]==paths_ordering['checksum'][equivalent_file_id]:
-                    useful_file_id_list.append(file_id)
-            
+    for file_id in np.flatnonzero(np.logical_not(is_useful)):
+        #This file was not kept but it might be the same data, in which
+        #case we would like to keep it.
+        #Find the file name (remove path):
+        file_name = paths_list[file_id].split('/')[-1]
+        #Then check if the checksum are the same. If yes, keep the file!
+        if ( file_name in equivalent_file_id and
+             paths_ordering['checksum'][file_id]==paths_ordering['checksum'][equivalent_file_id[file_name]] ):
+            useful_file_id_list.append(file_id)
+
     #Sort paths_ordering:
     if len(useful_file_id_list)>0:
         return paths_ordering[np.sort(useful_file_id_list)],paths_id_on_time_axis
@@ -469,29 +568,26 @@ def unique_time_axis(date_axis,units,calendar,years,months):
     time_axis = netcdf_utils.get_time_axis_relative(date_axis,units,calendar)
     time_axis_unique = np.unique(time_axis)
 
-    date_axis_unique = netcdf_utils.get_date_axis_relative(time_axis_unique,units,calendar)
-
     #Include a filter on years and months: 
-    time_desc = {}
+    years_axis, months_axis = netcdf_utils.get_date_components(time_axis_unique,units,calendar)[:2]
+    valid_times = np.ones(time_axis_unique.shape,dtype=np.bool)
     if years!=None:
         if years[0]<10:
             #This is important for piControl
-            temp_years = list(np.array(years)+np.min([date.year for date in date_axis_unique]))
-            #min_year = np.min([date.year for date in date_axis_unique])
+            temp_years = list(np.array(years)+np.min(years_axis))
         else:
             temp_years = years
-        if months!=None:
-            valid_times = np.array([True if (date.year in temp_years and 
-                                     date.month in months) else False for date in  date_axis_unique])
-        else:
-            valid_times = np.array([True if date.year in temp_years else False for date in  date_axis_unique])
+        valid_times = np.logical_and(valid_times,np.isin(years_axis,temp_years))
+    if months!=None:
+        valid_times = np.logical_and(valid_times,np.isin(months_axis,months))
+
+    #Only create dates for the valid times:
+    time_axis_unique = time_axis_unique[valid_times]
+    if len(time_axis_unique)>0:
+        date_axis_unique = netcdf_utils.get_date_axis_relative(time_axis_unique,units,calendar)
     else:
-        if months!=None:
-            valid_times = np.array([True if date.month in months else False for date in  date_axis_unique])
-        else:
-            valid_times = np.array([True for date in  date_axis_unique])
-        
+        date_axis_unique = np.array([])
     #self.time_axis_unique = time_axis_unique[valid_times]
     #self.date_axis_unique = date_axis_unique[valid_times]
     #self.time_axis = time_axis
-    return time_axis, time_axis_unique[valid_times], date_axis_unique[valid_times]
+    return time_axis, time_axis_unique, date_axis_unique
@@ -0,0 +1,141 @@
+#External:
+import os
+import time
+import datetime
+import sqlite3
+import cPickle as pickle
+
+#Internal:
+from ..remote_netcdf import remote_netcdf
+
+unique_file_id_list = ['checksum_type', 'checksum', 'tracking_id']
+
+class file_metadata_cache:
+    #Persistent cache of file metadata records (calendar, time units, time axis, ...).
+    #Records are keyed by path and unique file ids so that a modified file is never
+    #matched with stale metadata.
+    def __init__(self, cache_dir,
+                 expire_after=datetime.timedelta(days=30),
+                 max_size=100.0,
+                 timeout=5.0):
+        self.cache_dir = os.path.abspath(os.path.expanduser(os.path.expandvars(cache_dir)))
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.file_name = os.path.join(self.cache_dir, 'nc4sl_metadata.sqlite')
+        self.expire_after = expire_after
+        #maximum size in Mb:
+        self.max_size = max_size
+        #seconds to wait for a cache locked by another process:
+        self.timeout = timeout
+        try:
+            self._connect()
+        except sqlite3.DatabaseError:
+            #Corrupted cache:
+            try:
+                os.remove(self.file_name)
+            except:
+                pass
+            self._connect()
+        self.evict()
+        return
+
+    def _connect(self):
+        self.connection = sqlite3.connect(self.file_name, timeout=self.timeout)
+        try:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS metadata
+                                       (key TEXT PRIMARY KEY, created REAL, accessed REAL,
+                                        size INTEGER, record BLOB)''')
+            self.connection.commit()
+        except sqlite3.OperationalError:
+            #The cache is locked by another process, it is not corrupted. Records are
+            #neither read nor written while it is locked:
+            self.connection.rollback()
+        return
+
+    def get(self, path):
+        key = cache_key(path)
+        if key is None: return None
+        try:
+            row = self.connection.execute('SELECT created, record FROM metadata WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            if time.time() - row[0] > self.expire_after.total_seconds():
+                self.connection.execute('DELETE FROM metadata WHERE key=?', (key,))
+                self.connection.commit()
+                return None
+            self.connection.execute('UPDATE metadata SET accessed=? WHERE key=?', (time.time(), key))
+            self.connection.commit()
+        except sqlite3.OperationalError:
+            #The cache is locked by another process. The metadata is read from the file instead:
+            self.connection.rollback()
+            return None
+        return pickle.loads(str(row[1]))
+
+    def put(self, path, record):
+        key = cache_key(path)
+        if key is None: return
+        blob = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        try:
+            self.connection.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)',
+                                    (key, now, now, len(blob), sqlite3.Binary(blob)))
+            self.connection.commit()
+        except sqlite3.OperationalError:
+            #The cache is locked by another process. Do not cache this record:
+            self.connection.rollback()
+        return
+
+    def evict(self):
+        try:
+            #First remove expired records:
+            self.connection.execute('DELETE FROM metadata WHERE created<?',
+                                    (time.time() - self.expire_after.total_seconds(),))
+            #Then remove least recently accessed records until the cache fits max_size:
+            total_size = self.connection.execute('SELECT COALESCE(SUM(size),0) FROM metadata').fetchone()[0]
+            max_size = self.max_size*1024*1024
+            if total_size > max_size:
+                for key, size in self.connection.execute('SELECT key, size FROM metadata ORDER BY accessed').fetchall():
+                    if total_size <= max_size:
+                        break
+                    self.connection.execute('DELETE FROM metadata WHERE key=?', (key,))
+                    total_size -= size
+            self.connection.commit()
+        except sqlite3.OperationalError:
+            #The cache is locked by another process. Evict next time:
+            self.connection.rollback()
+        return
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+        return
+
+def cache_key(path):
+    file_type = str(path['file_type'])
+    path_name = str(path['path']).split('|')[0]
+    if file_type == 'local_file':
+        #Local files are identified by their modification time and size:
+        try:
+            stat = os.stat(local_file_name(path_name))
+        except OSError:
+            return None
+        return '|'.join([path_name, repr(stat.st_mtime), str(stat.st_size)])
+    elif file_type in remote_netcdf.remote_queryable_file_types:
+        #Remote files are identified by their checksum or tracking_id when they are known.
+        #Otherwise, the url alone is used and records are trusted until they expire:
+        return '|'.join([path_name] +
+                        [str(path[unique_file_id]) for unique_file_id in unique_file_id_list])
+    return None
+
+def local_file_name(path_name):
+    #Validated local paths are prefixed with the host name:
+    if not os.path.exists(path_name) and ':' in path_name.split('/')[0]:
+        return path_name.split(':',1)[1]
+    return path_name
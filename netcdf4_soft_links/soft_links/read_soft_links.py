@@ -5,6 +5,7 @@ import os
 import copy
 import datetime
 import tempfile
+from collections import OrderedDict
 
 #Internal:
 from ..remote_netcdf import remote_netcdf,http_netcdf
@@ -12,6 +13,10 @@ from .. import netcdf_utils, indices_utils, queues_manager
 
 file_unique_id_list=['checksum_type','checksum','tracking_id']
 
+#The variables retrieved together from a path are sent back as one result.
+#Maximum estimated size of such a batch, in Mb:
+max_batch_size=450.0
+
 def _nonzeroprod(x):
     return np.prod(np.asarray(x)[np.nonzero(x)])
 
@@ -28,6 +33,7 @@ class read_netCDF_pointers:
                     next=0,
                     requested_time_restriction=[],
                     time_var='time',
+                    waste_ratio=0.5,
                     q_manager=None,
                     session=None,
                     remote_netcdf_kwargs={}):
@@ -38,23 +44,26 @@ class read_netCDF_pointers:
 
         self.download_all_files=download_all_files
         self.download_all_opendap=download_all_opendap
+        self.waste_ratio=waste_ratio
 
         self.time_var = netcdf_utils.find_time_var(self.data_root,time_var=time_var)
         if self.time_var!=None and len(self.data_root.variables[self.time_var])>0:
             #Then find time axis, time restriction and which variables to retrieve:
-            self.date_axis = netcdf_utils.get_date_axis(self.data_root,self.time_var)
+            self._date_axis = None
             self.time_axis = self.data_root.variables[self.time_var][:]
-            if len(requested_time_restriction) == len(self.date_axis):
+            if len(requested_time_restriction) == len(self.time_axis):
                 self.time_restriction = np.array(requested_time_restriction)
             else:
-                self.time_restriction = get_time_restriction(self.date_axis, self.time_axis,
+                date_components = netcdf_utils.get_date_components_from_dataset(self.data_root,self.time_var)
+                self.time_restriction = get_time_restriction(None, self.time_axis,
                                                              min_year=min_year,
                                                              years=year,months=month,days=day,hours=hour,
-                                                             previous=previous,next=next)
+                                                             previous=previous,next=next,
+                                                             date_components=date_components)
             #time sorting:
             self.time_restriction_sort = np.argsort(self.time_axis[self.time_restriction])
         else:
-            self.time_axis,self.date_axis, self.time_restriction, self.time_restriction_sort=np.array([]),np.array([]),np.array([]),np.array([])
+            self.time_axis,self._date_axis, self.time_restriction, self.time_restriction_sort=np.array([]),np.array([]),np.array([]),np.array([])
 
         #Set retrieveable variables:
         if 'soft_links' in self.data_root.groups:
@@ -66,6 +75,9 @@ class read_netCDF_pointers:
             #Get list of paths:
             for path_desc in ['path','path_id','file_type','version']+file_unique_id_list:
                 setattr(self,path_desc+'_list',self.data_root.groups['soft_links'].variables[path_desc][:])
+            #Lookup tables for paths and replicas:
+            self.path_index=remote_netcdf.paths_index(self.path_list)
+            self.checksum_index=remote_netcdf.checksums_index(self.checksum_list)
         else:
             self.retrievable_vars=[var for var in self.data_root.variables]
 
@@ -75,6 +87,13 @@ class read_netCDF_pointers:
         self.retrievable_vars = list(np.array(self.retrievable_vars)[size_retrievable_vars_sort])
         return
 
+    @property
+    def date_axis(self):
+        #Date objects are slow to create. Only create them when needed:
+        if self._date_axis is None:
+            self._date_axis = netcdf_utils.get_date_axis(self.data_root,self.time_var)
+        return self._date_axis
+
     def replicate(self,output,check_empty=False,chunksize=None):
         #replicate attributes
         netcdf_utils.replicate_netcdf_file(self.data_root,output)
@@ -168,8 +187,10 @@ class read_netCDF_pointers:
                             output_grp.variables[var_name][:] = self.data_root.groups['soft_links'].variables[var_name][:]
 
             self.paths_sent_for_retrieval=[]
+            self.download_plan=OrderedDict()
             for var_to_retrieve in self.retrievable_vars:
                 self._retrieve_variable(output,var_to_retrieve)
+            self._send_download_plan(output)
         else:
             #Fixed variable. Do not retrieve, just copy:
             for var in self.retrievable_vars:
@@ -206,35 +227,85 @@ class read_netCDF_pointers:
         #Sort the paths so that we query each only once:
         unique_path_list_id, self.sorting_paths=np.unique(self.paths_link,return_inverse=True)
 
+        #Check concurrently the availability of the paths and of their replicas:
+        self._probe_paths(unique_path_list_id)
+
         for unique_path_id, path_id in enumerate(unique_path_list_id):
             self._retrieve_path_to_variable(unique_path_id,path_id,output,var_to_retrieve)
         return
 
+    def _probe_paths(self,path_id_list):
+        #Only probe the file types that _retrieve_path_to_variable accepts:
+        if self.retrieval_type=='download_files':
+            acceptable_file_types=remote_netcdf.downloadable_file_types
+            if not self.download_all_files:
+                acceptable_file_types=acceptable_file_types+remote_netcdf.remote_queryable_file_types
+        elif self.retrieval_type=='download_opendap':
+            acceptable_file_types=remote_netcdf.remote_queryable_file_types
+        elif self.retrieval_type=='assign':
+            acceptable_file_types=remote_netcdf.queryable_file_types
+        else:
+            #Only local files are retrieved:
+            return
+        probe_id_list=set()
+        for path_id in path_id_list:
+            checksum=self.checksum_list[path_id]
+            if checksum=='':
+                #Paths without a checksum have no known replicas:
+                probe_id_list.add(path_id)
+            else:
+                probe_id_list.update(self.checksum_index[checksum])
+        probe_id_list=sorted([ path_id for path_id in probe_id_list
+                               if self.file_type_list[path_id] in acceptable_file_types ])
+        if len(probe_id_list)==0:
+            return
+        if 'semaphores' in dir(self.q_manager):
+            semaphores=self.q_manager.semaphores
+        else:
+            semaphores=dict()
+        if 'health' in dir(self.q_manager):
+            health=self.q_manager.health
+        else:
+            health=None
+        remote_netcdf.probe_availability([self.path_list[path_id] for path_id in probe_id_list],
+                                         [self.file_type_list[path_id] for path_id in probe_id_list],
+                                         num_trials=2,
+                                         semaphores=semaphores,
+                                         health=health,
+                                         session=self.session,
+                                         **self.remote_netcdf_kwargs)
+        return
+
     def _retrieve_path_to_variable(self,unique_path_id,path_id,output,var_to_retrieve):
         path_to_retrieve=self.path_list[path_id]
 
         #Next, we check if the file is available. If it is not we replace it
         #with another file with the same checksum, if there is one!
-        file_type=self.file_type_list[list(self.path_list).index(path_to_retrieve)]
+        file_type=self.file_type_list[self.path_index[path_to_retrieve]]
         if 'semaphores' in dir(self.q_manager):
             semaphores=self.q_manager.semaphores
         else:
             semaphores=dict()
+        if 'health' in dir(self.q_manager):
+            health=self.q_manager.health
+        else:
+            health=None
         remote_data=remote_netcdf.remote_netCDF(path_to_retrieve,
                                                 file_type,
                                                 semaphores=semaphores,
+                                                health=health,
                                                 session=self.session,
                                                 **self.remote_netcdf_kwargs)
 
         #See if the available path is available for download and find alternative:
         if self.retrieval_type=='download_files':
-            path_to_retrieve=remote_data.check_if_available_and_find_alternative(self.path_list,self.file_type_list,self.checksum_list,remote_netcdf.downloadable_file_types,num_trials=2)
+            path_to_retrieve=remote_data.check_if_available_and_find_alternative(self.path_list,self.file_type_list,self.checksum_list,remote_netcdf.downloadable_file_types,num_trials=2,path_index=self.path_index,checksum_index=self.checksum_index)
         elif self.retrieval_type=='download_opendap':
-            path_to_retrieve=remote_data.check_if_available_and_find_alternative(self.path_list,self.file_type_list,self.checksum_list,remote_netcdf.remote_queryable_file_types,num_trials=2)
+            path_to_retrieve=remote_data.check_if_available_and_find_alternative(self.path_list,self.file_type_list,self.checksum_list,remote_netcdf.remote_queryable_file_types,num_trials=2,path_index=self.path_index,checksum_index=self.checksum_index)
         elif self.retrieval_type=='load':
-            path_to_retrieve=remote_data.check_if_available_and_find_alternative(self.path_list,self.file_type_list,self.checksum_list,remote_netcdf.local_queryable_file_types,num_trials=2)
+            path_to_retrieve=remote_data.check_if_available_and_find_alternative(self.path_list,self.file_type_list,self.checksum_list,remote_netcdf.local_queryable_file_types,num_trials=2,path_index=self.path_index,checksum_index=self.checksum_index)
         elif self.retrieval_type=='assign':
-            path_to_retrieve=remote_data.check_if_available_and_find_alternative(self.path_list,self.file_type_list,self.checksum_list,remote_netcdf.queryable_file_types,num_trials=2)
+            path_to_retrieve=remote_data.check_if_available_and_find_alternative(self.path_list,self.file_type_list,self.checksum_list,remote_netcdf.queryable_file_types,num_trials=2,path_index=self.path_index,checksum_index=self.checksum_index)
 
         if path_to_retrieve is None:
             #Do not retrieve!
@@ -244,18 +315,19 @@ class read_netCDF_pointers:
         if self.retrieval_type=='download_files' and not self.download_all_files:
             alt_path_to_retrieve=remote_data.check_if_available_and_find_alternative(self.path_list,self.file_type_list,self.checksum_list,
                                                                 remote_netcdf.remote_queryable_file_types+
-                                                                remote_netcdf.local_queryable_file_types,num_trials=2)
+                                                                remote_netcdf.local_queryable_file_types,num_trials=2,
+                                                                path_index=self.path_index,checksum_index=self.checksum_index)
             #Do not retrieve if a 'better' file type exists and is available
             if alt_path_to_retrieve!=None: return
         elif self.retrieval_type=='download_opendap' and not self.download_all_opendap:
-            alt_path_to_retrieve=remote_data.check_if_available_and_find_alternative(self.path_list,self.file_type_list,self.checksum_list,remote_netcdf.local_queryable_file_types,num_trials=2)
+            alt_path_to_retrieve=remote_data.check_if_available_and_find_alternative(self.path_list,self.file_type_list,self.checksum_list,remote_netcdf.local_queryable_file_types,num_trials=2,path_index=self.path_index,checksum_index=self.checksum_index)
             #Do not retrieve if a 'better' file type exists and is available
             if alt_path_to_retrieve!=None: return
         elif self.retrieval_type=='assign':
-            path_to_retrieve=remote_data.check_if_available_and_find_alternative(self.path_list,self.file_type_list,self.checksum_list,remote_netcdf.local_queryable_file_types,num_trials=2)
+            path_to_retrieve=remote_data.check_if_available_and_find_alternative(self.path_list,self.file_type_list,self.checksum_list,remote_netcdf.local_queryable_file_types,num_trials=2,path_index=self.path_index,checksum_index=self.checksum_index)
             
         #Get the file_type, checksum and version of the file to retrieve:
-        path_index=list(self.path_list).index(path_to_retrieve)
+        path_index=self.path_index[path_to_retrieve]
         file_type=self.file_type_list[path_index]
         version='v'+str(self.version_list[path_index])
         checksum=self.checksum_list[path_index]
@@ -283,9 +355,11 @@ class read_netCDF_pointers:
                 self._add_path_to_soft_links(new_path,new_file_type,path_index,self.sorting_paths==unique_path_id,output.groups['soft_links'],var_to_retrieve)
 
             sort_table=np.arange(len(self.sorting_paths))[self.sorting_paths==unique_path_id]
-            download_kwargs={'dimensions':self.dimensions,
-                             'unsort_dimensions':self.unsort_dimensions,
-                             'sort_table':sort_table
+            #Copy the dimensions because the time dimension is replaced for every path:
+            download_kwargs={'dimensions':copy.copy(self.dimensions),
+                             'unsort_dimensions':copy.copy(self.unsort_dimensions),
+                             'sort_table':sort_table,
+                             'waste_ratio':self.waste_ratio
                              }
 
             #Keep a list of paths sent for retrieval:
@@ -300,15 +374,13 @@ class read_netCDF_pointers:
                                                                 sort_table,max_request)
                 result=(retrieved_data, sort_table, self.tree+[var_to_retrieve,])
                 assign_leaf(output,*result)
-            elif file_type in remote_netcdf.remote_queryable_file_types:
-                data_node=remote_netcdf.get_data_node(path_to_retrieve,file_type)
-                #Send to the download queue:
-                self.q_manager.put_to_data_node(data_node,download_args+(download_kwargs,))
-            elif file_type in remote_netcdf.local_queryable_file_types:
-                #Load and simply assign:
-                remote_data=remote_netcdf.remote_netCDF(path_to_retrieve,file_type)
-                result=remote_data.download(*download_args[3:],download_kwargs=download_kwargs)
-                assign_leaf(output,*result)
+            elif ( file_type in remote_netcdf.remote_queryable_file_types or
+                   file_type in remote_netcdf.local_queryable_file_types ):
+                #Variables from the same path are retrieved together:
+                if not path_to_retrieve in self.download_plan:
+                    self.download_plan[path_to_retrieve]=(file_type,[],[])
+                self.download_plan[path_to_retrieve][1].append(var_to_retrieve)
+                self.download_plan[path_to_retrieve][2].append(download_kwargs)
         else:
             if not path_to_retrieve in self.paths_sent_for_retrieval:
                 new_path=http_netcdf.destination_download_files(self.path_list[path_index],
@@ -330,6 +402,29 @@ class read_netCDF_pointers:
                 self.q_manager.put_to_data_node(data_node,download_args+(download_kwargs,))
         return 
 
+    def _send_download_plan(self,output):
+        #Each path is accessed once for all the variables it provides:
+        for path_to_retrieve in self.download_plan:
+            file_type, var_list, download_kwargs_list = self.download_plan[path_to_retrieve]
+            download_args=(0,path_to_retrieve,file_type,var_list,self.tree)
+            if file_type in remote_netcdf.remote_queryable_file_types:
+                data_node=remote_netcdf.get_data_node(path_to_retrieve,file_type)
+                sizes=[ indices_utils.bytes_per_element(self.data_root.variables[var])*
+                        np.prod([len(download_kwargs['dimensions'][dim]) for dim in download_kwargs['dimensions']])/1024.0**2
+                        for var, download_kwargs in zip(var_list,download_kwargs_list) ]
+                for batch in batches_by_size(sizes,max_batch_size):
+                    #Send to the download queue:
+                    self.q_manager.put_to_data_node(data_node,(0,path_to_retrieve,file_type,
+                                                               [var_list[var_id] for var_id in batch],self.tree,
+                                                               [download_kwargs_list[var_id] for var_id in batch]))
+            else:
+                #Load and simply assign:
+                remote_data=remote_netcdf.remote_netCDF(path_to_retrieve,file_type)
+                for result in remote_data.download_batch(*download_args[3:],download_kwargs_list=download_kwargs_list):
+                    assign_leaf(output,*result)
+        self.download_plan=OrderedDict()
+        return
+
     def _add_path_to_soft_links(self,new_path,new_file_type,path_index,time_indices_to_replace,output,var_to_retrieve):
         if not new_path in output.variables['path'][:]:
             output.variables['path'][len(output.dimensions['path'])]=new_path
@@ -363,10 +458,12 @@ class read_netCDF_pointers:
         self.retrieval_type='assign'
         self.out_dir='.'
         self.paths_sent_for_retrieval=[]
+        self.download_plan=OrderedDict()
      
         self.output_root.createGroup(var_to_retrieve)
         netcdf_utils.create_time_axis(self.data_root,self.output_root.groups[var_to_retrieve],self.time_axis[self.time_restriction][self.time_restriction_sort])
         self._retrieve_variable(self.output_root.groups[var_to_retrieve],var_to_retrieve)
+        self._send_download_plan(self.output_root.groups[var_to_retrieve])
        
         for var in self.output_root.groups[var_to_retrieve].variables:
             self.variables[var]=self.output_root.groups[var_to_retrieve].variables[var]
@@ -391,52 +488,51 @@ def add_previous(time_restriction):
 def add_next(time_restriction):
     return np.logical_or(time_restriction,np.insert(time_restriction[:-1],0,False))
 
-def time_restriction_years(min_year,years,date_axis,time_restriction_any):
+def time_restriction_years(min_year,years,years_axis,time_restriction_any):
     if years!=None:
-        years_axis=np.array([date.year for date in date_axis])
         if min_year!=None:
             #Important for piControl:
-            time_restriction=np.logical_and(time_restriction_any, [True if year in years else False for year in years_axis-years_axis.min()+min_year])
+            time_restriction=np.logical_and(time_restriction_any, np.isin(years_axis-years_axis.min()+min_year,years))
         else:
-            time_restriction=np.logical_and(time_restriction_any, [True if year in years else False for year in years_axis])
+            time_restriction=np.logical_and(time_restriction_any, np.isin(years_axis,years))
         return time_restriction
     else:
         return time_restriction_any
 
-def time_restriction_months(months,date_axis,time_restriction_for_years):
+def time_restriction_months(months,months_axis,time_restriction_for_years):
     if months!=None:
-        months_axis=np.array([date.month for date in date_axis])
-        #time_restriction=np.logical_and(time_restriction,months_axis==month)
-        time_restriction=np.logical_and(time_restriction_for_years,[True if month in months else False for month in months_axis])
+        time_restriction=np.logical_and(time_restriction_for_years,np.isin(months_axis,months))
         return time_restriction
     else:
         return time_restriction_for_years
 
-def time_restriction_days(days,date_axis,time_restriction_any):
+def time_restriction_days(days,days_axis,time_restriction_any):
     if days!=None:
-        days_axis=np.array([date.day for date in date_axis])
-        time_restriction=np.logical_and(time_restriction_any,[True if day in days else False for day in days_axis])
+        time_restriction=np.logical_and(time_restriction_any,np.isin(days_axis,days))
         return time_restriction
     else:
         return time_restriction_any
                     
-def time_restriction_hours(hours,date_axis,time_restriction_any):
+def time_restriction_hours(hours,hours_axis,time_restriction_any):
     if hours!=None:
-        hours_axis=np.array([date.hour for date in date_axis])
-        time_restriction=np.logical_and(time_restriction_any,[True if hour in hours else False for hour in hours_axis])
+        time_restriction=np.logical_and(time_restriction_any,np.isin(hours_axis,hours))
         return time_restriction
     else:
         return time_restriction_any
                     
 def get_time_restriction(date_axis, time_axis,
                          min_year=None, years=None, months=None, days=None, hours=None,
-                         previous=0,next=0):
-    time_restriction = np.ones(date_axis.shape,dtype=np.bool)
-
-    time_restriction = time_restriction_years(min_year,years,date_axis,time_restriction)
-    time_restriction = time_restriction_months(months,date_axis,time_restriction)
-    time_restriction = time_restriction_days(days,date_axis,time_restriction)
-    time_restriction = time_restriction_hours(hours,date_axis,time_restriction)
+                         previous=0,next=0,date_components=None):
+    if date_components is None:
+        date_components=tuple([np.array([getattr(date,component) for date in date_axis],dtype=np.int64)
+                                for component in ['year','month','day','hour']])
+    years_axis, months_axis, days_axis, hours_axis = date_components
+    time_restriction = np.ones(years_axis.shape,dtype=np.bool)
+
+    time_restriction = time_restriction_years(min_year,years,years_axis,time_restriction)
+    time_restriction = time_restriction_months(months,months_axis,time_restriction)
+    time_restriction = time_restriction_days(days,days_axis,time_restriction)
+    time_restriction = time_restriction_hours(hours,hours_axis,time_restriction)
 
     if ( (previous>0) or
          (next>0) ):
@@ -452,6 +548,19 @@ def get_time_restriction(date_axis, time_axis,
         time_restriction[sort_indices] = sorted_time_restriction
     return time_restriction
 
+def batches_by_size(sizes,max_size):
+    #Split consecutive items in batches whose total size does not exceed max_size.
+    #Items larger than max_size are alone in their batch:
+    batches=[]
+    batch_size=0.0
+    for item_id, size in enumerate(sizes):
+        if len(batches)==0 or batch_size+size>max_size:
+            batches.append([])
+            batch_size=0.0
+        batches[-1].append(item_id)
+        batch_size+=size
+    return batches
+
 def get_dimensions_slicing(dataset,var,time_var):
     #Set the dimensions:
     dimensions=dict()
@@ -27,6 +27,8 @@ def subset(input_file,output_file,lonlatbox=default_box,lat_var='lat',lon_var='l
         elif np.diff(lonlatbox[:2])<0:
             mod_lonlatbox[1]+=1e-6
     optimal_slice = (lambda x: get_optimal_slices(x,mod_lonlatbox,lat_var,lon_var,output_vertices))
+    #Compressed chunks are copied once the output is closed:
+    netcdf_utils.defer_direct_chunks(output_file)
     with netCDF4.Dataset(input_file,'r') as dataset:
         with netCDF4.Dataset(output_file,'w') as output:
             if output_vertices:
@@ -34,6 +36,7 @@ def subset(input_file,output_file,lonlatbox=default_box,lat_var='lat',lon_var='l
                 netcdf_utils.replicate_full_netcdf_recursive(dataset,output,transform=transform,slices=optimal_slice,check_empty=True)
             else:
                 netcdf_utils.replicate_full_netcdf_recursive(dataset,output,slices=optimal_slice,check_empty=True)
+    netcdf_utils.flush_direct_chunks(output_file)
     return
 
 def get_optimal_slices(data,lonlatbox,lat_var,lon_var,output_vertices):
@@ -0,0 +1,42 @@
+#Times reduce_paths_ordering against its reference implementation on synthetic catalogs.
+#From the root of the repository, or anywhere once the package is installed:
+#
+#    PYTHONPATH=. python tests/benchmark_reduce_paths_ordering.py --num_files 100 1000 --reference_max_files 1000
+#
+import argparse
+import timeit
+
+import numpy as np
+
+from netcdf4_soft_links.soft_links import create_soft_links
+from test_reduce_paths_ordering import reference_reduce_paths_ordering, synthetic_catalog
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reduce_paths_ordering on synthetic catalogs.')
+    parser.add_argument('--num_files', type=int, nargs='+', default=[100, 1000, 3000],
+                        help='Number of distinct files in each catalog. Default: 100 1000 3000.')
+    parser.add_argument('--steps_per_file', type=int, default=120, help='Time steps per file. Default: 120.')
+    parser.add_argument('--num_replicas', type=int, default=2, help='Replicas of each file. Default: 2.')
+    parser.add_argument('--reference_max_files', type=int, default=1000,
+                        help='Largest catalog timed with the reference implementation. Default: 1000.')
+    parser.add_argument('--repeat', type=int, default=3, help='Best of repeat timings. Default: 3.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic catalogs. Default: 0.')
+    options = parser.parse_args()
+
+    print('{0:>8} {1:>10} {2:>12} {3:>12}'.format('paths', 'time steps', 'reference', 'vectorized'))
+    for num_files in options.num_files:
+        catalog = synthetic_catalog(np.random.RandomState(options.seed), num_files,
+                                    options.steps_per_file, options.num_replicas)
+        vectorized = min(timeit.repeat(lambda: create_soft_links.reduce_paths_ordering(*catalog),
+                                       number=1, repeat=options.repeat))
+        if num_files <= options.reference_max_files:
+            reference = '{0:11.3f}s'.format(min(timeit.repeat(lambda: reference_reduce_paths_ordering(*catalog),
+                                                              number=1, repeat=options.repeat)))
+        else:
+            reference = '{0:>12}'.format('-')
+        print('{0:8d} {1:10d} {2} {3:11.3f}s'.format(len(catalog[2]), len(catalog[0]), reference, vectorized))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import pytest
+import requests
+
+from netcdf4_soft_links import retrieval_manager
+from netcdf4_soft_links.remote_netcdf import remote_netcdf
+from netcdf4_soft_links.soft_links import read_soft_links
+
+
+def test_batches_by_size():
+    assert read_soft_links.batches_by_size([], 10.0) == []
+    assert read_soft_links.batches_by_size([1.0, 2.0, 3.0], 10.0) == [[0, 1, 2]]
+    assert read_soft_links.batches_by_size([4.0, 5.0, 2.0, 20.0, 1.0], 10.0) == [[0, 1], [2], [3], [4]]
+    assert read_soft_links.batches_by_size([0.0, 0.0, 10.0, 0.0], 10.0) == [[0, 1, 2, 3]]
+
+
+class fake_q_manager:
+    def __init__(self, items):
+        self.queues = self
+        self.items = list(items)
+        self.results = []
+        self.expected = len(items)
+        self.trial = None
+
+    def get(self, data_node):
+        item = self.items.pop(0)
+        self.trial = item[1]
+        return item
+
+    def put_for_thread_id(self, thread_id, item):
+        self.results.append(item)
+
+    def put_to_data_node_from_thread_id(self, thread_id, data_node, item):
+        self.expected += 1
+        self.items.insert(0, (thread_id,) + item)
+
+    def put_again_to_data_node_from_thread_id(self, thread_id, data_node, item):
+        self.items.insert(0, (thread_id,) + item)
+
+
+def test_failed_batch_retried_one_variable_at_a_time(monkeypatch):
+    q_manager = fake_q_manager([('thread', 0, 'http://node/file.nc', 'OPENDAP', ['tas', 'bad', 'pr'], [''],
+                                 [{'sort_table': [0]}, {'sort_table': [1]}, {'sort_table': [2]}])])
+    calls = []
+
+    class remote_netCDF:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def download_batch(self, var_list, pointer_var, download_kwargs_list=[]):
+            calls.append((list(var_list), q_manager.trial))
+            if 'bad' in var_list:
+                raise IOError('cannot retrieve bad')
+            return [ (var, [], pointer_var + [var]) for var in var_list ]
+
+    monkeypatch.setattr(remote_netcdf, 'remote_netCDF', remote_netCDF)
+    with pytest.raises(IOError):
+        retrieval_manager.worker_retrieve(q_manager, 'node', 'time', dict(), session=requests.Session())
+    #The batch is split in three items expected by the consumer:
+    assert q_manager.expected == 3
+    assert sorted(result[1][0][0] for result in q_manager.results) == ['pr', 'tas']
+    #Only the failing variable counts trials:
+    assert calls == [(['tas', 'bad', 'pr'], 0), (['tas'], 0), (['pr'], 0),
+                     (['bad'], 0), (['bad'], 1), (['bad'], 2), (['bad'], 3)]
@@ -0,0 +1,98 @@
+import netCDF4
+import numpy as np
+import pytest
+
+from netcdf4_soft_links import netcdf_utils
+
+
+@pytest.mark.parametrize('copy_threads', [False, True])
+@pytest.mark.parametrize('budget', [1e-4, 0.01, 0.2, 450.0])
+@pytest.mark.parametrize('shape, alignment', [((12, 30, 40), (1, 30, 40)),
+                                              ((12, 30, 40), (5, 7, 40)),
+                                              ((7, 3, 1000), (2, 3, 100)),
+                                              ((1000,), (64,))])
+def test_copy_blocks_cover_shape(monkeypatch, shape, alignment, budget, copy_threads):
+    monkeypatch.setattr(netcdf_utils, 'copy_memory_budget', budget)
+    monkeypatch.setattr(netcdf_utils, 'copy_threads', copy_threads)
+    memory_budget = budget * 1024 * 1024 / (3.0 if copy_threads else 1.0)
+    covered = np.zeros(shape, dtype=int)
+    for block in netcdf_utils.copy_blocks(shape, alignment, 8):
+        covered[block] += 1
+        block_shape = [ block_slice.stop - block_slice.start for block_slice in block ]
+        #Blocks only exceed the budget when a single element of the outer dimensions does:
+        split_dims = [ dim_id for dim_id, length in enumerate(block_shape) if length < shape[dim_id] ]
+        if 8 * np.prod(block_shape) > memory_budget:
+            assert all( block_shape[dim_id] == 1 for dim_id in split_dims[:-1] )
+    #Every element is copied exactly once:
+    assert (covered == 1).all()
+
+
+@pytest.mark.parametrize('copy_threads', [False, True])
+def test_copy_in_blocks(monkeypatch, copy_threads):
+    monkeypatch.setattr(netcdf_utils, 'copy_threads', copy_threads)
+    monkeypatch.setattr(netcdf_utils, 'copy_memory_budget', 0.01)
+    source = np.random.RandomState(0).rand(20, 30, 40)
+    dest = np.zeros_like(source)
+    blocks = list(netcdf_utils.copy_blocks(source.shape, (1, 1, 1), 8))
+    assert len(blocks) > 1
+
+    def write_block(block, temp):
+        dest[block] = temp
+
+    netcdf_utils.copy_in_blocks(lambda block: source[block], write_block, iter(blocks))
+    np.testing.assert_array_equal(dest, source)
+
+
+@pytest.mark.parametrize('copy_threads', [False, True])
+@pytest.mark.parametrize('failing', ['read', 'write'])
+def test_copy_in_blocks_errors(monkeypatch, copy_threads, failing):
+    monkeypatch.setattr(netcdf_utils, 'copy_threads', copy_threads)
+    blocks = [ (slice(start, start + 1, 1),) for start in range(10) ]
+
+    def read_block(block):
+        if failing == 'read' and block[0].start == 5:
+            raise IOError('read failed')
+        return block[0].start
+
+    def write_block(block, temp):
+        if failing == 'write' and block[0].start == 5:
+            raise IOError('write failed')
+
+    with pytest.raises(IOError, match=failing + ' failed'):
+        netcdf_utils.copy_in_blocks(read_block, write_block, iter(blocks))
+
+
+def create_source(file_name, chunksizes):
+    with netCDF4.Dataset(file_name, 'w') as dataset:
+        #Contiguous variables cannot have unlimited dimensions:
+        dataset.createDimension('time', 12 if chunksizes is None else None)
+        dataset.createDimension('lat', 30)
+        dataset.createDimension('lon', 40)
+        dataset.createVariable('time', 'd', ('time',))[:] = np.arange(12)
+        dataset.createVariable('lat', 'd', ('lat',))[:] = np.linspace(-90.0, 90.0, 30)
+        dataset.createVariable('lon', 'd', ('lon',))[:] = np.linspace(0.0, 360.0, 40, endpoint=False)
+        tas = dataset.createVariable('tas', 'f', ('time', 'lat', 'lon'), zlib=chunksizes is not None,
+                                     chunksizes=chunksizes, contiguous=chunksizes is None, fill_value=1e20)
+        tas[:] = np.ma.masked_greater(np.random.RandomState(0).rand(12, 30, 40).astype(np.float32), 0.9)
+
+
+@pytest.mark.parametrize('copy_threads', [False, True])
+@pytest.mark.parametrize('budget', [1e-3, 0.05, 450.0])
+@pytest.mark.parametrize('chunksizes', [None, (1, 30, 40), (5, 7, 11)])
+@pytest.mark.parametrize('slices', [dict(), {'lat': slice(2, 25, 3)}, {'time': slice(1, 12, 2), 'lon': slice(5, 35, 1)}])
+def test_block_copy_matches_plain_copy(tmpdir, monkeypatch, chunksizes, slices, budget, copy_threads):
+    monkeypatch.setattr(netcdf_utils, 'copy_memory_budget', budget)
+    monkeypatch.setattr(netcdf_utils, 'copy_threads', copy_threads)
+    source_name = str(tmpdir.join('source.nc'))
+    create_source(source_name, chunksizes)
+    output_name = str(tmpdir.join('output.nc'))
+    with netCDF4.Dataset(source_name, 'r') as dataset:
+        with netCDF4.Dataset(output_name, 'w') as output:
+            netcdf_utils.replicate_and_copy_variable(dataset, output, 'tas', slices=slices)
+        expected = dataset.variables['tas'][tuple([ slices.get(dim, slice(None))
+                                                    for dim in dataset.variables['tas'].dimensions ])]
+    with netCDF4.Dataset(output_name, 'r') as output:
+        copied = output.variables['tas'][...]
+    assert copied.shape == expected.shape
+    np.testing.assert_array_equal(np.ma.getmaskarray(copied), np.ma.getmaskarray(expected))
+    np.testing.assert_array_equal(np.ma.filled(copied), np.ma.filled(expected))
@@ -0,0 +1,228 @@
+import os
+import threading
+import time
+
+import netCDF4
+import numpy as np
+import pytest
+
+from netcdf4_soft_links.remote_netcdf import queryable_netcdf
+
+
+class fake_dataset:
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class opener:
+    def __init__(self):
+        self.opened = []
+
+    def __call__(self, name='dataset'):
+        dataset = fake_dataset(name)
+        self.opened.append(dataset)
+        return dataset
+
+
+def test_pool_reuses_datasets():
+    pool = queryable_netcdf.datasets_pool(2)
+    open_function = opener()
+    first = pool.open('a', open_function)
+    pool.release('a', first)
+    second = pool.open('a', open_function)
+    pool.release('a', second)
+    assert first is second
+    assert len(open_function.opened) == 1
+    assert not first.closed
+
+
+def test_pool_evicts_least_recently_used():
+    pool = queryable_netcdf.datasets_pool(2)
+    open_function = opener()
+    datasets = dict()
+    for key in ['a', 'b', 'a', 'c']:
+        datasets[key] = pool.open(key, lambda: open_function(key))
+        pool.release(key, datasets[key])
+    assert list(pool.datasets) == ['a', 'c']
+    assert datasets['b'].closed
+    assert not datasets['a'].closed
+
+
+def test_pool_reopens_when_signature_changes():
+    pool = queryable_netcdf.datasets_pool(2)
+    open_function = opener()
+    first = pool.open('a', open_function, signature=(1.0, 10))
+    pool.release('a', first)
+    second = pool.open('a', open_function, signature=(2.0, 10))
+    pool.release('a', second)
+    assert first is not second
+    assert first.closed
+    assert not second.closed
+
+
+def test_local_dataset_reopened_after_change(tmpdir, monkeypatch):
+    monkeypatch.setattr(queryable_netcdf, 'local_datasets', queryable_netcdf.datasets_pool(2))
+    file_name = str(tmpdir.join('local.nc'))
+
+    def write(length):
+        with netCDF4.Dataset(file_name, 'w') as dataset:
+            dataset.createDimension('x', length)
+            dataset.createVariable('x', 'd', ('x',))[:] = np.arange(length)
+
+    write(3)
+    queryable_netcdf.local_use_h5(file_name)
+    first = queryable_netcdf.open_local_dataset(file_name)
+    queryable_netcdf.local_datasets.release(file_name, first)
+    assert queryable_netcdf.open_local_dataset(file_name) is first
+    queryable_netcdf.local_datasets.release(file_name, first)
+
+    #Same modification time, different size:
+    stat = os.stat(file_name)
+    write(5)
+    os.utime(file_name, (stat.st_atime, stat.st_mtime))
+    queryable_netcdf.local_use_h5(file_name)
+    second = queryable_netcdf.open_local_dataset(file_name)
+    assert second is not first
+    assert len(second.variables['x']) == 5
+    queryable_netcdf.local_datasets.release(file_name, second)
+    queryable_netcdf.local_datasets.close_all()
+
+
+def test_pool_closes_after_last_release():
+    pool = queryable_netcdf.datasets_pool(2)
+    open_function = opener()
+    first = pool.open('a', open_function)
+    second = pool.open('a', open_function)
+    assert first is second
+    #Removed from the pool while in use:
+    pool.close('a')
+    assert not first.closed
+    pool.release('a', first)
+    assert not first.closed
+    pool.release('a', second)
+    assert first.closed
+    assert pool.open('a', open_function) is not first
+
+
+def test_pool_discards_dataset_after_error(tmpdir, monkeypatch):
+    monkeypatch.setattr(queryable_netcdf, 'local_datasets', queryable_netcdf.datasets_pool(2))
+    file_name = str(tmpdir.join('local.nc'))
+    with netCDF4.Dataset(file_name, 'w') as dataset:
+        dataset.createDimension('x', 3)
+    remote_data = queryable_netcdf.queryable_netCDF(file_name)
+    used = []
+    closed = []
+    close_dataset = queryable_netcdf._close_dataset
+    monkeypatch.setattr(queryable_netcdf, '_close_dataset',
+                        lambda dataset: closed.append(dataset) or close_dataset(dataset))
+
+    def failing(dataset):
+        used.append(dataset)
+        raise IOError('invalid state')
+
+    with pytest.raises(IOError):
+        remote_data.pooled_handling(None, failing)
+    assert not file_name in queryable_netcdf.local_datasets.datasets
+    assert closed == used
+    dataset = remote_data.pooled_handling(None, lambda dataset: dataset)
+    assert dataset is not used[0]
+    queryable_netcdf.local_datasets.close_all()
+
+
+def test_pool_discard_keeps_dataset_for_other_users():
+    pool = queryable_netcdf.datasets_pool(2)
+    open_function = opener()
+    first = pool.open('a', open_function)
+    second = pool.open('a', open_function)
+    pool.release('a', first, discard=True)
+    assert not 'a' in pool.datasets
+    assert not second.closed
+    pool.release('a', second)
+    assert second.closed
+
+
+def test_pool_reset_in_child_process():
+    pool = queryable_netcdf.datasets_pool(2)
+    open_function = opener()
+    inherited = pool.open('a', open_function)
+    pool.release('a', inherited)
+    #As seen from a forked process:
+    pool.pid = -1
+    child = pool.open('a', open_function)
+    assert child is not inherited
+    #Handles inherited from the parent are not closed:
+    assert not inherited.closed
+    assert pool.pid == os.getpid()
+    pool.release('a', child)
+
+
+def test_pool_forked_process():
+    pool = queryable_netcdf.datasets_pool(2)
+    open_function = opener()
+    inherited = pool.open('a', open_function)
+    pool.release('a', inherited)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            child = pool.open('a', open_function)
+            pool.release('a', child)
+            pool.close_all()
+            os.write(write_fd, str(int(child is not inherited and not inherited.closed)))
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read_fd, 1) == '1'
+    os.close(read_fd)
+    os.close(write_fd)
+    #The parent handle is untouched:
+    assert not inherited.closed
+    assert pool.open('a', open_function) is inherited
+
+
+def test_pool_opens_key_once_for_concurrent_threads():
+    pool = queryable_netcdf.datasets_pool(2)
+    open_function = opener()
+    started = threading.Event()
+    proceed = threading.Event()
+
+    def slow_open():
+        started.set()
+        proceed.wait()
+        return open_function()
+
+    results = []
+
+    def worker():
+        dataset = pool.open('a', slow_open)
+        results.append(dataset)
+        pool.release('a', dataset)
+
+    threads = [ threading.Thread(target=worker) for thread_id in range(4) ]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.1)
+    proceed.set()
+    for thread in threads:
+        thread.join()
+    assert len(open_function.opened) == 1
+    assert all( dataset is results[0] for dataset in results )
+    assert not results[0].closed
+
+
+def test_pool_retries_open_after_failure():
+    pool = queryable_netcdf.datasets_pool(2)
+
+    def failing_open():
+        raise IOError('cannot open')
+
+    with pytest.raises(IOError):
+        pool.open('a', failing_open)
+    assert pool.opening == {}
+    assert pool.open('a', opener()).name == 'dataset'
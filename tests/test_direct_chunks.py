@@ -0,0 +1,119 @@
+import netCDF4
+import numpy as np
+import pytest
+
+from netcdf4_soft_links import netcdf_utils
+
+pytestmark = pytest.mark.skipif(not netcdf_utils.h5lib_read_chunk,
+                                reason='H5Dread_chunk requires HDF5 1.10.2')
+
+
+def create_source(file_name, num_times=12, first_time=0):
+    with netCDF4.Dataset(file_name, 'w') as dataset:
+        dataset.createDimension('time', None)
+        dataset.createDimension('lat', 30)
+        dataset.createDimension('lon', 40)
+        time = dataset.createVariable('time', 'd', ('time',))
+        time.units = 'days since 2000-01-01'
+        time[:] = first_time + np.arange(num_times)
+        dataset.createVariable('lat', 'd', ('lat',))[:] = np.linspace(-90.0, 90.0, 30)
+        dataset.createVariable('lon', 'd', ('lon',))[:] = np.linspace(0.0, 360.0, 40, endpoint=False)
+        tas = dataset.createVariable('tas', 'f', ('time', 'lat', 'lon'), zlib=True, complevel=4, shuffle=True,
+                                     chunksizes=(1, 30, 40), fill_value=1e20)
+        values = np.ma.masked_greater(np.random.RandomState(0).rand(num_times, 30, 40).astype(np.float32), 0.9)
+        #A time step that is never written stays unallocated:
+        tas[:num_times - 1] = values[:num_times - 1]
+        dataset.createVariable('orog', 'f', ('lat', 'lon'), zlib=True, chunksizes=(10, 40))[:] = np.ones((30, 40))
+
+
+def copy_file(source_name, output_name, deferred):
+    if deferred:
+        netcdf_utils.defer_direct_chunks(output_name)
+    with netCDF4.Dataset(source_name, 'r') as dataset:
+        with netCDF4.Dataset(output_name, 'w') as output:
+            for var_name in dataset.variables:
+                netcdf_utils.replicate_and_copy_variable(dataset, output, var_name)
+            if deferred:
+                copies = list(netcdf_utils.deferred_chunks[netcdf_utils.os.path.abspath(output_name)])
+            else:
+                copies = []
+    netcdf_utils.flush_direct_chunks(output_name)
+    return copies
+
+
+def assert_same_variables(first_name, second_name, same_storage=True):
+    with netCDF4.Dataset(first_name, 'r') as first:
+        with netCDF4.Dataset(second_name, 'r') as second:
+            assert set(first.variables) == set(second.variables)
+            for var_name in first.variables:
+                first_values = first.variables[var_name][...]
+                second_values = second.variables[var_name][...]
+                np.testing.assert_array_equal(np.ma.getmaskarray(first_values), np.ma.getmaskarray(second_values))
+                np.testing.assert_array_equal(np.ma.filled(first_values), np.ma.filled(second_values))
+                if same_storage:
+                    assert first.variables[var_name].filters() == second.variables[var_name].filters()
+                    assert first.variables[var_name].chunking() == second.variables[var_name].chunking()
+
+
+def test_direct_chunks_match_block_copy(tmpdir):
+    source_name = str(tmpdir.join('source.nc'))
+    create_source(source_name)
+    block_name = str(tmpdir.join('block.nc'))
+    direct_name = str(tmpdir.join('direct.nc'))
+    assert copy_file(source_name, block_name, deferred=False) == []
+    copies = copy_file(source_name, direct_name, deferred=True)
+    #Compressed variables use the direct path. Coordinates are copied right away:
+    assert sorted([ copy[2] for copy in copies ]) == ['/orog', '/tas']
+    assert netcdf_utils.deferred_chunks == {}
+    assert_same_variables(source_name, block_name, same_storage=False)
+    assert_same_variables(block_name, direct_name)
+
+    #The stored chunks are the source chunks:
+    h5py = netcdf_utils.h5py
+    with h5py.File(source_name, 'r') as source:
+        with h5py.File(direct_name, 'r') as direct:
+            for chunk_offset in [(0, 0, 0), (5, 0, 0)]:
+                assert (netcdf_utils._read_direct_chunk(source['tas'], chunk_offset) ==
+                        netcdf_utils._read_direct_chunk(direct['tas'], chunk_offset))
+            assert netcdf_utils._read_direct_chunk(direct['tas'], (11, 0, 0)) == (None, None)
+
+
+def test_direct_chunks_append(tmpdir):
+    first_name = str(tmpdir.join('first.nc'))
+    second_name = str(tmpdir.join('second.nc'))
+    create_source(first_name, num_times=4)
+    create_source(second_name, num_times=6, first_time=4)
+    results = dict()
+    for deferred in [False, True]:
+        output_name = str(tmpdir.join('append_{0}.nc'.format(deferred)))
+        if deferred:
+            netcdf_utils.defer_direct_chunks(output_name)
+        with netCDF4.Dataset(output_name, 'w') as output:
+            for source_name in [first_name, second_name]:
+                with netCDF4.Dataset(source_name, 'r') as dataset:
+                    netcdf_utils.replicate_netcdf_file(dataset, output)
+                    record_dimensions = netcdf_utils.append_record(dataset, output)
+                    for var_name in ['tas', 'orog']:
+                        if var_name in output.variables:
+                            netcdf_utils.append_and_copy_variable(dataset, output, var_name, record_dimensions)
+                        else:
+                            netcdf_utils.replicate_and_copy_variable(dataset, output, var_name)
+            if deferred:
+                copies = netcdf_utils.deferred_chunks[netcdf_utils.os.path.abspath(output_name)]
+                assert [ (copy[2], copy[3]) for copy in copies ] == [('/tas', (0, 0, 0)), ('/orog', (0, 0)),
+                                                                     ('/tas', (4, 0, 0))]
+        netcdf_utils.flush_direct_chunks(output_name)
+        with netCDF4.Dataset(output_name, 'r') as output:
+            results[deferred] = output.variables['tas'][...]
+    assert results[True].shape == (10, 30, 40)
+    np.testing.assert_array_equal(np.ma.getmaskarray(results[True]), np.ma.getmaskarray(results[False]))
+    np.testing.assert_array_equal(np.ma.filled(results[True]), np.ma.filled(results[False]))
+
+
+def test_direct_chunks_require_registered_output(tmpdir):
+    source_name = str(tmpdir.join('source.nc'))
+    create_source(source_name)
+    with netCDF4.Dataset(source_name, 'r') as dataset:
+        with netCDF4.Dataset(str(tmpdir.join('output.nc')), 'w') as output:
+            netcdf_utils.replicate_netcdf_var(dataset, output, 'tas')
+            assert not netcdf_utils.copy_direct_chunks(dataset.variables['tas'], output.variables['tas'], [0, 0, 0])
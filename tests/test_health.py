@@ -0,0 +1,82 @@
+import multiprocessing
+
+import pytest
+import requests
+
+from netcdf4_soft_links import queues_manager, retrieval_manager
+from netcdf4_soft_links.remote_netcdf import remote_netcdf
+from netcdf4_soft_links.remote_netcdf.queryable_netcdf import circuitOpenError
+
+
+@pytest.fixture(scope='module')
+def manager():
+    manager = multiprocessing.Manager()
+    yield manager
+    manager.shutdown()
+
+
+class fake_queues:
+    def __init__(self, items):
+        self.items = list(items)
+        self.requeued = []
+
+    def get(self, data_node):
+        return self.items.pop(0)
+
+    def put(self, data_node, item):
+        self.requeued.append(item)
+        self.items.insert(0, item)
+
+
+class fake_q_manager:
+    def __init__(self, health, items):
+        self.health = health
+        self.queues = fake_queues(items)
+        self.results = []
+
+    def put_for_thread_id(self, thread_id, item):
+        self.results.append((thread_id, item))
+
+    def put_again_to_data_node_from_thread_id(self, thread_id, data_node, item):
+        self.queues.put(data_node, (thread_id,) + item)
+
+
+def test_circuit_dead_after_failed_probes(manager):
+    health = queues_manager.Health_data_node(manager, max_failures=3, cooldown=0.0, max_probes=2)
+    for failure in range(3):
+        health.failure('node')
+    assert not health.is_dead('node')
+    #Two failed tests after cooldown:
+    for probe in range(2):
+        assert health.allow('node')
+        health.failure('node')
+    assert health.is_dead('node')
+    health.success('node', 1.0)
+    assert not health.is_dead('node')
+
+
+def test_circuit_open_item_fails_once_node_is_dead(manager, monkeypatch):
+    health = queues_manager.Health_data_node(manager, max_failures=3, cooldown=0.05, max_probes=2)
+    for failure in range(3):
+        health.failure('node')
+
+    class remote_netCDF:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def download(self, *args, **kwargs):
+            if not health.allow('node'):
+                raise circuitOpenError('circuit open')
+            #The test request after each cooldown fails:
+            health.failure('node')
+            raise IOError('unavailable')
+
+    monkeypatch.setattr(remote_netcdf, 'remote_netCDF', remote_netCDF)
+    item = ('thread', 0, 'http://node/file.nc', 'OPENDAP', 'tas', ['', 'tas'], dict())
+    q_manager = fake_q_manager(health, [item])
+    q_manager.queues.items.append('STOP')
+    retrieval_manager.worker_retrieve(q_manager, 'node', 'time', dict(), session=requests.Session())
+    assert health.is_dead('node')
+    assert q_manager.results == [('thread', ('OPENDAP', 'FAIL'))]
+    #Rejections by the circuit do not count as trials:
+    assert all(requeued[1] <= 2 for requeued in q_manager.queues.requeued)
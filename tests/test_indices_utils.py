@@ -0,0 +1,42 @@
+import threading
+
+import numpy as np
+
+from netcdf4_soft_links import indices_utils
+
+
+def test_get_indices_from_dim_matches_values():
+    source = np.array([5.0, 1.0, 3.0, 1.0])
+    output = np.array([1.0, 3.0, 5.0])
+    np.testing.assert_array_equal(indices_utils.get_indices_from_dim(source, output), [1, 2, 0])
+    #Cached result is a copy:
+    indices = indices_utils.get_indices_from_dim(source, output)
+    indices[:] = -1
+    np.testing.assert_array_equal(indices_utils.get_indices_from_dim(source, output), [1, 2, 0])
+
+
+def test_get_indices_from_dim_concurrent(monkeypatch):
+    #A small cache forces evictions while other threads look up and insert:
+    monkeypatch.setattr(indices_utils, 'indices_from_dim_cache', indices_utils.OrderedDict())
+    monkeypatch.setattr(indices_utils, 'indices_from_dim_cache_size', 4)
+    source = np.arange(500, dtype=np.float64)[::-1]
+    grids = [ source[offset:offset + 100] for offset in range(0, 400, 10) ]
+    expected = [ indices_utils.match_indices(source, grid) for grid in grids ]
+    errors = []
+
+    def worker(thread_id):
+        try:
+            for repeat in range(20):
+                for grid_id in np.random.RandomState(thread_id + repeat).permutation(len(grids)):
+                    np.testing.assert_array_equal(indices_utils.get_indices_from_dim(source, grids[grid_id]),
+                                                  expected[grid_id])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [ threading.Thread(target=worker, args=(thread_id,)) for thread_id in range(8) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(indices_utils.indices_from_dim_cache) <= 4
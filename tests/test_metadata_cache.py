@@ -0,0 +1,131 @@
+import datetime
+import os
+import sqlite3
+import time
+
+import pytest
+
+from netcdf4_soft_links.soft_links import metadata_cache
+
+
+def local_path(file_name):
+    return {'path': file_name + '|', 'file_type': 'local_file',
+            'checksum_type': 'SHA256', 'checksum': '', 'tracking_id': ''}
+
+
+def opendap_path(url, checksum='abc', tracking_id='id'):
+    return {'path': url + '|' + checksum, 'file_type': 'OPENDAP',
+            'checksum_type': 'SHA256', 'checksum': checksum, 'tracking_id': tracking_id}
+
+
+@pytest.fixture
+def local_file(tmpdir):
+    file_name = str(tmpdir.join('data.nc'))
+    with open(file_name, 'w') as file_handle:
+        file_handle.write('data')
+    return file_name
+
+
+def test_local_key_follows_modification_time_and_size(tmpdir, local_file):
+    with metadata_cache.file_metadata_cache(str(tmpdir.join('cache'))) as cache:
+        cache.put(local_path(local_file), {'calendar': 'noleap'})
+        assert cache.get(local_path(local_file)) == {'calendar': 'noleap'}
+        #Validated paths are prefixed with the host name:
+        assert cache.get(local_path('host:' + local_file)) is None
+        stat = os.stat(local_file)
+        with open(local_file, 'a') as file_handle:
+            file_handle.write('more')
+        os.utime(local_file, (stat.st_atime, stat.st_mtime))
+        assert cache.get(local_path(local_file)) is None
+        os.utime(local_file, (stat.st_atime, stat.st_mtime + 10))
+        assert cache.get(local_path(local_file)) is None
+        #Missing files are not cached:
+        missing_path = local_path(str(tmpdir.join('missing.nc')))
+        cache.put(missing_path, {'calendar': 'noleap'})
+        assert cache.get(missing_path) is None
+
+
+def test_host_prefixed_local_path(tmpdir, local_file):
+    assert (metadata_cache.cache_key(local_path('host:' + local_file)) ==
+            metadata_cache.cache_key(local_path(local_file)).replace(local_file, 'host:' + local_file, 1))
+
+
+def test_opendap_key_follows_checksum_and_tracking_id(tmpdir):
+    url = 'http://node/thredds/dodsC/file.nc'
+    with metadata_cache.file_metadata_cache(str(tmpdir.join('cache'))) as cache:
+        cache.put(opendap_path(url), {'calendar': 'noleap'})
+        assert cache.get(opendap_path(url)) == {'calendar': 'noleap'}
+        assert cache.get(opendap_path(url, checksum='def')) is None
+        assert cache.get(opendap_path(url, tracking_id='other')) is None
+        assert cache.get(opendap_path(url.replace('file', 'other'))) is None
+    #Other file types are never cached:
+    assert metadata_cache.cache_key(dict(opendap_path(url), file_type='HTTPServer')) is None
+
+
+def test_expiry(tmpdir, monkeypatch):
+    url = 'http://node/thredds/dodsC/file.nc'
+    cache_dir = str(tmpdir.join('cache'))
+    with metadata_cache.file_metadata_cache(cache_dir, expire_after=datetime.timedelta(days=1)) as cache:
+        cache.put(opendap_path(url), {'calendar': 'noleap'})
+        now = time.time()
+        monkeypatch.setattr(metadata_cache.time, 'time', lambda: now + 2 * 24 * 3600)
+        assert cache.get(opendap_path(url)) is None
+        monkeypatch.undo()
+        cache.put(opendap_path(url), {'calendar': 'noleap'})
+    #Expired records are removed when the cache is opened:
+    monkeypatch.setattr(metadata_cache.time, 'time', lambda: now + 2 * 24 * 3600)
+    with metadata_cache.file_metadata_cache(cache_dir, expire_after=datetime.timedelta(days=1)) as cache:
+        assert cache.connection.execute('SELECT COUNT(*) FROM metadata').fetchone()[0] == 0
+
+
+def test_size_eviction_least_recently_accessed(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir.join('cache'))
+    paths = [ opendap_path('http://node/thredds/dodsC/file{0}.nc'.format(file_id)) for file_id in range(4) ]
+    record = {'time': 'x' * 100000}
+    clock = [time.time()]
+
+    def tick():
+        clock[0] += 1.0
+        return clock[0]
+
+    monkeypatch.setattr(metadata_cache.time, 'time', tick)
+    with metadata_cache.file_metadata_cache(cache_dir) as cache:
+        for path in paths:
+            cache.put(path, record)
+        #file0 becomes the most recently accessed:
+        assert cache.get(paths[0]) == record
+    #Room for two records:
+    with metadata_cache.file_metadata_cache(cache_dir, max_size=0.25) as cache:
+        assert [ cache.get(path) is not None for path in paths ] == [True, False, False, True]
+
+
+def test_corrupt_database(tmpdir):
+    cache_dir = tmpdir.join('cache')
+    cache_dir.ensure(dir=True)
+    cache_dir.join('nc4sl_metadata.sqlite').write('not a database' * 100)
+    url = 'http://node/thredds/dodsC/file.nc'
+    with metadata_cache.file_metadata_cache(str(cache_dir)) as cache:
+        assert cache.get(opendap_path(url)) is None
+        cache.put(opendap_path(url), {'calendar': 'noleap'})
+        assert cache.get(opendap_path(url)) == {'calendar': 'noleap'}
+
+
+def test_locked_database(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    url = 'http://node/thredds/dodsC/file.nc'
+    with metadata_cache.file_metadata_cache(cache_dir) as cache:
+        cache.put(opendap_path(url), {'calendar': 'noleap'})
+    #Another process holds the cache:
+    other = sqlite3.connect(os.path.join(cache_dir, 'nc4sl_metadata.sqlite'))
+    other.execute('BEGIN EXCLUSIVE')
+    try:
+        with metadata_cache.file_metadata_cache(cache_dir, timeout=0.1) as cache:
+            assert cache.get(opendap_path(url)) is None
+            cache.put(opendap_path(url, checksum='def'), {'calendar': 'noleap'})
+    finally:
+        other.rollback()
+        other.close()
+    #The cache is usable once released:
+    with metadata_cache.file_metadata_cache(cache_dir) as cache:
+        assert cache.get(opendap_path(url)) == {'calendar': 'noleap'}
+        assert cache.get(opendap_path(url, checksum='def')) is None
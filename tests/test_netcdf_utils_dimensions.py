@@ -0,0 +1,67 @@
+import threading
+
+import numpy as np
+
+from netcdf4_soft_links import netcdf_utils
+
+
+class fake_variable:
+    def __init__(self, values):
+        self.values = values
+        self.units = 'degrees_north'
+
+    def ncattrs(self):
+        return ['units']
+
+    def getncattr(self, att):
+        return getattr(self, att)
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+
+class fake_dataset:
+    #Stands for a remote dataset. Only the attributes used by retrieve_dimension_cached:
+    def __init__(self, values):
+        self.dimensions = {'lat': range(len(values))}
+        self.variables = {'lat': fake_variable(values)}
+
+
+def test_retrieve_dimension_cached_reuses_same_grid(monkeypatch):
+    monkeypatch.setattr(netcdf_utils, 'dimensions_cache', netcdf_utils.OrderedDict())
+    values = np.linspace(-90.0, 90.0, 10)
+    first, attributes = netcdf_utils.retrieve_dimension_cached(fake_dataset(values), 'lat', ('node',))
+    np.testing.assert_array_equal(first, values)
+    assert attributes == {'units': 'degrees_north'}
+    #A different file on the same grid is served from the cache:
+    other = fake_dataset(values.copy())
+    other.variables['lat'].values[1:-1] = 0.0
+    second, attributes = netcdf_utils.retrieve_dimension_cached(other, 'lat', ('node',))
+    np.testing.assert_array_equal(second, values)
+    assert len(netcdf_utils.dimensions_cache) == 1
+
+
+def test_retrieve_dimension_cached_concurrent(monkeypatch):
+    #A small cache forces evictions while other threads look up and insert:
+    monkeypatch.setattr(netcdf_utils, 'dimensions_cache', netcdf_utils.OrderedDict())
+    monkeypatch.setattr(netcdf_utils, 'dimensions_cache_size', 4)
+    grids = [ np.linspace(-90.0, 90.0, length) for length in range(10, 50) ]
+    errors = []
+
+    def worker(thread_id):
+        try:
+            for repeat in range(20):
+                for grid_id in np.random.RandomState(thread_id + repeat).permutation(len(grids)):
+                    values, attributes = netcdf_utils.retrieve_dimension_cached(fake_dataset(grids[grid_id]),
+                                                                                'lat', ('node',))
+                    np.testing.assert_array_equal(values, grids[grid_id])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [ threading.Thread(target=worker, args=(thread_id,)) for thread_id in range(8) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(netcdf_utils.dimensions_cache) <= 4
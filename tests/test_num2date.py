@@ -0,0 +1,132 @@
+import datetime
+
+import netCDF4
+import numpy as np
+import pytest
+
+from netcdf4_soft_links import netcdf_utils
+from netcdf4_soft_links.remote_netcdf import timeaxis_mod
+
+calendars = ['standard', 'gregorian', 'proleptic_gregorian', 'julian', 'noleap', '365_day',
+             'all_leap', '366_day', '360_day']
+
+
+def assert_same_dates(dates, expected, calendar):
+    dates = np.atleast_1d(dates)
+    expected = np.atleast_1d(expected)
+    assert dates.shape == expected.shape
+    assert [ type(date) for date in dates.ravel() ] == [ type(date) for date in expected.ravel() ]
+    #netCDF4 computes dates in floating point and is only accurate to a few microseconds.
+    #It cannot compare dates on both sides of the switch to the gregorian calendar:
+    julian = np.array([ date.year < 1583 for date in expected.ravel() ], dtype=bool)
+    for subset, units in [(julian, 'seconds since 1-01-01'), (~julian, 'seconds since 1800-01-01')]:
+        if subset.any():
+            np.testing.assert_allclose(netCDF4.date2num(dates.ravel()[subset], units, calendar),
+                                       netCDF4.date2num(expected.ravel()[subset], units, calendar),
+                                       rtol=0, atol=1e-3)
+
+
+@pytest.mark.parametrize('calendar', calendars)
+@pytest.mark.parametrize('units, time_axis', [('days since 1850-01-01', np.arange(0.0, 80000.0, 13.25)),
+                                              ('hours since 1979-01-01 06:00:00', np.arange(-1000.0, 5000.0, 7.5)),
+                                              ('seconds since 2000-02-28 23:59:30', np.arange(0.0, 3e7, 86399.5)),
+                                              ('days since 1-01-01', np.array([0.0, 1.5, 365.0, 730000.25]))])
+def test_num2date_matches_netcdf4(calendar, units, time_axis):
+    assert_same_dates(netcdf_utils.num2date(time_axis, units, calendar),
+                      netCDF4.num2date(time_axis, units, calendar), calendar)
+    #2-D axis:
+    time_axis = time_axis[:len(time_axis) // 2 * 2].reshape((2, -1))
+    assert_same_dates(netcdf_utils.num2date(time_axis, units, calendar),
+                      netCDF4.num2date(time_axis, units, calendar), calendar)
+
+
+@pytest.mark.parametrize('calendar', calendars)
+def test_num2date_scalar(calendar):
+    date = netcdf_utils.num2date(np.float64(45.5), 'days since 1850-01-01', calendar)
+    expected = netCDF4.num2date(45.5, 'days since 1850-01-01', calendar)
+    assert type(date) == type(expected)
+    assert_same_dates(date, expected, calendar)
+    assert_same_dates(netcdf_utils.num2date(np.array(45.5), 'days since 1850-01-01', calendar), expected, calendar)
+
+
+@pytest.mark.parametrize('calendar', ['standard', 'julian', 'proleptic_gregorian'])
+def test_num2date_gregorian_switch(calendar):
+    #The standard calendar switches from julian to gregorian dates on 1582-10-15.
+    #netCDF4.date2num cannot compare these dates, compare their components:
+    time_axis = np.arange(-5.0, 5.0)
+    date_axis = netcdf_utils.num2date(time_axis, 'days since 1582-10-15', calendar)
+    expected = netCDF4.num2date(time_axis, 'days since 1582-10-15', calendar)
+    assert [ type(date) for date in date_axis ] == [ type(date) for date in expected ]
+    assert ([ (date.year, date.month, date.day, date.hour) for date in date_axis ] ==
+            [ (date.year, date.month, date.day, date.hour) for date in expected ])
+
+
+@pytest.mark.parametrize('calendar', ['standard', 'noleap', '360_day'])
+def test_date_axis_masked_and_empty(calendar):
+    time_axis = np.ma.masked_array([0.0, 31.0, 59.0], mask=[False, True, False])
+    with pytest.raises(NotImplementedError):
+        netcdf_utils.num2date(time_axis, 'days since 2000-01-01', calendar)
+    #Falls back to netCDF4:
+    date_axis = netcdf_utils.get_date_axis_relative(time_axis, 'days since 2000-01-01', calendar)
+    expected = netCDF4.num2date(time_axis, 'days since 2000-01-01', calendar)
+    assert list(date_axis) == list(expected)
+    assert netcdf_utils.num2date(np.array([]), 'days since 2000-01-01', calendar).shape == (0,)
+
+
+def reference_months_since(num_axis, units, calendar):
+    #Dates for 'months since' and 'years since' units, one netCDF4 call at a time:
+    units_as_days = 'days ' + ' '.join(units.split(' ')[1:])
+    year, month, day = [ int(item) for item in units.split(' ')[2].split('-') ]
+    if calendar in ['standard', 'gregorian']:
+        date_type = datetime.datetime
+    else:
+        date_type = netcdf_utils.date_types[calendar]
+    dates = []
+    for value in np.atleast_1d(num_axis):
+        index = int(np.floor(value))
+        if units.split(' ')[0] == 'years':
+            start = date_type(year + index, month, day)
+            end = date_type(year + index + 1, month, day)
+        else:
+            start = date_type(year + (month - 1 + index) // 12, (month - 1 + index) % 12 + 1, day)
+            end = date_type(year + (month + index) // 12, (month + index) % 12 + 1, day)
+        start_days, end_days = netCDF4.date2num([start, end], units_as_days, calendar)
+        dates.append(netCDF4.num2date(start_days + (value - index) * (end_days - start_days),
+                                      units_as_days, calendar))
+    return np.array(dates)
+
+
+@pytest.mark.parametrize('calendar', ['standard', 'proleptic_gregorian', 'noleap', 'all_leap', '360_day'])
+@pytest.mark.parametrize('units', ['months since 1850-01-01', 'months since 1979-07-15', 'years since 1850-01-01',
+                                   'years since 2001-03-01'])
+def test_months_since_matches_reference(calendar, units):
+    num_axis = np.concatenate([np.arange(-24.0, 600.0, 0.5), [1e3 + 0.25]])
+    date_axis = timeaxis_mod.Num2date(num_axis, units, calendar)
+    assert_same_dates(date_axis, reference_months_since(num_axis, units, calendar), calendar)
+    np.testing.assert_allclose(timeaxis_mod.Date2num(date_axis, units, calendar), num_axis, rtol=0, atol=1e-6)
+    #0-d input:
+    assert_same_dates(timeaxis_mod.Num2date(np.float64(5.5), units, calendar),
+                      reference_months_since(5.5, units, calendar), calendar)
+
+
+@pytest.mark.parametrize('calendar', ['standard', 'noleap', '360_day'])
+def test_days_since_matches_netcdf4(calendar):
+    num_axis = np.arange(0.0, 1000.0, 0.5)
+    date_axis = timeaxis_mod.Num2date(num_axis, 'days since 1850-01-01', calendar)
+    assert_same_dates(date_axis, netCDF4.num2date(num_axis, 'days since 1850-01-01', calendar), calendar)
+    np.testing.assert_allclose(timeaxis_mod.Date2num(date_axis, 'days since 1850-01-01', calendar), num_axis)
+
+
+@pytest.mark.parametrize('units, calendar', [('months since 2000-01-31', 'standard'),
+                                             ('months since 2000-01-30', 'noleap'),
+                                             ('months since 2000-01-31', '360_day'),
+                                             ('years since 2000-02-29', 'standard'),
+                                             ('years since 2000-02-29', 'noleap')])
+def test_reference_day_out_of_range(units, calendar):
+    #The time reference cannot be moved to a year or month without its day:
+    with pytest.raises(ValueError):
+        timeaxis_mod.Num2date(np.arange(3.0), units, calendar)
+    #Dates in February and March:
+    dates = netcdf_utils.num2date(np.array([40.0, 70.0]), 'days since 2000-01-01', calendar)
+    with pytest.raises(ValueError):
+        timeaxis_mod.Date2num(dates, units, calendar)
@@ -0,0 +1,9 @@
+from netcdf4_soft_links import parsers
+
+
+def test_waste_ratio_option():
+    parser = parsers.generate_subparsers(None)
+    options = parser.parse_args(['download_opendap', 'in.nc', 'out.nc'])
+    assert options.waste_ratio == 0.5
+    options = parser.parse_args(['download_opendap', '--waste_ratio', '0', 'in.nc', 'out.nc'])
+    assert options.waste_ratio == 0.0
@@ -0,0 +1,169 @@
+import multiprocessing
+import Queue
+import random
+import threading
+import time
+
+import pytest
+
+from netcdf4_soft_links import queues_manager
+
+
+@pytest.fixture(scope='module')
+def manager():
+    manager = multiprocessing.Manager()
+    yield manager
+    manager.shutdown()
+
+
+class options:
+    def __init__(self, queues_backend):
+        self.num_dl = 2
+        self.queues_backend = queues_backend
+
+
+class reference_queues_manager(queues_manager.NC4SL_queues_manager):
+    #Results gathering before the 'CLOSED' sentinel, polling the results queue:
+    def set_closed(self):
+        thread_id = 'download_' + multiprocessing.current_process().name
+        getattr(self, thread_id + '_closed').set()
+        return
+
+    def get_for_thread_id(self):
+        timeout = 0.1
+        thread_id = 'download_' + multiprocessing.current_process().name
+        while not (getattr(self, thread_id + '_closed').is_set()
+                   and getattr(self, thread_id + '_expected').value == 0):
+            try:
+                with getattr(self, thread_id + '_expected').lock:
+                    item = getattr(self, thread_id).get(True, timeout)
+                    getattr(self, thread_id + '_expected').decrement_no_lock()
+                return item
+            except Queue.Empty:
+                pass
+        return 'STOP'
+
+
+data_nodes = ['node0', 'node1', 'node2']
+
+
+def retrieve(q_manager, num_items, seed):
+    #Workers take items from the data node queues and put back some of them once,
+    #as failed downloads are. Items are put while results are gathered:
+    random_state = random.Random(seed)
+    delays = [ random_state.random() * 0.002 for item_id in range(num_items) ]
+
+    def worker(data_node):
+        while True:
+            item = q_manager.queues.get(data_node)
+            if item == 'STOP':
+                break
+            thread_id, trial, item_id = item
+            time.sleep(delays[item_id])
+            if trial == 0 and item_id % 3 == 0:
+                q_manager.put_again_to_data_node_from_thread_id(thread_id, data_node, (1, item_id))
+            else:
+                q_manager.put_for_thread_id(thread_id, (data_node, item_id))
+
+    def producer():
+        for item_id in range(num_items):
+            q_manager.put_to_data_node(data_nodes[item_id % len(data_nodes)], (0, item_id))
+            if item_id % 10 == 0:
+                time.sleep(0.001)
+        q_manager.set_closed()
+
+    workers = [ threading.Thread(target=worker, args=(data_node,))
+                for data_node in data_nodes for worker_id in range(2) ]
+    for thread in workers:
+        thread.start()
+    q_manager.set_opened()
+    producer_thread = threading.Thread(target=producer)
+    producer_thread.start()
+    results = []
+    while True:
+        item = q_manager.get_for_thread_id()
+        if item == 'STOP':
+            break
+        results.append(item)
+    producer_thread.join()
+    for data_node in data_nodes:
+        for worker_id in range(2):
+            q_manager.queues.put(data_node, 'STOP')
+    for thread in workers:
+        thread.join()
+    return sorted(results)
+
+
+def create_queues_manager(manager, queues_backend, queues_manager_class):
+    q_manager = queues_manager_class(options(queues_backend), [multiprocessing.current_process().name],
+                                     manager=manager)
+    for data_node in data_nodes:
+        q_manager.queues.add_new_data_node(data_node)
+    return q_manager
+
+
+@pytest.mark.parametrize('queues_backend', ['manager', 'native'])
+def test_get_for_thread_id_matches_reference(manager, queues_backend):
+    thread_id = 'download_' + multiprocessing.current_process().name
+    reference = create_queues_manager(manager, 'manager', reference_queues_manager)
+    q_manager = create_queues_manager(manager, queues_backend, queues_manager.NC4SL_queues_manager)
+    for seed, num_items in enumerate([0, 1, 50, 200]):
+        expected = retrieve(reference, num_items, seed)
+        assert expected == sorted([ (data_nodes[item_id % len(data_nodes)], item_id) for item_id in range(num_items) ])
+        #Successive retrievals reuse the queues. Sentinels from previous retrievals are ignored:
+        assert retrieve(q_manager, num_items, seed) == expected
+        assert getattr(q_manager, thread_id + '_expected').value == 0
+        assert getattr(reference, thread_id + '_expected').value == 0
+        assert q_manager.consumed == {} and q_manager.remaining == {}
+        assert all( q_manager.queues.qsize(data_node) == 0 for data_node in data_nodes )
+
+
+def test_get_for_thread_id_blocks_until_closed(manager):
+    thread_id = 'download_' + multiprocessing.current_process().name
+    q_manager = create_queues_manager(manager, 'manager', queues_manager.NC4SL_queues_manager)
+    q_manager.set_opened()
+    q_manager.put_to_data_node('node0', (0, 0))
+    q_manager.put_for_thread_id(thread_id, 'result')
+    assert q_manager.get_for_thread_id() == 'result'
+    #All expected results were consumed but the producer is not done:
+    results = []
+    consumer = threading.Thread(target=lambda: results.append(q_manager.get_for_thread_id()))
+    consumer.start()
+    consumer.join(0.2)
+    assert consumer.is_alive()
+    q_manager.set_closed()
+    consumer.join(5)
+    assert results == ['STOP']
+    assert getattr(q_manager, thread_id + '_expected').value == 0
+    q_manager.queues.get('node0')
+
+
+def test_get_for_thread_id_waits_for_split_items(manager):
+    thread_id = 'download_' + multiprocessing.current_process().name
+    q_manager = create_queues_manager(manager, 'manager', queues_manager.NC4SL_queues_manager)
+    q_manager.set_opened()
+    q_manager.put_to_data_node('node0', (0, 'batch'))
+    q_manager.set_closed()
+    results = []
+
+    def consumer():
+        while True:
+            item = q_manager.get_for_thread_id()
+            results.append(item)
+            if item == 'STOP':
+                break
+
+    consumer_thread = threading.Thread(target=consumer)
+    consumer_thread.start()
+    #The consumer received 'CLOSED' and expects a single result. The batch is then split in three:
+    time.sleep(0.2)
+    q_manager.queues.get('node0')
+    for item_id in range(2):
+        q_manager.put_to_data_node_from_thread_id(thread_id, 'node0', (0, item_id))
+    for item_id in range(3):
+        q_manager.put_for_thread_id(thread_id, item_id)
+    consumer_thread.join(5)
+    assert results == [0, 1, 2, 'STOP']
+    assert getattr(q_manager, thread_id + '_expected').value == 0
+    for item_id in range(2):
+        q_manager.queues.get('node0')
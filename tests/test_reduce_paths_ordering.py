@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from netcdf4_soft_links.soft_links import create_soft_links
+
+
+def reference_reduce_paths_ordering(time_axis, time_axis_unique, paths_ordering, table):
+    #reduce_paths_ordering before it was vectorized:
+    paths_indices_on_time_axis = np.empty(time_axis.shape, dtype=np.int64)
+    paths_id_on_time_axis = np.empty(time_axis.shape, dtype=np.int64)
+
+    paths_list = list(paths_ordering['path'])
+    paths_id_list = list(paths_ordering['path_id'])
+    for path_index, (path_id, path) in enumerate(zip(paths_id_list, paths_list)):
+        paths_indices_on_time_axis[path == table['paths']] = path_index
+        paths_id_on_time_axis[path == table['paths']] = path_id
+
+    useful_paths_id_list_unique = list(np.unique([paths_id_list[np.min(paths_indices_on_time_axis[time == time_axis])]
+                                                  for time in time_axis_unique]))
+    useful_file_name_list_unique = [paths_list[paths_id_list.index(path_id)].split('/')[-1]
+                                    for path_id in useful_paths_id_list_unique]
+
+    useful_file_id_list = [file_id for file_id in range(len(paths_ordering))
+                           if paths_ordering['path_id'][file_id] in useful_paths_id_list_unique]
+    for file_id in range(len(paths_ordering)):
+        if not paths_ordering['path_id'][file_id] in useful_paths_id_list_unique:
+            file_name = paths_ordering['path'][file_id].split('/')[-1]
+            if file_name in useful_file_name_list_unique:
+                equivalent_path_id = useful_paths_id_list_unique[useful_file_name_list_unique.index(file_name)]
+                equivalent_file_id = list(paths_ordering['path_id']).index(equivalent_path_id)
+                if paths_ordering['checksum'][file_id] == paths_ordering['checksum'][equivalent_file_id]:
+                    useful_file_id_list.append(file_id)
+
+    if len(useful_file_id_list) > 0:
+        return paths_ordering[np.sort(useful_file_id_list)], paths_id_on_time_axis
+    else:
+        return paths_ordering, paths_id_on_time_axis
+
+
+def synthetic_catalog(random_state, num_files, steps_per_file, num_replicas):
+    #num_files files with overlapping time steps, each available from num_replicas data nodes
+    #in a random order. One in five replicas has a different checksum:
+    paths_ordering = np.empty(num_files * num_replicas, dtype=[('path_id', np.int64), ('path', 'a255'),
+                                                               ('checksum', 'a255')])
+    file_ids = np.tile(np.arange(num_files), num_replicas)
+    for path_index, file_id in enumerate(file_ids):
+        paths_ordering['path'][path_index] = '/node{0}/f{1}.nc'.format(path_index // num_files, file_id)
+        paths_ordering['path_id'][path_index] = hash(paths_ordering['path'][path_index])
+        paths_ordering['checksum'][path_index] = 'c{0}'.format(file_id if random_state.rand() < 0.8
+                                                               else -path_index - 1)
+    permutation = random_state.permutation(len(paths_ordering))
+    paths_ordering = paths_ordering[permutation]
+    file_ids = file_ids[permutation]
+
+    time_axis_list = [ np.arange(file_id * steps_per_file,
+                                 (file_id + 1) * steps_per_file + random_state.randint(0, 3), dtype=np.float64)
+                       for file_id in file_ids ]
+    time_axis = np.concatenate(time_axis_list)
+    table = np.empty(len(time_axis), dtype=[('paths', 'a255'), ('indices', np.int64)])
+    table['paths'] = np.concatenate([ np.repeat(path, len(file_time_axis)) for path, file_time_axis
+                                      in zip(paths_ordering['path'], time_axis_list) ])
+    table['indices'] = np.concatenate([ np.arange(len(file_time_axis)) for file_time_axis in time_axis_list ])
+    #Some time steps are not requested:
+    time_axis_unique = np.unique(time_axis)
+    time_axis_unique = time_axis_unique[random_state.rand(len(time_axis_unique)) < 0.9]
+    return time_axis, time_axis_unique, paths_ordering, table
+
+
+def assert_same_reduction(catalog):
+    expected = reference_reduce_paths_ordering(*catalog)
+    reduced = create_soft_links.reduce_paths_ordering(*catalog)
+    np.testing.assert_array_equal(reduced[0], expected[0])
+    np.testing.assert_array_equal(reduced[1], expected[1])
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_reduce_paths_ordering_small_catalogs(seed):
+    random_state = np.random.RandomState(seed)
+    assert_same_reduction(synthetic_catalog(random_state, random_state.randint(1, 10),
+                                            random_state.randint(1, 10), random_state.randint(1, 4)))
+
+
+def test_reduce_paths_ordering_large_catalog():
+    assert_same_reduction(synthetic_catalog(np.random.RandomState(0), 300, 60, 2))
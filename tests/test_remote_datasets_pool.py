@@ -0,0 +1,94 @@
+import time
+
+import pytest
+import requests
+
+from netcdf4_soft_links import netcdf_utils
+from netcdf4_soft_links.remote_netcdf import queryable_netcdf
+
+
+class fake_pydap_dataset:
+    def __init__(self, file_name, timeout=None, **kwargs):
+        self.file_name = file_name
+        self.timeout = timeout
+        self.closed = False
+        self.variables = dict()
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def remote_datasets(monkeypatch):
+    pool = queryable_netcdf.datasets_pool(8, idle_timeout=300)
+    monkeypatch.setattr(queryable_netcdf, 'remote_datasets', pool)
+    opened = []
+
+    def open_dataset(file_name, **kwargs):
+        opened.append(fake_pydap_dataset(file_name, **kwargs))
+        return opened[-1]
+
+    monkeypatch.setattr(queryable_netcdf.netcdf4_pydap, 'Dataset', open_dataset)
+    #Do not wait between trials:
+    monkeypatch.setattr(queryable_netcdf.time, 'sleep', lambda seconds: None)
+    yield pool, opened
+    pool.close_all()
+
+
+def remote_data(session, timeout=10):
+    return queryable_netcdf.queryable_netCDF('http://node/thredds/dodsC/file.nc', session=session, timeout=timeout)
+
+
+def test_remote_dataset_reused(remote_datasets):
+    pool, opened = remote_datasets
+    session = requests.Session()
+    for trial in range(3):
+        assert remote_data(session).unsafe_handling(lambda dataset: dataset) is opened[0]
+    assert len(opened) == 1
+    #Another session is another dataset:
+    remote_data(requests.Session()).unsafe_handling(lambda dataset: dataset)
+    assert len(opened) == 2
+
+
+def test_remote_dataset_idle_timeout(remote_datasets, monkeypatch):
+    pool, opened = remote_datasets
+    session = requests.Session()
+    remote_data(session).unsafe_handling(lambda dataset: dataset)
+    now = time.time()
+    monkeypatch.setattr(queryable_netcdf.time, 'time', lambda: now + 301)
+    remote_data(session).unsafe_handling(lambda dataset: dataset)
+    assert len(opened) == 2
+    assert opened[0].closed
+    assert not opened[1].closed
+
+
+def test_remote_dataset_discarded_and_reopened_with_longer_timeout(remote_datasets):
+    pool, opened = remote_datasets
+    session = requests.Session()
+    calls = []
+
+    def retrieve(dataset):
+        calls.append(dataset)
+        if len(calls) == 1:
+            raise requests.exceptions.ReadTimeout('read timed out')
+        return dataset.timeout
+
+    assert remote_data(session, timeout=10).safe_handling(retrieve) == 20
+    assert len(opened) == 2
+    #The dataset used when the error occurred is closed:
+    assert opened[0].closed
+    assert calls == opened
+    assert list(pool.datasets.values())[0][2] is opened[1]
+
+
+def test_check_if_opens_closes_pooled_dataset(remote_datasets, monkeypatch):
+    pool, opened = remote_datasets
+    session = requests.Session()
+    data = remote_data(session)
+    data.unsafe_handling(lambda dataset: dataset)
+    monkeypatch.setattr(netcdf_utils, 'check_if_opens', lambda dataset, default=False: True)
+    assert data.check_if_opens()
+    #The remote file was opened again and the new dataset is reused:
+    assert len(opened) == 2
+    assert opened[0].closed
+    assert data.unsafe_handling(lambda dataset: dataset) is opened[1]
@@ -0,0 +1,71 @@
+import multiprocessing
+import socket
+from urllib2 import HTTPError
+
+import numpy as np
+import pytest
+import requests
+from pydap.exceptions import ServerError
+
+from netcdf4_soft_links import indices_utils, queues_manager, retrieval_manager
+from netcdf4_soft_links.remote_netcdf.queryable_netcdf import dodsError
+
+
+@pytest.fixture(scope='module')
+def manager():
+    manager = multiprocessing.Manager()
+    yield manager
+    manager.shutdown()
+
+
+def test_getitem_from_variable_logs_every_request():
+    variable = np.arange(100 * 1024, dtype=np.float64).reshape((100, 1024))
+    getitem_tuple = (slice(0, 100, 1), slice(0, 1024, 1))
+    indices_utils.start_request_log()
+    np.testing.assert_array_equal(indices_utils.getitem_from_variable(variable, getitem_tuple, None), variable)
+    #800 kb split in requests of at most 0.2 Mb:
+    np.testing.assert_array_equal(indices_utils.getitem_from_variable(variable, getitem_tuple, 0.2), variable)
+    requests_list = indices_utils.stop_request_log()
+    assert requests_list[0][0] == pytest.approx(100 * 1024 * 8 / 1024.0 ** 2)
+    assert requests_list[0][2] is False
+    assert len(requests_list) == 5
+    assert all([ request[2] for request in requests_list[1:] ])
+    assert sum([ request[0] for request in requests_list[1:] ]) == pytest.approx(requests_list[0][0])
+    #Nothing is logged outside start_request_log and stop_request_log:
+    indices_utils.getitem_from_variable(variable, getitem_tuple, None)
+    assert indices_utils.stop_request_log() == []
+
+
+def test_request_sizes_adapt_only_to_split_requests(manager):
+    request_sizes = queues_manager.Request_sizes_data_node(manager)
+    #Many variables retrieved in single requests do not grow the size, however large the total:
+    request_sizes.success('node', 450.0, [ (400.0, 1.0, False) for request in range(5) ])
+    assert request_sizes['node'] == 450.0
+    request_sizes.success('node', 450.0, [ (450.0, 1.0, True), (450.0, 1.0, True) ])
+    assert request_sizes['node'] == 500.0
+    #Throughput collapsed:
+    request_sizes.success('node', 500.0, [ (500.0, 100.0, True), (500.0, 100.0, True) ])
+    assert request_sizes['node'] == 250.0
+    request_sizes.failure('node', 250.0)
+    assert request_sizes['node'] == 125.0
+    #Nothing was requested:
+    request_sizes.success('other', 450.0, [])
+    assert not 'other' in request_sizes.keys()
+
+
+def test_is_size_error():
+    timeout = requests.exceptions.ReadTimeout('timed out')
+    assert retrieval_manager.is_size_error(timeout)
+    assert retrieval_manager.is_size_error(socket.timeout())
+    assert retrieval_manager.is_size_error(dodsError('failed', cause=timeout))
+    assert retrieval_manager.is_size_error(HTTPError('http://node', 503, 'Unavailable', None, None))
+    assert retrieval_manager.is_size_error(HTTPError('http://node', 413, 'Too large', None, None))
+    assert retrieval_manager.is_size_error(ServerError('Server error 500: "Request too big"'))
+    assert retrieval_manager.is_size_error(requests.exceptions.HTTPError('502 Server Error: Bad Gateway'))
+
+    assert not retrieval_manager.is_size_error(HTTPError('http://node', 401, 'Unauthorized', None, None))
+    assert not retrieval_manager.is_size_error(requests.exceptions.HTTPError('403 Client Error: Forbidden'))
+    assert not retrieval_manager.is_size_error(ServerError('Server error 0: "Variable tas not found"'))
+    assert not retrieval_manager.is_size_error(dodsError('failed'))
+    assert not retrieval_manager.is_size_error(KeyError('500'))
+    assert not retrieval_manager.is_size_error(requests.exceptions.ConnectionError('refused'))